@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Batch execution of many OpenRefine programs / inputs in one spark application
+
+Jobs are given as manifest (JSON list of {"input", "or_program" | "program", "output"}
+objects or CSV lines "input,or_program,output") or as glob of inputs with one program.
+"""
+
+import csv
+import glob
+import json
+import os
+import time
+
+import log
+
+from service import Service, FINISHED
+
+
+def load_manifest(path):
+    """
+    read batch manifest, relative paths are resolved against manifest directory
+
+    :param path:        path to JSON or CSV manifest
+    :return: list of job requests
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, "r") as manifest:
+        if path.endswith(".json"):
+            entries = json.load(manifest)
+        else:
+            entries = [dict(zip(["input", "or_program", "output"], [i.strip() for i in line]))
+                       for line in csv.reader(manifest) if line and not line[0].startswith("#")]
+
+    for entry in entries:
+        for key in ["input", "or_program", "output"]:
+            if entry.get(key):
+                entry[key] = os.path.join(base_dir, entry[key])
+    return entries
+
+
+def glob_root(input_glob):
+    """
+    return directory of glob before its first component with wildcards
+    """
+    parts = os.path.normpath(input_glob).split(os.sep)
+    index = next(i for i, part in enumerate(parts) if glob.has_magic(part) or i == len(parts) - 1)
+    return os.sep.join(parts[:index]) or (os.sep if input_glob.startswith(os.sep) else os.curdir)
+
+
+def check_outputs(requests):
+    """
+    check that outputs of jobs are distinct and don't overwrite inputs (output is removed before job)
+
+    :param requests:    list of job requests
+    :return: requests
+    """
+    inputs = [os.path.abspath(r["input"]) for r in requests if r.get("input")]
+    outputs = set()
+    for request in requests:
+        if not request.get("output"):
+            continue
+        output = os.path.abspath(request["output"])
+        if output in outputs:
+            raise ValueError("output '%s' of several jobs" % request["output"])
+        outputs.add(output)
+        for i in inputs:
+            if output == i or output.startswith(i + os.sep):
+                raise ValueError("output '%s' overwrites input '%s'" % (request["output"], i))
+    return requests
+
+
+def glob_manifest(input_glob, or_program, output_dir):
+    """
+    generate job requests applying one program to every matching input
+
+    :param input_glob:  glob of input files
+    :param or_program:  path to OR program
+    :param output_dir:  directory of output files (named by paths of input files relative to directory of glob)
+    :return: list of job requests
+    """
+    if None in [or_program, output_dir]:
+        raise ValueError("--input-glob requires --or-program and --output-dir.")
+    program = json.load(open(or_program, "r"))
+    root = glob_root(input_glob)
+    return check_outputs([{"input": i, "program": program,
+                           "output": os.path.join(output_dir, os.path.relpath(i, root))}
+                          for i in sorted(glob.glob(input_glob))])
+
+
+def run(scalable_or, args):
+    """
+    execute all jobs of batch with bounded concurrency and write combined report
+
+    :param scalable_or:     initialized ScalableOR object (with spark context)
+    :param args:            parsed command line arguments
+    :return: True if all jobs are finished successfully
+    """
+    if args.batch:
+        requests = load_manifest(args.batch)
+    else:
+        requests = glob_manifest(args.input_glob, args.or_program, args.output_dir)
+        # directories of inputs of nested globs
+        for directory in set(os.path.dirname(r["output"]) for r in requests):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+    started = time.time()
+    service = Service(scalable_or, args.max_jobs)
+    jobs = []
+    for index, request in enumerate(requests):
+        request.setdefault("pool", "batch-%d" % (index % args.max_jobs))
+        jobs.append(service.submit(request))
+    service.wait()
+
+    report = {
+        "jobs": [j.to_dict() for j in jobs],
+        "total": len(jobs),
+        "finished": len([j for j in jobs if j.status == FINISHED]),
+        "failed": len([j for j in jobs if j.status != FINISHED]),
+        "seconds": time.time() - started,
+    }
+    log.logger.info("batch: %(finished)d of %(total)d jobs finished, %(failed)d failed in %(seconds).1fs" % report)
+
+    if args.report:
+        with open(args.report, "w") as output:
+            json.dump(report, output, indent=2)
+
+    return report["failed"] == 0
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Sharing of command payloads with spark tasks
+
+Large payloads (edit maps, facet value sets, expression source) are shipped once per executor as
+broadcast variables instead of being pickled into every task closure. Small payloads stay in the
+closure, where they are cheaper than a broadcast lookup. Pickled sizes of payloads of every step are
+logged with its closure.
+"""
+
+import cPickle
+import threading
+
+import log
+
+# minimal pickled size of payload in bytes shipped as broadcast variable
+BROADCAST_THRESHOLD = 64 * 1024
+# pickled sizes of payloads shared since last logged closure of job running in thread
+STATE = threading.local()
+
+
+def payload_size(value):
+    """
+    return pickled size of value in bytes
+    """
+    return len(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+
+def share(value, sc=None):
+    """
+    share value with tasks
+
+    :param value:   payload
+    :param sc:      spark context (None: value is captured by closure, e.g. in local engine)
+    :return: callable returning value (call it once per partition)
+    """
+    if sc is not None:
+        size = payload_size(value)
+        broadcast = size >= BROADCAST_THRESHOLD
+        if not hasattr(STATE, "payloads"):
+            STATE.payloads = []
+        STATE.payloads.append((size, broadcast))
+        if broadcast:
+            shared = sc.broadcast(value)
+            log.logger.info("broadcast payload of %d bytes" % size)
+            return lambda: shared.value
+    return lambda: value
+
+
+def log_closure(cmd, func):
+    """
+    log sizes of payloads of task closure of command once per step (sizes are measured by share, the
+    closure isn't pickled again)
+
+    :param cmd:     OpenRefine command
+    :param func:    function shipped to tasks
+    :return: func
+    """
+    payloads, STATE.payloads = getattr(STATE, "payloads", []), []
+    if getattr(STATE, "logged", None) is not cmd:
+        STATE.logged = cmd
+        log.logger.info("closure of '%s': %d bytes of payloads in closure, %d bytes broadcast" % (
+            cmd["op"], sum(s for s, b in payloads if not b), sum(s for s, b in payloads if b)))
+    return func
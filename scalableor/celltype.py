@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Guessing of cell types at import (guessCellType)
+
+Columns are scanned in one pass. A column gets the first type (long, double, boolean, date) which all
+its non-blank values have, otherwise it stays string. A value has a type only if it is written back
+unchanged (e.g. "1.50" and "007" stay strings), so the exported data is equal to untyped import.
+Blank cells of typed columns are null.
+"""
+
+import datetime
+import decimal
+import math
+import re
+
+LONG = 1
+DOUBLE = 2
+BOOLEAN = 4
+DATE = 8
+ALL = LONG | DOUBLE | BOOLEAN | DATE
+# types in order of preference
+TYPES = ((LONG, "long"), (DOUBLE, "double"), (BOOLEAN, "boolean"), (DATE, "date"))
+
+RE_LONG = re.compile(r"^-?(0|[1-9]\d*)$")
+RE_DOUBLE = re.compile(r"^-?\d+\.\d+(E-?\d+)?$")
+RE_DATE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+MAX_LONG = 2 ** 63
+
+
+def java_string(value):
+    """
+    convert value to string like spark CSV writer
+    """
+    if value is None:
+        return u"null"
+    if isinstance(value, bool):
+        return u"true" if value else u"false"
+    if isinstance(value, float):
+        if math.isnan(value):
+            return u"NaN"
+        if math.isinf(value):
+            return u"Infinity" if value > 0 else u"-Infinity"
+        if value == 0 or 1e-3 <= abs(value) < 1e7:
+            return unicode(repr(value))
+        # computerized scientific notation of java Double.toString
+        number = decimal.Decimal(repr(value))
+        digits = "".join(str(i) for i in number.as_tuple()[1]).rstrip("0") or "0"
+        return u"%s%s.%sE%d" % ("-" if value < 0 else "", digits[0], digits[1:] or "0", number.adjusted())
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    return unicode(value)
+
+
+def cell_text(value):
+    """
+    return cell as text of string steps (facets, splits, mass edit): typed value like CSV export, null as blank
+    """
+    if value is None:
+        return u""
+    if isinstance(value, basestring):
+        return value
+    return java_string(value)
+
+
+def parse_date(value):
+    found = RE_DATE.match(value)
+    if found is None:
+        return None
+    try:
+        return datetime.date(*[int(i) for i in found.groups()])
+    except ValueError:
+        return None
+
+
+def candidates(value):
+    """
+    return mask of types of value (blank value has all types)
+    """
+    if not value:
+        return ALL
+    mask = 0
+    if RE_LONG.match(value) and -MAX_LONG <= int(value) < MAX_LONG:
+        mask |= LONG
+    elif RE_DOUBLE.match(value) and java_string(float(value)) == value:
+        mask |= DOUBLE
+    elif value == "true" or value == "false":
+        mask |= BOOLEAN
+    elif parse_date(value) is not None:
+        mask |= DATE
+    return mask
+
+
+def guess_rows(rows, masks=None):
+    """
+    narrow type masks of columns by rows
+
+    :param rows:    iterable of rows (sequences of strings)
+    :param masks:   initial masks of columns
+    :return: list of masks of columns
+    """
+    masks = list(masks or [])
+    for row in rows:
+        if len(row) > len(masks):
+            masks.extend([ALL] * (len(row) - len(masks)))
+        for index, value in enumerate(row):
+            if masks[index]:
+                masks[index] &= candidates(value)
+    return masks
+
+
+def merge(masks1, masks2):
+    """
+    merge type masks of two parts of data
+    """
+    width = max(len(masks1), len(masks2))
+    masks1 = list(masks1) + [ALL] * (width - len(masks1))
+    masks2 = list(masks2) + [ALL] * (width - len(masks2))
+    return [m1 & m2 for m1, m2 in zip(masks1, masks2)]
+
+
+def choose_types(masks):
+    """
+    choose type of every column (column of blank values stays string)
+
+    :param masks:   type masks of columns
+    :return: list of type names
+    """
+    result = []
+    for mask in masks:
+        name = "string"
+        if mask != ALL:
+            for bit, type_name in TYPES:
+                if mask & bit:
+                    name = type_name
+                    break
+        result.append(name)
+    return result
+
+
+def guess_types(rows):
+    """
+    guess types of columns of rows in one pass
+
+    :return: list of type names
+    """
+    return choose_types(guess_rows(rows))
+
+
+def guess_rdd(rdd):
+    """
+    guess types of columns of spark rdd of split rows in one distributed pass
+
+    :return: list of type names
+    """
+    masks = rdd.mapPartitions(lambda rows: [guess_rows(rows)]).reduce(merge)
+    return choose_types(masks)
+
+
+PARSERS = {
+    "long": int,
+    "double": float,
+    "boolean": lambda value: value == "true",
+    "date": parse_date,
+}
+
+
+def row_parser(types):
+    """
+    create callback converting row of strings to typed row
+    """
+    parsers = [(index, PARSERS[name]) for index, name in enumerate(types) if name in PARSERS]
+
+    def parse_row(row):
+        row = list(row)
+        for index, parse in parsers:
+            row[index] = parse(row[index]) if row[index] else None
+        return tuple(row)
+
+    return parse_row
+
+
+def spark_schema(types, names):
+    """
+    create spark schema of typed columns
+    """
+    from pyspark.sql.types import BooleanType, DateType, DoubleType, LongType, StringType, StructField, StructType
+
+    spark_types = {"long": LongType, "double": DoubleType, "boolean": BooleanType, "date": DateType,
+                   "string": StringType}
+    return StructType([StructField(name, spark_types[type_name](), True) for name, type_name in zip(names, types)])
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Reliable checkpoints of long OpenRefine programs
+
+Data frame is written as parquet after every N steps and after steps marked with "checkpoint": true.
+Reading a checkpoint truncates the lineage of data frame. A manifest is written after the data, so
+only completed checkpoints are resumed. Checkpoints are kept per program (hash of program and input),
+a resumed run continues after the last completed checkpoint of the same program. Reconciled columns are
+kept in memory of driver, so a run is resumed only from checkpoints before the first reconcile step.
+
+Manifests are accessed over the Hadoop FileSystem API of spark context, so checkpoints can be kept on
+any file system of spark (e.g. HDFS, S3) like the parquet data.
+"""
+
+import json
+import os
+import shutil
+
+import incremental
+import log
+
+
+def program_key(or_program):
+    """
+    return key of OpenRefine program and state of its input files
+    """
+    inputs = [incremental.scan_input(cmd["path"]) for cmd in or_program
+              if cmd["op"] == "scalableor/import" and os.path.exists(cmd["path"])]
+    return incremental.program_hash([or_program, inputs])[:16]
+
+
+class LocalFiles(object):
+    """
+    this class accesses files of checkpoints on local file system (without spark context)
+    """
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def list(self, path):
+        return os.listdir(path)
+
+    def read(self, path):
+        with open(path, "r") as f:
+            return f.read()
+
+    def write(self, path, data):
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.rename(path + ".tmp", path)
+
+    def delete(self, path):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class HadoopFiles(object):
+    """
+    this class accesses files of checkpoints over Hadoop FileSystem API of spark context
+    """
+
+    def __init__(self, sc):
+        self.jvm = sc._jvm
+        self.conf = sc._jsc.hadoopConfiguration()
+
+    def get(self, path):
+        """
+        return file system and Hadoop path object
+        """
+        hadoop_path = self.jvm.org.apache.hadoop.fs.Path(path)
+        return hadoop_path.getFileSystem(self.conf), hadoop_path
+
+    def exists(self, path):
+        fs, hadoop_path = self.get(path)
+        return fs.exists(hadoop_path)
+
+    def list(self, path):
+        fs, hadoop_path = self.get(path)
+        return [status.getPath().getName() for status in fs.listStatus(hadoop_path)]
+
+    def read(self, path):
+        fs, hadoop_path = self.get(path)
+        stream = fs.open(hadoop_path)
+        try:
+            return self.jvm.java.util.Scanner(stream, "UTF-8").useDelimiter("\\A").next()
+        finally:
+            stream.close()
+
+    def write(self, path, data):
+        fs, hadoop_path = self.get(path)
+        tmp_path = self.jvm.org.apache.hadoop.fs.Path(path + ".tmp")
+        stream = fs.create(tmp_path, True)
+        try:
+            stream.write(bytearray(data))
+        finally:
+            stream.close()
+        fs.delete(hadoop_path, False)
+        fs.rename(tmp_path, hadoop_path)
+
+    def delete(self, path):
+        fs, hadoop_path = self.get(path)
+        fs.delete(hadoop_path, True)
+
+
+def get_files(sc):
+    """
+    return accessor of checkpoint files (local file system without spark context)
+    """
+    return HadoopFiles(sc) if sc is not None else LocalFiles()
+
+
+class Checkpoints(object):
+    """
+    this class writes and reads checkpoints of one OpenRefine program
+    """
+
+    def __init__(self, directory, or_program, every=None, resume=False):
+        """
+        :param directory:   directory of checkpoints
+        :param or_program:  sequence of OpenRefine commands
+        :param every:       checkpoint after every N steps (None: only marked steps)
+        :param resume:      continue after last completed checkpoint
+        """
+        self.directory = os.path.join(directory, program_key(or_program))
+        self.every = every
+        self.resume = resume
+        # index of first reconcile step (recon tables of earlier steps aren't checkpointed)
+        self.recon_step = next((index for index, cmd in enumerate(or_program) if cmd["op"] == "core/recon"),
+                               len(or_program))
+
+    def is_due(self, index, cmd):
+        """
+        check that data is checkpointed after step
+        """
+        if cmd.get("checkpoint") is True:
+            return True
+        return bool(self.every) and (index + 1) % self.every == 0
+
+    def manifest_path(self, index):
+        return os.path.join(self.directory, "step-%05d.json" % index)
+
+    def save(self, index, df):
+        """
+        write data frame after step and return data frame read from checkpoint (truncated lineage)
+        """
+        path = os.path.join(self.directory, "step-%05d.parquet" % index)
+        # parquet doesn't allow some characters of OpenRefine column names
+        df.toDF(*["c%d" % i for i in range(len(df.columns))]).write.mode("overwrite").parquet(path)
+
+        manifest = {"step": index, "path": path, "columns": df.columns}
+        get_files(df.sql_ctx._sc).write(self.manifest_path(index), json.dumps(manifest))
+        log.logger.info("checkpoint: step %d is written to '%s'" % (index + 1, path))
+        return self.read(df.sql_ctx, manifest)
+
+    def read(self, sql_context, manifest):
+        return sql_context.read.parquet(manifest["path"]).toDF(*manifest["columns"])
+
+    def load(self, sc):
+        """
+        read last completed checkpoint
+
+        :param sc:  spark context
+        :return: tuple of index of next step and data frame (0, None if checkpoint doesn't exist)
+        """
+        files = get_files(sc)
+        if not files.exists(self.directory):
+            return 0, None
+        manifests = sorted(i for i in files.list(self.directory) if i.endswith(".json"))
+        resumable = [i for i in manifests if int(i[len("step-"):-len(".json")]) < self.recon_step]
+        if len(resumable) < len(manifests):
+            log.logger.warn("checkpoint: %d checkpoint(s) after reconcile step %d aren't resumed" % (
+                len(manifests) - len(resumable), self.recon_step + 1))
+        manifests = resumable
+        if not manifests:
+            return 0, None
+
+        from pyspark.sql import SQLContext
+
+        manifest = json.loads(files.read(os.path.join(self.directory, manifests[-1])))
+        log.logger.info("checkpoint: resume after step %d from '%s'" % (manifest["step"] + 1, manifest["path"]))
+        return manifest["step"] + 1, self.read(SQLContext(sc), manifest)
+
+    def clear(self, sc):
+        """
+        remove checkpoints of program after successful run
+
+        :param sc:  spark context
+        """
+        get_files(sc).delete(self.directory)
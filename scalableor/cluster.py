@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Key collision clustering of column values (scalableor/cluster)
+
+Distinct values of column are counted first, so keys are computed once per distinct value. Values are
+grouped by key and groups with more than one distinct value are clusters. The result is written as
+cluster report or as OpenRefine program of mass edits, which replaces values of every cluster with
+its most frequent value.
+"""
+
+import io
+import json
+
+from scalableor.keyer import get_keyer
+
+MODE_REPORT = "report"
+MODE_MASS_EDIT = "mass-edit"
+
+
+def get_cluster_keyer(cmd):
+    """
+    return keying function of command
+
+    :param cmd:     command with keyer name and keyer parameters (ngramSize, encoding)
+    """
+    return get_keyer(cmd.get("keyer", "fingerprint"), cmd)
+
+
+def build_clusters(groups):
+    """
+    build clusters from values grouped by key
+
+    :param groups:  iterable of (key, list of (value, count))
+    :return: list of clusters sorted by size
+    """
+    clusters = []
+    for key, values in groups:
+        values = sorted(values, key=lambda e: (-e[1], e[0]))
+        if len(values) < 2:
+            continue
+        clusters.append({
+            "key": key,
+            "size": len(values),
+            "rowCount": sum(c for v, c in values),
+            "values": [{"v": v, "c": c} for v, c in values],
+        })
+    clusters.sort(key=lambda e: (-e["size"], -e["rowCount"], e["key"]))
+    return clusters
+
+
+def mass_edit_program(cmd, clusters):
+    """
+    create OpenRefine program replacing values of every cluster with its most frequent value
+    """
+    edits = [{"from": [e["v"] for e in cluster["values"][1:]], "fromBlank": False, "fromError": False,
+              "to": cluster["values"][0]["v"]} for cluster in clusters]
+    return [{
+        "op": "core/mass-edit",
+        "description": "Mass edit cells in column %s" % cmd["columnName"],
+        "engineConfig": {"facets": [], "mode": "row-based"},
+        "columnName": cmd["columnName"],
+        "expression": "value",
+        "edits": edits,
+    }]
+
+
+def write_clusters(cmd, groups):
+    """
+    write clusters to output file of command
+
+    :param cmd:     cluster command
+    :param groups:  iterable of (key, list of (value, count))
+    """
+    clusters = build_clusters(groups)
+    if cmd.get("mode", MODE_REPORT) == MODE_MASS_EDIT:
+        result = mass_edit_program(cmd, clusters)
+    else:
+        result = {"columnName": cmd["columnName"], "keyer": cmd.get("keyer", "fingerprint"), "clusters": clusters}
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    with io.open(cmd["output"], "w", encoding="utf-8") as f:
+        f.write(text.decode("utf-8") if isinstance(text, str) else text)
+    return clusters
@@ -2,3 +2,6 @@
 
 NAME = "Scalable.OR"
 COLUMN_NAME = "Column %d"
+
+ENGINE_SPARK = "spark"
+ENGINE_LOCAL = "local"
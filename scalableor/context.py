@@ -4,11 +4,19 @@ Original description of GREL function is here:
 https://github.com/OpenRefine/OpenRefine/wiki/General-Refine-Expression-Language
 """
 
+import collections
+import itertools
 import json
 import math
+import threading
 
 import re
 
+from scalableor import keyer, memo, pattern
+from scalableor.celltype import java_string
+from scalableor.failure import fallback
+from scalableor.control import compile_controls
+
 
 def not_implemented_error(*args, **kwargs):
     """
@@ -40,6 +48,38 @@ def has_field(ob, item):
     return False
 
 
+def grel_items(array):
+    """
+    iterate items of array as GREL objects (variable of forEach/filter)
+    """
+    if array is None:
+        return iter(())
+    return itertools.imap(to_grel_object, array)
+
+
+def grel_enumerate(array):
+    """
+    iterate GREL indexes and items of array (variables of forEachIndex)
+    """
+    return itertools.izip(itertools.imap(GRELInteger, itertools.count()), grel_items(array))
+
+
+def grel_range(start, stop, step):
+    """
+    iterate GREL numbers of forRange
+    """
+    if step == 0:
+        raise ValueError("step of forRange can't be 0")
+    if all(isinstance(i, (int, long)) for i in (start, stop, step)):
+        return itertools.imap(to_grel_object, xrange(start, stop, step))
+    return itertools.imap(to_grel_object, itertools.takewhile(lambda i: i < stop if step > 0 else i > stop,
+                                                              itertools.count(float(start), step)))
+
+
+def is_non_blank(value):
+    return value is not None and value != ""
+
+
 def if_(exp, true, false):
     return true if exp else false
 
@@ -91,6 +131,28 @@ class GRELBoolean(object):
         return str(self.value)
 
 
+def grel_keyer(func):
+    """
+    wrap keying function of keyer module to return GREL string
+    """
+
+    def wrapper(value, *args):
+        return GRELString(func(value, *args).encode("utf-8"))
+
+    return wrapper
+
+
+# keyers of string methods and functions (pure builtins)
+PURE_KEYERS = dict((name, memo.pure(name)(grel_keyer(func))) for name, func in [
+    ("md5", keyer.md5), ("sha1", keyer.sha1), ("phonetic", keyer.phonetic), ("fingerprint", keyer.fingerprint),
+    ("ngramFingerprint", keyer.ngram_fingerprint)])
+
+
+@memo.pure("parseJson", memo.copy_json)
+def parse_json(value):
+    return json.loads(value)
+
+
 class GRELString(str):
     """
     This class implements GREL string functionality
@@ -165,18 +227,29 @@ class GRELString(str):
             result = result.replace(ch, to_str)
         return GRELString(result)
 
+    @memo.pure("match", memo.copy_list)
     def match(self, regex):
-        # return re.match(regex, self)
-        raise NotImplementedError("match isn't implemented")
+        found = pattern.compile(r"(?:%s)\Z" % regex).match(self)
+        if found is None:
+            return None
+        return GRELList(to_grel_object(i) for i in found.groups())
 
     # String Parsing and Splitting
 
     def toNumber(self):
-        return int(self)
+        try:
+            return GRELInteger(self)
+        except ValueError:
+            return GRELFloat(self)
+
+    def toString(self, *args):
+        return self
 
+    @memo.pure("split", memo.copy_list)
     def split(self, sep):
         return GRELList(str(self).split(sep))
 
+    @memo.pure("splitByLengths", memo.copy_list)
     def splitByLengths(self, *lengths):
         from_i = to_i = 0
         result = []
@@ -198,10 +271,62 @@ class GRELString(str):
     def rpartition(self, str_or_regex, omitFragment):
         raise NotImplementedError("rpartition isn't implemented")
 
+    # Parsing
+    def parseJson(self):
+        return parse_json(self)
+
+    # Encoding and Hashing
+    md5 = PURE_KEYERS["md5"]
+    sha1 = PURE_KEYERS["sha1"]
+    phonetic = PURE_KEYERS["phonetic"]
+    fingerprint = PURE_KEYERS["fingerprint"]
+    ngramFingerprint = PURE_KEYERS["ngramFingerprint"]
 
         # Freebase Specific
 
 
+class GRELNumber(object):
+    """
+    This class implements GREL number functionality of typed cells (see guessCellType)
+    """
+    grelname = "number"
+    hasField = has_field
+
+    def toNumber(self):
+        return self
+
+    def toString(self, *args):
+        return GRELString(java_string(self).encode("utf-8"))
+
+
+class GRELInteger(long, GRELNumber):
+    pass
+
+
+class GRELFloat(float, GRELNumber):
+    pass
+
+
+def to_number(value):
+    if isinstance(value, GRELNumber):
+        return value
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return to_grel_object(value)
+    return to_grel_object(str(value)).toNumber()
+
+
+def to_string(value):
+    if isinstance(value, basestring):
+        return to_grel_object(value)
+    return GRELString(java_string(to_python_object(value)).encode("utf-8"))
+
+
+def is_numeric(value):
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return True
+    return bool(value) and value.isdigit()
+
+
 class GRELList(list):
     """
     This class implements GREL array functionality
@@ -369,7 +494,8 @@ GREL_GLOBAL_CONTEXT = {
     "replace": GRELString.replace,
     "replaceChars": GRELString.replaceChars,
     "match": GRELString.match,
-    "toNumber": GRELString.toNumber,
+    "toNumber": to_number,
+    "toString": to_string,
     "split": GRELString.split,
     "splitByLengths": GRELString.splitByLengths,
     "smartSplit": GRELString.smartSplit,
@@ -378,16 +504,11 @@ GREL_GLOBAL_CONTEXT = {
     # Controls functions: Expression
     "if_": if_,
     # https://github.com/OpenRefine/OpenRefine/wiki/GREL-Controls
-    "with_": not_implemented_error,
-    "filter_": not_implemented_error,
-    "forEach": not_implemented_error,
-    "forEachIndex": not_implemented_error,
-    "forRange": not_implemented_error,
-    "forNonBlank": not_implemented_error,
+    # with, filter, forEach, forEachIndex, forRange and forNonBlank are compiled (see control.py)
     "isBlank": lambda x: not (x or len(x)),
     "isNonBlank": lambda x: not (not (x or len(x))),
     "isNull": lambda x: x is None,
-    "isNumeric": lambda x: x and x.isdigit(),
+    "isNumeric": is_numeric,
     "isError": not_implemented_error,
     # math functions
     "floor": math.floor,
@@ -404,7 +525,7 @@ GREL_GLOBAL_CONTEXT = {
     "type_": type_,
     "hasField": has_field,
     "jsonize": json.dumps,
-    "parseJson": json.loads,
+    "parseJson": parse_json,
     # work with 2 OR projects
     "cross": not_implemented_error,
     # facet
@@ -423,13 +544,13 @@ GREL_GLOBAL_CONTEXT = {
     "diff": not_implemented_error,
     "escape": not_implemented_error,
     "unescape": not_implemented_error,
-    "md5": not_implemented_error,
-    "sha1": not_implemented_error,
-    "phonetic": not_implemented_error,
+    "md5": PURE_KEYERS["md5"],
+    "sha1": PURE_KEYERS["sha1"],
+    "phonetic": PURE_KEYERS["phonetic"],
     "reinterpret": not_implemented_error,
-    "fingerprint": not_implemented_error,
+    "fingerprint": PURE_KEYERS["fingerprint"],
     "ngram": not_implemented_error,
-    "ngramFingerprint": not_implemented_error,
+    "ngramFingerprint": PURE_KEYERS["ngramFingerprint"],
     "unicode": not_implemented_error,
     "unicodeType": not_implemented_error,
     # Freebase Specific
@@ -439,6 +560,84 @@ GREL_GLOBAL_CONTEXT = {
 }
 
 
+# maximal count of cached expressions of every kind per process
+EXPRESSION_CACHE_SIZE = 1024
+
+
+class LRUCache(object):
+    """
+    this class implements size-bounded cache of values created once per key, least recently used values are
+    evicted (caches of long-running batch and service processes are bounded)
+    """
+
+    def __init__(self, size=EXPRESSION_CACHE_SIZE):
+        self.size = size
+        self.values = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, create):
+        """
+        return cached value of key
+
+        :param key:     hashable key
+        :param create:  callback returning value of key (called without lock)
+        """
+        with self.lock:
+            if key in self.values:
+                value = self.values.pop(key)
+                self.values[key] = value
+                return value
+        value = create(key)
+        with self.lock:
+            self.values.pop(key, None)
+            if len(self.values) >= self.size:
+                self.values.popitem(last=False)
+            self.values[key] = value
+        return value
+
+    def __len__(self):
+        return len(self.values)
+
+
+# compiled expressions shared by all programs executed in this process
+COMPILED_EXPRESSIONS = LRUCache()
+EXPRESSION_FUNCTIONS = LRUCache()
+
+
+def compile_code(exp, names):
+    """
+    compile python expression to code of function definition once and cache it
+
+    :param exp:         python expression (function body)
+    :param names:       sorted tuple of context variable names
+    :return: code object defining 'exp_func'
+    """
+    def create(key):
+        parameters = ", ".join(["%s=None" % k for k in names])
+        return compile("def exp_func(" + parameters + "):\n" + "\n".join(["  " + l for l in exp.split("\n")]),
+                       "<expression>", "exec")
+
+    return COMPILED_EXPRESSIONS.get((exp, names), create)
+
+
+def compile_python(exp, names, global_context=None):
+    """
+    create expression function
+
+    :param exp:             python expression (function body)
+    :param names:           sorted tuple of context variable names
+    :param global_context:  variables available as globals of function (function is cached without them)
+    :return: expression function
+    """
+    if global_context is None:
+        return EXPRESSION_FUNCTIONS.get((exp, names), lambda key: compile_python(exp, names, {}))
+
+    namespace = dict(globals())
+    namespace.update(global_context or {})
+    exec compile_code(exp, names) in namespace
+    return namespace["exp_func"]
+
+
 def eval_python(exp, required_grel_context):
     """
     prepare GREL expression and execute it
@@ -447,14 +646,8 @@ def eval_python(exp, required_grel_context):
     :return:
     """
     exp = exp.replace("jython:", "", 1).strip()
-    parameters = ", ".join(["%s=None" % k for k in required_grel_context.keys()])
-    parameters_in = ", ".join(["%s=%s" % (k, k) for k in required_grel_context.keys()])
-    # define expression function
-    exec ("def exp_func(" + parameters + "):\n" +
-          "\n".join(["  " + l for l in exp.split("\n")]))
-
-    required_grel_context.update({"exp_func": exp_func})
-    return eval("exp_func(" + parameters_in + ")", required_grel_context)
+    exp_func = compile_python(exp, tuple(sorted(required_grel_context.keys())))
+    return exp_func(**required_grel_context)
 
 
 def to_grel_object(value):
@@ -472,6 +665,10 @@ def to_grel_object(value):
         value = GRELList(value)
     elif isinstance(value, bool):
         value = GRELBoolean(value)
+    elif isinstance(value, (int, long)) and not isinstance(value, GRELNumber):
+        value = GRELInteger(value)
+    elif isinstance(value, float) and not isinstance(value, GRELNumber):
+        value = GRELFloat(value)
     return value
 
 
@@ -487,36 +684,72 @@ def to_python_object(value):
         value = list(value)
     elif isinstance(value, GRELBoolean):
         value = value.value
+    elif isinstance(value, GRELInteger):
+        value = int(value)
+    elif isinstance(value, GRELFloat):
+        value = float(value)
     return value
 
 
-def eval_grel(exp, grel_context=None):
+def key_of(value):
     """
-    prepare GREL expression and execute it
+    normalize cell value to key of lookup
+    """
+    value = getattr(value, "value", value)
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    if value is None or isinstance(value, unicode):
+        return value
+    return unicode(value)
+
+
+# GREL expressions translated to python
+PREPARED_GREL = LRUCache()
+RE_SUBSTRING = re.compile(r"\[\d+,\d+\]")
+
+
+def translate_grel(exp):
+    """
+    translate GREL expression to python function body
 
     :param exp:         expression
     """
     # TODO: regex for expression functions (or/and/not)
-    # TODO: fix control functions (if/with/forEach/...)
-    # TODO: regex for control functions
-    exp = exp.replace("grel:", "", 1).strip()
-    exp = "return " + exp
-
-    grel_context = grel_context or {}
-    grel_context.update(GREL_GLOBAL_CONTEXT)
+    exp_py = compile_controls(exp.replace("grel:", "", 1).strip())
+    exp_py = "return " + exp_py
 
     for func_name in ["and", "or", "not", "type", "if"]:
-        exp = exp.replace("%s(" % func_name, "%s_(" % func_name)
+        exp_py = exp_py.replace("%s(" % func_name, "%s_(" % func_name)
 
-    find_substring_operations = re.findall("\[\d+,\d+\]", exp)
+    find_substring_operations = RE_SUBSTRING.findall(exp_py)
     if find_substring_operations:
         for sub in find_substring_operations:
-            exp = exp.replace(sub, sub.replace(",", ":"), 1)
+            exp_py = exp_py.replace(sub, sub.replace(",", ":"), 1)
+    return exp_py
+
+
+def prepare_grel(exp):
+    """
+    translate GREL expression to python function body once and cache it
+
+    :param exp:         expression
+    """
+    return PREPARED_GREL.get(exp, translate_grel)
+
+
+def eval_grel(exp, grel_context=None):
+    """
+    prepare GREL expression and execute it
 
-    return eval_python(exp, grel_context)
+    :param exp:         expression
+    """
+    context = dict(GREL_GLOBAL_CONTEXT)
+    context.update(grel_context or {})
 
+    return eval_python(prepare_grel(exp), context)
 
-def eval_expression(row, position, exp, context=None, names=None):
+
+def eval_expression(row, position, exp, context=None, names=None, recons=None):
     """
     prepare OR context and execute expression
 
@@ -525,6 +758,7 @@ def eval_expression(row, position, exp, context=None, names=None):
     :param exp:
     :param context:
     :param names:
+    :param recons:      reconciled columns: column name -> table with lookup(row, names) of recon
     :return:
     """
     if names is None:
@@ -537,15 +771,81 @@ def eval_expression(row, position, exp, context=None, names=None):
         raise NotImplementedError("closure context isn't exists")
     else:
         grow = GRELRow(row, names)
+    set_recons(grow, row, names, recons)
     context.update({
         "row": grow,
         "cells": grow.cells,
         "cell": grow.cells[names[position]],
         "value": grow.cells[names[position]].value,
-        "recon": None,
+        "recon": grow.cells[names[position]].recon,
         "record": None
     })
     if exp.startswith("jython:"):
         return eval_python(exp, context)
     else:
         return to_python_object(eval_grel(exp, context))
+
+
+def set_recons(grow, row, names, recons):
+    """
+    set recon of cells of reconciled columns
+    """
+    for name, table in (recons or {}).iteritems():
+        if name in grow.cells:
+            grow.cells[name].recon = table.lookup(row, names)
+
+
+# variables of OR context which are changed for every row
+ROW_VARIABLES = ("cell", "cells", "record", "recon", "row", "value")
+
+
+def eval_expression_batch(rows, position, exp, context=None, names=None, on_error=None, failures=None,
+                          recons=None):
+    """
+    prepare OR context and compile expression once, then execute it for every row of batch
+
+    :param rows:        list of rows
+    :param position:    position of column of 'value' and 'cell' variables
+    :param exp:         expression
+    :param context:     additional variables
+    :param names:       column names
+    :param on_error:    onError mode of failed rows (None: error is raised)
+    :param failures:    collector of failed rows (failure.Failures)
+    :param recons:      reconciled columns: column name -> table with lookup(row, names) of recon
+    :return: list of results
+    """
+    if not rows:
+        return []
+    if names is None:
+        names = [str(i) for i in range(len(rows[0]))]
+
+    jython = exp.startswith("jython:")
+    if exp.startswith("closure:"):
+        raise NotImplementedError("closure context isn't exists")
+
+    global_context = {} if jython else dict(GREL_GLOBAL_CONTEXT)
+    global_context.update(context or {})
+    body = (exp if jython else prepare_grel(exp)).replace("jython:", "", 1).strip()
+    exp_func = compile_python(body, ROW_VARIABLES, global_context)
+
+    row_class = PythonRow if jython else GRELRow
+    column_name = names[position]
+    results = []
+    # results of pure builtins are reused within batch (or partition of pipelined steps)
+    with memo.scope():
+        for row in rows:
+            grow = row_class(row, names)
+            if recons:
+                set_recons(grow, row, names, recons)
+            cell = grow.cells[column_name]
+            try:
+                result = exp_func(row=grow, cells=grow.cells, cell=cell, value=cell.value, recon=cell.recon,
+                                  record=None)
+            except Exception as error:
+                if on_error is None:
+                    raise
+                failures is not None and failures.add(row, error)
+                results.append(fallback(on_error, row[position], error))
+                continue
+            results.append(result if jython else to_python_object(result))
+    return results
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Compilation of GREL control functions
+https://github.com/OpenRefine/OpenRefine/wiki/GREL-Controls
+
+Control functions bind a variable and evaluate an expression lazily, so they can't be called as
+python functions. Their calls (function form `forEach(a, v, e)` and method form `a.forEach(v, e)`)
+are rewritten to python generator expressions and lambdas, which are compiled with the expression:
+    forEach(a, v, e)            -> GRELList((e) for v in grel_items((a)))
+    forEachIndex(a, i, v, e)    -> GRELList((e) for i, v in grel_enumerate((a)))
+    filter(a, v, test)          -> GRELList(v for v in grel_items((a)) if (test))
+    forRange(from, to, step, v, e) -> GRELList((e) for v in grel_range((from), (to), (step)))
+    with(o, v, e)               -> (lambda v: (e))((o))
+    forNonBlank(o, v, e, eBlank) -> (lambda v: (e) if is_non_blank(v) else (eBlank))((o))
+    if(c, t, f)                 -> ((t) if (c) else (f))
+Generator expressions and lambdas have own scope, so variables don't overwrite 'value' etc.
+"""
+
+import cStringIO
+import keyword
+import re
+import tokenize
+
+# name -> (names of arguments including subject, python template)
+CONTROLS = {
+    "forEach": (("a", "v", "e"), "GRELList((%(e)s) for %(v)s in grel_items((%(a)s)))"),
+    "forEachIndex": (("a", "i", "v", "e"),
+                     "GRELList((%(e)s) for %(i)s, %(v)s in grel_enumerate((%(a)s)))"),
+    "filter": (("a", "v", "e"), "GRELList(%(v)s for %(v)s in grel_items((%(a)s)) if (%(e)s))"),
+    "forRange": (("from", "to", "step", "v", "e"),
+                 "GRELList((%(e)s) for %(v)s in grel_range((%(from)s), (%(to)s), (%(step)s)))"),
+    "with": (("o", "v", "e"), "(lambda %(v)s: (%(e)s))((%(o)s))"),
+    "forNonBlank": (("o", "v", "e", "b"), "(lambda %(v)s: (%(e)s) if is_non_blank(%(v)s) else (%(b)s))((%(o)s))"),
+    # only the chosen branch is evaluated
+    "if": (("c", "t", "f"), "((%(t)s) if (%(c)s) else (%(f)s))"),
+}
+# arguments of control functions which are variable names
+VARIABLES = ("v", "i")
+# GREL functions with names of python keywords
+KEYWORD_FUNCTIONS = ("and", "or", "not", "if", "with")
+RE_IDENTIFIER = re.compile(r"^[A-Za-z_]\w*$")
+RE_CONTROL = re.compile(r"\b(?:%s)\s*\(" % "|".join(CONTROLS))
+OPENING = {")": "(", "]": "[", "}": "{"}
+CLOSING = dict((v, k) for k, v in OPENING.items())
+
+
+def get_tokens(exp):
+    """
+    tokenize expression
+
+    :return: list of (type, text, start offset, end offset), None if expression can't be tokenized
+    """
+    offsets = [0]
+    for line in exp.splitlines(True):
+        offsets.append(offsets[-1] + len(line))
+    skipped = (tokenize.NEWLINE, tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT,
+               tokenize.ENDMARKER)
+    tokens = []
+    try:
+        for tok_type, text, start, end, line in tokenize.generate_tokens(cStringIO.StringIO(exp).readline):
+            if tok_type not in skipped:
+                tokens.append((tok_type, text, offsets[start[0] - 1] + start[1], offsets[end[0] - 1] + end[1]))
+    except (tokenize.TokenError, SyntaxError):
+        return None
+    return tokens
+
+
+def match_brackets(tokens):
+    """
+    return map of position of bracket to position of matching bracket (both directions)
+    """
+    matches = {}
+    stack = []
+    for index, (tok_type, text, start, end) in enumerate(tokens):
+        if text in CLOSING and tok_type == tokenize.OP:
+            stack.append(index)
+        elif text in OPENING and tok_type == tokenize.OP:
+            if not stack or tokens[stack[-1]][1] != OPENING[text]:
+                raise SyntaxError("unbalanced '%s' in GREL expression" % text)
+            opening = stack.pop()
+            matches[opening], matches[index] = index, opening
+    if stack:
+        raise SyntaxError("unbalanced '%s' in GREL expression" % tokens[stack[-1]][1])
+    return matches
+
+
+def is_callee(token):
+    return token[0] == tokenize.NAME and (not keyword.iskeyword(token[1]) or token[1] in KEYWORD_FUNCTIONS)
+
+
+def is_operand_end(token):
+    """
+    check that token ends an operand, so following name isn't a call (e.g. python 'if' of rewritten control)
+    """
+    if token[0] == tokenize.NAME:
+        return not keyword.iskeyword(token[1])
+    return token[0] in (tokenize.NUMBER, tokenize.STRING) or (token[0] == tokenize.OP and token[1] in OPENING)
+
+
+def subject_start(tokens, matches, index):
+    """
+    return position of first token of subject of method call, which ends with token at index
+    """
+    while True:
+        tok_type, text, start, end = tokens[index]
+        if text in OPENING and tok_type == tokenize.OP:
+            index = matches[index]
+            # call, item of item or parenthesized expression
+            if index > 0 and (is_callee(tokens[index - 1]) or tokens[index - 1][1] in OPENING):
+                index -= 1
+                continue
+            return index
+        if tok_type in (tokenize.NAME, tokenize.NUMBER, tokenize.STRING):
+            if index > 1 and tokens[index - 1][1] == ".":
+                index -= 2
+                continue
+            return index
+        raise SyntaxError("subject of method call isn't found in GREL expression: '%s'" % text)
+
+
+def split_arguments(exp, tokens, matches, opening):
+    """
+    return text of arguments of call with opening bracket at position
+    """
+    closing = matches[opening]
+    arguments = []
+    start = tokens[opening][3]
+    position = opening + 1
+    while position < closing:
+        if tokens[position][1] in CLOSING and position in matches:
+            position = matches[position]
+        elif tokens[position][1] == ",":
+            arguments.append(exp[start:tokens[position][2]].strip())
+            start = tokens[position][3]
+        position += 1
+    last = exp[start:tokens[closing][2]].strip()
+    if last or arguments:
+        arguments.append(last)
+    return arguments
+
+
+def compile_control(exp, tokens, matches, index):
+    """
+    rewrite call of control function at position
+
+    :return: rewritten expression
+    """
+    name = tokens[index][1]
+    closing = matches[index + 1]
+
+    arguments = split_arguments(exp, tokens, matches, index + 1)
+
+    first = index
+    if index > 1 and tokens[index - 1][1] == ".":
+        first = subject_start(tokens, matches, index - 2)
+        arguments.insert(0, exp[tokens[first][2]:tokens[index - 2][3]])
+
+    names, template = CONTROLS[name]
+    if len(arguments) != len(names):
+        raise SyntaxError("%s() requires %d arguments, %d given" % (name, len(names), len(arguments)))
+    params = dict(zip(names, arguments))
+    for variable in VARIABLES:
+        if variable in params and (not RE_IDENTIFIER.match(params[variable]) or keyword.iskeyword(params[variable])):
+            raise SyntaxError("variable of %s() must be a name: '%s'" % (name, params[variable]))
+    return exp[:tokens[first][2]] + template % params + exp[tokens[closing][3]:]
+
+
+def compile_controls(exp):
+    """
+    rewrite calls of GREL control functions in expression to python generator expressions and lambdas
+
+    :param exp:     GREL expression (without "grel:" prefix)
+    :return: python expression
+    """
+    while RE_CONTROL.search(exp):
+        tokens = get_tokens(exp)
+        if tokens is None:
+            return exp
+        matches = match_brackets(tokens)
+        for index, (tok_type, text, start, end) in enumerate(tokens):
+            if tok_type == tokenize.NAME and text in CONTROLS and index + 1 < len(tokens) and \
+                    tokens[index + 1][1] == "(" and not (index > 0 and is_operand_end(tokens[index - 1])):
+                exp = compile_control(exp, tokens, matches, index)
+                break
+        else:
+            return exp
+    return exp
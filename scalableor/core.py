@@ -2,30 +2,45 @@
 
 # system libs
 import argparse
-import atexit
+import hashlib
 import json
 import sys
 import os
+import tempfile
+import time
 import zipfile
 
-# external libs
-from pyspark import SparkContext, SparkConf
-
 # local imports
+import batch
+import checkpoint
+import cross
+import failure
+import fetch
+import incremental
+import local
 import log
 import method
+import optimizer
+import partition
+import pattern
+import plan
+import recon
+import sample
+import service
+import streaming
 import verify
 
-from constant import NAME
+from constant import ENGINE_LOCAL, ENGINE_SPARK, NAME
 from manager import VerifiersManager, MethodsManager
 
 CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+EXPRESSION_COMMANDS = ["core/column-addition", "core/text-transform", "core/column-addition-by-fetching-urls"]
 PROJECT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
 
 
 class ScalableOR(object):
     sc = None
-    zippath = os.path.abspath(os.path.join(CURRENT_DIR, "../scalable.zip"))
+    zippath = None
 
     def get_jars(self, from_path="vendor/jar"):
         """
@@ -49,6 +64,8 @@ class ScalableOR(object):
 
         :param args:    parsed command line arguments
         """
+        from pyspark import SparkContext, SparkConf
+
         if args.in_proc:
             master = "local"
         else:
@@ -57,88 +74,316 @@ class ScalableOR(object):
         if "SPARK_HOME" not in os.environ:
             os.environ["SPARK_HOME"] = args.spark_home
 
+        # concurrently submitted jobs share the cluster fairly in service mode
+        concurrent = args.serve or args.batch or args.input_glob
+        scheduler_mode = args.scheduler_mode or ("FAIR" if concurrent else "FIFO")
+        conf = SparkConf().set("spark.scheduler.mode", scheduler_mode)
+
         os.environ["PYSPARK_SUBMIT_ARGS"] = "--jars %s pyspark-shell" % ",".join(self.get_jars())
-        ScalableOR.sc = SparkContext(master=master, appName=NAME)
+        ScalableOR.sc = SparkContext(master=master, appName=NAME, conf=conf)
         map(ScalableOR.sc.addPyFile, self.get_pythons())
         log.set_logger(ScalableOR.sc, args.verbose)
 
+    def start_spark(self):
+        """
+        build code bundle and create spark context (once per process)
+        """
+        if ScalableOR.sc is None:
+            # zip file of current project (required for distributed execution)
+            ScalableOR.zippath = self.build_bundle(os.path.join(PROJECT_DIR, "scalableor"))
+            self.initialize_spark(self.args)
+
     def __init__(self, argv=None):
-        atexit.register(self.on_exit)
         self.args = args = self.get_args(argv)
-
-        # create zip file of current project (required for distributed execution)
-        if not os.path.exists(ScalableOR.zippath):
-            self.zipdir(os.path.join(PROJECT_DIR, "scalableor"))
-
-        # create spark context instance
-        if ScalableOR.sc is None:
-            self.initialize_spark(args)
+        log.set_python_logger(args.verbose)
+        local.PROCESSES = args.local_processes
+
+        # projects of GREL cross()
+        cross.BROADCAST_SIZE = args.cross_broadcast_size
+        if args.recon_cache:
+            recon.CACHE_PATH = args.recon_cache
+        if args.fetch_cache:
+            fetch.CACHE_PATH = args.fetch_cache
+        fetch.HOST_CONNECTIONS = args.fetch_connections
+        for project in args.project or []:
+            if "=" not in project:
+                raise ValueError("project '%s' must be given as NAME=PATH." % project)
+            name, path = project.split("=", 1)
+            cross.register_project(name, path)
+
+        # keep spark context alive and accept jobs over HTTP
+        if args.serve:
+            self.start_spark()
+            service.serve(self, args.host, args.port, args.max_jobs)
+            return
+
+        # run many programs/inputs in this spark application
+        if args.batch or args.input_glob:
+            self.start_spark()
+            if batch.run(self, args) is False:
+                sys.exit(1)
+            return
+
+        # refine files landing in input directory continuously
+        if args.stream:
+            self.start_spark()
+            streaming.run(self, args)
+            return
 
         # validate required parameters
-        if None in [args.input, args.output, args.or_program]:
+        if args.or_program is None or (not (args.verify_only or args.plan) and None in [args.input, args.output]):
             raise ValueError("please define all required parameters.")
 
-        # validate path parameters
-        i_path = os.path.abspath(args.input)
-        o_path = os.path.abspath(args.output)
         op_path = os.path.abspath(args.or_program)
+        if not os.path.exists(op_path):
+            raise ValueError("path '%s' doesn't exist." % op_path)
+
+        log.logger.debug("parser args: %s" % args)
+        log.logger.info("or-program path: %s" % op_path)
+
+        # verify or-program without spark context
+        if args.verify_only or args.plan:
+            or_program = json.load(open(op_path, "r"))
+            if args.input and (args.output or args.plan):
+                # program is planned without export, if output isn't given
+                or_program = self.add_io_commands(os.path.abspath(args.input),
+                                                  os.path.abspath(args.output) if args.output else None, or_program)
+            if self.verify(or_program) is False:
+                log.logger.error("verifying is failed")
+                sys.exit(1)
+            log.logger.info("verifying is passed")
+            if args.plan and self.check_plan(or_program, sys.stdout.write) is False:
+                sys.exit(1)
+            return
+
+        # refine only data appended to input since last run
+        if args.incremental:
+            incremental.run(self, os.path.abspath(args.input), os.path.abspath(args.output),
+                            json.load(open(op_path, "r")), args.state)
+            return
+
+        # read or-program
+        or_program = self.prepare(args.input, args.output, json.load(open(op_path, "r")))
+        engine = self.choose_engine(args.input)
+
+        # verify or-program
+        if self.verify(or_program, engine) is False:
+            log.logger.error("verifying is failed")
+            sys.exit(1)
+
+        # reject expensive programs before spark is started
+        if args.max_passes is not None or args.max_shuffles is not None:
+            if self.check_plan(or_program, log.logger.info) is False:
+                sys.exit(1)
+
+        # checkpoints of long programs (spark engine)
+        checkpoints = None
+        marked = any(cmd.get("checkpoint") is True for cmd in or_program)
+        if engine == ENGINE_SPARK and (args.checkpoint_every or marked or args.resume):
+            checkpoints = checkpoint.Checkpoints(args.checkpoint_dir or os.path.abspath(args.output) + ".checkpoints",
+                                                 or_program, args.checkpoint_every, args.resume)
+
+        if engine == ENGINE_SPARK:
+            self.start_spark()
+        error_output = args.error_output or os.path.abspath(args.output) + ".errors.json"
+        if args.sample:
+            # every step is measured on the sample, the first failing step stops the run
+            try:
+                with local.pool_scope():
+                    metrics = self.refine(or_program, engine, error_output=error_output, sampled=True)
+            except Exception as e:
+                log.logger.error("sample run failed: %s" % e)
+                sys.exit(1)
+            fraction = [cmd for cmd in or_program if cmd["op"] == "scalableor/sample"][0]["fraction"]
+            sys.stdout.write(sample.format_report(metrics, fraction))
+            return
+        with local.pool_scope():
+            self.refine(or_program, engine, checkpoints=checkpoints, error_output=error_output)
+        if checkpoints is not None:
+            checkpoints.clear(ScalableOR.sc)
+
+    def choose_engine(self, input_path):
+        """
+        choose execution engine, small inputs are refined locally without spark
+
+        :param input_path:      path to input file
+        :return: name of engine
+        """
+        engine = self.args.engine
+        if engine == "auto":
+            size = partition.input_size(os.path.abspath(input_path))
+            engine = ENGINE_LOCAL if size < self.args.local_max_size * 1024 * 1024 else ENGINE_SPARK
+        log.logger.info("engine: %s" % engine)
+        return engine
+
+    def prepare(self, input_path, output_path, or_program):
+        """
+        validate input/output paths and add import/export commands to OpenRefine program
 
-        for p in [i_path, op_path, os.path.dirname(o_path)]:
+        :param input_path:      path to input file
+        :param output_path:     path to output file
+        :param or_program:      sequence of OpenRefine commands
+        :return: completed sequence of OpenRefine commands
+        """
+        # validate path parameters
+        i_path = os.path.abspath(input_path)
+        o_path = os.path.abspath(output_path)
+
+        for p in [i_path, os.path.dirname(o_path)]:
             if not os.path.exists(p):
                 raise ValueError("path '%s' doesn't exist." % p)
 
         if os.path.exists(o_path):
-            log.logger.info("output file already exists. Remove it (%s)" % i_path)
+            log.logger.info("output file already exists. Remove it (%s)" % o_path)
             os.remove(o_path)
 
-        log.logger.debug("parser args: %s" % args)
         log.logger.info("input path: %s" % i_path)
         log.logger.info("output path: %s" % o_path)
-        log.logger.info("or-program path: %s" % op_path)
 
-        # read or-program
-        or_program = json.load(open(op_path, "r"))
+        return self.add_io_commands(i_path, o_path, or_program)
 
-        # import file
-        if args.add_import_command:
-            or_program.insert(0, {"op": "scalableor/import", "separator": ",", "path": i_path})
+    def add_io_commands(self, i_path, o_path, or_program):
+        """
+        add import/export commands to OpenRefine program
 
-        # export file
-        if args.add_export_command:
-            or_program.append({"op": "scalableor/export", "separator": ",", "path": o_path})
+        :param i_path:          absolute path to input file
+        :param o_path:          absolute path to output file (None: export command isn't added)
+        :param or_program:      sequence of OpenRefine commands
+        :return: completed sequence of OpenRefine commands
+        """
+        or_program = list(or_program)
 
-        # verify or-program
-        if self.verify(or_program) is False:
-            log.logger.error("verifying is failed")
-            sys.exit(1)
+        # options of python expression steps (partitioning, execution mode)
+        options = {"repartition": self.args.expression_partitions, "execution": self.args.execution}
+        for index, cmd in enumerate(or_program):
+            if cmd["op"] in EXPRESSION_COMMANDS:
+                or_program[index] = dict((k, v) for k, v in options.items() if v is not None)
+                or_program[index].update(cmd)
 
-        self.refine(or_program)
+        # import file
+        if self.args.add_import_command:
+            or_program.insert(0, {"op": "scalableor/import", "separator": ",", "path": i_path,
+                                  "partitions": self.args.partitions,
+                                  "targetPartitionSize": self.args.target_partition_size,
+                                  "guessCellType": self.args.guess_cell_type})
+
+        # seeded sample of imported rows
+        if self.args.sample:
+            or_program.insert(1 if self.args.add_import_command else 0,
+                              {"op": "scalableor/sample", "fraction": sample.sample_fraction(self.args.sample, i_path),
+                               "seed": self.args.sample_seed})
+
+        # export file
+        if self.args.add_export_command and o_path is not None:
+            export = {"op": "scalableor/export", "separator": ",", "path": o_path,
+                      "coalesce": self.args.export_partitions}
+            if self.args.guess_cell_type:
+                # blank cells of typed columns are written back as blank
+                export["nullValue"] = ""
+            or_program.append(export)
+
+        # rewrite program with the same result (renames, dead steps, row removals ahead of expressions)
+        if self.args.optimize:
+            or_program = optimizer.optimize(or_program)
+        return or_program
+
+    def run_job(self, input_path, output_path, or_program, pool=None):
+        """
+        prepare, verify and execute OpenRefine program in spark scheduler pool
 
-    def on_exit(self):
+        :param input_path:      path to input file
+        :param output_path:     path to output file
+        :param or_program:      sequence of OpenRefine commands
+        :param pool:            name of spark scheduler pool
+        :return: list of step metrics
         """
-        exit handler
+        or_program = self.prepare(input_path, output_path, or_program)
+        engine = self.choose_engine(input_path)
+        if self.verify(or_program, engine) is False:
+            raise ValueError("verifying is failed")
+
+        error_output = os.path.abspath(output_path) + ".errors.json"
+        if engine == ENGINE_LOCAL:
+            with local.pool_scope():
+                return self.refine(or_program, engine, error_output=error_output)
+
+        self.start_spark()
+        ScalableOR.sc.setLocalProperty("spark.scheduler.pool", pool)
+        try:
+            return self.refine(or_program, error_output=error_output)
+        finally:
+            ScalableOR.sc.setLocalProperty("spark.scheduler.pool", None)
+
+    def check_plan(self, or_program, output):
         """
-        if os.path.exists(ScalableOR.zippath):
-            log.logger.info("clear: remove '%s'" % ScalableOR.zippath)
-            os.remove(ScalableOR.zippath)
+        plan OpenRefine program and check it against cost limits
 
-    def zipdir(self, path):
+        :param or_program:      sequence of OpenRefine commands
+        :param output:          writer of formatted plan
+        :return: False if plan has errors or exceeds limits
         """
-        create zip archive
+        program_plan = plan.build_plan(or_program)
+        output(program_plan.format().encode("utf-8") + "\n")
+
+        rejected = list(program_plan.errors)
+        if self.args.max_passes is not None and program_plan.passes > self.args.max_passes:
+            rejected.append("estimated passes over data %d exceed limit %d" % (
+                program_plan.passes, self.args.max_passes))
+        if self.args.max_shuffles is not None and program_plan.shuffles > self.args.max_shuffles:
+            rejected.append("estimated shuffles %d exceed limit %d" % (
+                program_plan.shuffles, self.args.max_shuffles))
+
+        if rejected:
+            log.logger.error("Plan error report:")
+            log.logger.error("\n".join(rejected))
+            return False
+        return True
 
-        :param path: source directory
+    def build_bundle(self, path):
         """
-        zipf = zipfile.ZipFile(ScalableOR.zippath, "w", zipfile.ZIP_DEFLATED)
+        build zip archive of python code once. The archive is named by hash of its content,
+        so it is reused across runs and written atomically by parallel processes.
 
+        :param path: source directory
+        :return: path to zip archive
+        """
         basepath_len = len(os.path.dirname(path))
-        for root, dirs, files in os.walk(path):
-            for f in files:
+        files = []
+        for root, dirs, fnames in os.walk(path):
+            for f in fnames:
                 if f.endswith(".py"):
-                    fpath = os.path.join(root, f)
-                    zipf.write(fpath, fpath[basepath_len:])
-
+                    files.append(os.path.join(root, f))
+        files.sort()
+
+        digest = hashlib.sha1()
+        for fpath in files:
+            digest.update(fpath[basepath_len:])
+            digest.update(open(fpath, "rb").read())
+
+        bundle_dir = self.args.bundle_dir
+        zippath = os.path.join(bundle_dir, "scalableor-%s.zip" % digest.hexdigest()[:16])
+        if os.path.exists(zippath):
+            log.logger.debug("reuse code bundle '%s'" % zippath)
+            return zippath
+
+        try:
+            os.makedirs(bundle_dir)
+        except OSError:
+            if not os.path.isdir(bundle_dir):
+                raise
+
+        fd, tmp_path = tempfile.mkstemp(suffix=".zip.tmp", dir=bundle_dir)
+        os.close(fd)
+        zipf = zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED)
+        for fpath in files:
+            zipf.write(fpath, fpath[basepath_len:])
         zipf.close()
 
+        # rename is atomic, a concurrently built bundle has the same content
+        os.rename(tmp_path, zippath)
+        log.logger.info("build code bundle '%s'" % zippath)
+        return zippath
+
     def get_args(self, argv=None):
         """
         parse command line parameters
@@ -179,16 +424,166 @@ class ScalableOR(object):
                             help="include python libraries to Spark Context "
                                  "(comma separated list; supported .py,.zip,.egg)", )
 
+        parser.add_argument("--verify-only", action="store_true", default=False,
+                            help="verify OR program without spark context (default: %(default)s)")
+
+        parser.add_argument("--plan", action="store_true", default=False,
+                            help="print execution plan and cost estimate without spark context "
+                                 "(reads only first line of input) (default: %(default)s)")
+
+        parser.add_argument("--optimize", action="store_true", default=False,
+                            help="rewrite OR program before run: collapse renames and moves, remove no-op and dead "
+                                 "steps, move row removals ahead of expression steps (default: %(default)s)")
+
+        parser.add_argument("--sample", type=str, default=None, metavar="FRACTION|N",
+                            help="run program on seeded sample of input (fraction of rows or row count), report "
+                                 "per-step times and row counts with estimates of full run, stop at first error")
+
+        parser.add_argument("--sample-seed", type=int, default=sample.SEED,
+                            help="set seed of --sample (default: %(default)s)")
+
+        parser.add_argument("--max-passes", type=int, default=None,
+                            help="reject program with more estimated passes over data (default: %(default)s)")
+
+        parser.add_argument("--max-shuffles", type=int, default=None,
+                            help="reject program with more estimated shuffles (default: %(default)s)")
+
+        parser.add_argument("--bundle-dir", type=str,
+                            default=os.environ.get("SCALABLEOR_BUNDLE_DIR",
+                                                   os.path.join(os.path.expanduser("~"), ".cache", "scalableor")),
+                            help="set directory of cached code bundles (default: %(default)s)")
+
+        parser.add_argument("--partitions", type=int, default=None,
+                            help="set partition count of input (default: chosen by input size and cluster cores)")
+
+        parser.add_argument("--target-partition-size", type=int, default=partition.TARGET_PARTITION_SIZE,
+                            help="set target size of input partition in MB (default: %(default)s)")
+
+        parser.add_argument("--guess-cell-type", action="store_true", default=False,
+                            help="store numbers, booleans and dates of input as typed values, blank cells of "
+                                 "typed columns as null (one additional pass over input)")
+
+        parser.add_argument("--error-output", type=str, default=None,
+                            help="set path to sample of rows failed in steps with onError mode "
+                                 "(default: output path + .errors.json)")
+
+        parser.add_argument("--expression-partitions", type=int, default=None,
+                            help="set minimal partition count of python expression steps "
+                                 "(default: cluster cores)")
+
+        parser.add_argument("--execution", choices=["batch", "arrow", "row"], default="batch",
+                            help="set execution mode of python expression steps: batches of rows, "
+                                 "Arrow record batches (spark >= 2.3) or single rows (default: %(default)s)")
+
+        parser.add_argument("--export-partitions", type=int, default=None,
+                            help="coalesce data to partition count before export "
+                                 "(default: cluster cores, if there are many more partitions)")
+
+        parser.add_argument("--project", action="append", default=None, metavar="NAME=PATH",
+                            help="register project (CSV with header row or .parquet) for GREL cross() "
+                                 "(repeatable)")
+
+        parser.add_argument("--cross-broadcast-size", type=int, default=cross.BROADCAST_SIZE,
+                            help="set maximal size in MB of project joined by broadcast hash map for cross(), "
+                                 "larger projects are joined by shuffle (default: %(default)s)")
+
+        parser.add_argument("--recon-cache", type=str, default=None,
+                            help="set path to persistent cache of reconciliation results "
+                                 "(default: ~/.cache/scalableor/recon.db)")
+
+        parser.add_argument("--fetch-cache", type=str, default=None,
+                            help="set path to persistent cache of responses of URL fetching "
+                                 "(default: ~/.cache/scalableor/fetch.db)")
+
+        parser.add_argument("--fetch-connections", type=int, default=fetch.HOST_CONNECTIONS,
+                            help="set maximal count of concurrent connections per host of URL fetching "
+                                 "(default: %(default)s)")
+
+        parser.add_argument("--checkpoint-every", type=int, default=None,
+                            help="checkpoint data after every N steps; steps marked with \"checkpoint\": true "
+                                 "are always checkpointed (default: %(default)s)")
+
+        parser.add_argument("--checkpoint-dir", type=str, default=None,
+                            help="set directory of checkpoints (default: output path + .checkpoints)")
+
+        parser.add_argument("--resume", action="store_true", default=False,
+                            help="continue after last completed checkpoint of the same program and input "
+                                 "(default: %(default)s)")
+
+        parser.add_argument("--incremental", action="store_true", default=False,
+                            help="refine only data appended to input since last run, if all steps are row-local "
+                                 "(default: %(default)s)")
+
+        parser.add_argument("--state", type=str, default=None,
+                            help="set path to state file of incremental mode (default: output path + .state.json)")
+
+        parser.add_argument("--engine", choices=["auto", ENGINE_LOCAL, ENGINE_SPARK], default="auto",
+                            help="set execution engine; auto refines inputs smaller than --local-max-size "
+                                 "locally without spark (default: %(default)s)")
+
+        parser.add_argument("--local-max-size", type=int, default=2048,
+                            help="set maximal input size in MB of local engine in auto mode (default: %(default)s)")
+
+        parser.add_argument("--local-processes", type=int, default=None,
+                            help="set process count of local engine (default: cpu count)")
+
+        parser.add_argument("--scheduler-mode", choices=["FIFO", "FAIR"], default=None,
+                            help="set spark scheduler mode (default: FAIR in service mode, otherwise FIFO)")
+
+        parser.add_argument("--serve", action="store_true", default=False,
+                            help="start a long-running service with a warm spark context (default: %(default)s)")
+
+        parser.add_argument("--host", default="127.0.0.1", type=str,
+                            help="set service host (default: %(default)s)")
+
+        parser.add_argument("--port", default=8090, type=int,
+                            help="set service port (default: %(default)s)")
+
+        parser.add_argument("--max-jobs", default=4, type=int,
+                            help="set number of concurrently running service/batch jobs (default: %(default)s)")
+
+        parser.add_argument("--batch", default=None, type=str,
+                            help="set path to batch manifest (JSON list or CSV of input,or_program,output)")
+
+        parser.add_argument("--input-glob", default=None, type=str,
+                            help="apply OR program to every input matching glob (requires --or-program, --output-dir)")
+
+        parser.add_argument("--output-dir", default=None, type=str,
+                            help="set output directory for --input-glob (default: %(default)s)")
+
+        parser.add_argument("--report", default=None, type=str,
+                            help="set path to combined batch/stream result report (default: %(default)s)")
+
+        parser.add_argument("--stream", action="store_true", default=False,
+                            help="refine files landing in input directory (-i) continuously and write them "
+                                 "to --output-dir (spark >= 2.4) (default: %(default)s)")
+
+        parser.add_argument("--stream-checkpoint", default=None, type=str,
+                            help="set checkpoint location of stream (default: <output-dir>/_checkpoint)")
+
+        parser.add_argument("--trigger-interval", default=0, type=int,
+                            help="set micro-batch interval in seconds (default: %(default)s)")
+
+        parser.add_argument("--max-files-per-trigger", default=None, type=int,
+                            help="set maximal count of new files per micro-batch (default: all)")
+
+        parser.add_argument("--stream-once", action="store_true", default=False,
+                            help="refine available files in one micro-batch and stop (default: %(default)s)")
+
+        parser.add_argument("--stream-timeout", default=None, type=int,
+                            help="stop stream after seconds (default: run until interrupted)")
+
         args = parser.parse_args(args=argv)
 
         return args
 
     @staticmethod
-    def verify(or_program):
+    def verify(or_program, engine=ENGINE_SPARK):
         """
         verify OpenRefine program
 
         :param or_program:      sequence of OpenRefine commands
+        :param engine:          name of execution engine
         :return: validation     status
         """
         error_all = []
@@ -202,8 +597,8 @@ class ScalableOR(object):
             else:
                 log.logger.warn("Verify method '%s' doesn't exists" % name)
 
-            if not MethodsManager.has(name):
-                error_all.append("Method '%s' doesn't exists" % name)
+            if not MethodsManager.has(name, engine=engine):
+                error_all.append("Method '%s' doesn't exists (engine: %s)" % (name, engine))
 
         if not error_all:
             if not len(or_program):
@@ -217,19 +612,76 @@ class ScalableOR(object):
         return True
 
     @staticmethod
-    def refine(or_program):
+    def refine(or_program, engine=ENGINE_SPARK, df=None, checkpoints=None, error_output=None, sampled=False):
         """
         execute OpenRefine program
 
         :param or_program:      sequence of OpenRefine commands
+        :param engine:          name of execution engine
+        :param df:              initial data (e.g. micro-batch of stream), by default imported by program
+        :param checkpoints:     checkpoints of program (spark engine)
+        :param error_output:    path to sample of rows failed in steps with onError mode
+        :param sampled:         program runs on sample: every step is materialized and its rows are counted
+        :return: list of step metrics
         """
-        df = None
-        samples = []
-        for cmd in or_program:
-            name = cmd["op"]
-            log.logger.info("Call '%s': cmd='%s'" % (name, cmd))
-            df = MethodsManager.call(cmd, df=df, sc=ScalableOR.sc)
-            df and samples.append(df.head(10))
+        start = 0
+        recon.reset()
+        pattern.reset()
+        try:
+            if checkpoints is not None and checkpoints.resume:
+                start, resumed = checkpoints.load(ScalableOR.sc)
+                if resumed is not None:
+                    df = resumed
+
+            samples = []
+            metrics = []
+            # partitioning of initial (or resumed) data is unknown
+            planned = None
+            for index, cmd in enumerate(or_program[start:], start):
+                name = cmd["op"]
+                log.logger.info("Call '%s': cmd='%s'" % (name, cmd))
+                started = time.time()
+                regex_before = pattern.metrics()
+                if engine == ENGINE_SPARK:
+                    df = partition.before_step(cmd, df, ScalableOR.sc, planned)
+                    planned = partition.plan_step(cmd, df)
+                previous, rows = df, None
+                try:
+                    df = MethodsManager.call(cmd, df=df, sc=ScalableOR.sc, engine=engine)
+                    # whole input isn't read, sample is taken after import
+                    if sampled and name != "scalableor/import":
+                        df, rows = sample.materialize(df, engine, previous)
+                except Exception:
+                    if sampled:
+                        log.logger.error("step %d '%s' failed on sample" % (index + 1, name))
+                    raise
+                if checkpoints is not None and df is not None and checkpoints.is_due(index, cmd):
+                    df = checkpoints.save(index, df)
+                    planned = None
+                    # data before checkpoint isn't read again
+                    partition.release()
+                df and samples.append(df.head(10))
+                # regex cache counters of spark tasks are attributed to step whose action executed them
+                metrics.append({"op": name, "seconds": time.time() - started,
+                                "regex_cache": pattern.diff(pattern.metrics(), regex_before), "failures": 0})
+                if sampled:
+                    metrics[-1]["rows"] = rows
+
+            # failures of spark tasks are known after the action (export)
+            failures = failure.collect(or_program)
+            for index, failed in sorted(failures.items()):
+                if index >= start and failed.count:
+                    metrics[index - start]["failures"] = failed.count
+                    log.logger.warn("step %d '%s': %d rows failed (onError: %s)" % (
+                        index + 1, or_program[index]["op"], failed.count, or_program[index]["onError"]))
+            if error_output:
+                failure.write_report(error_output, or_program, failures)
+            return metrics
+        finally:
+            # regex counters, failure collectors and persisted data of job (also of failed job) aren't kept
+            pattern.reset()
+            failure.collect(or_program)
+            partition.release()
 
 
 main = run = ScalableOR
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+GREL cross() against registered projects
+
+Secondary projects (CSV with header row or parquet) are registered by name. Expressions using
+`cell.cross("project", "column")` are rewritten to a call of a lookup function and the lookup data
+is joined to the rows instead of being searched per row:
+    - small project:    hash map of project is broadcast to executors (broadcast hash join), size of
+                        profiled project is taken from its profile report
+    - large project:    rows are joined with grouped project rows by key (shuffle join), original
+                        order of rows is restored by row index
+"""
+
+import csv
+import os
+import re
+
+import log
+
+from scalableor import failure, recon
+from scalableor.broadcast import log_closure, share
+from scalableor.context import GRELList, GRELRow, key_of
+from scalableor.facet import get_facet_filter
+from scalableor.partition import input_size
+from scalableor.plan import RE_CELLS_ATTR, RE_CELLS_ITEM
+from scalableor.profiling import profiled_size
+from scalableor.vectorized import evaluate_partitions, evaluate_rows, iter_batches
+
+# registered projects: name -> path
+PROJECTS = {}
+# maximal size of project in MB joined as broadcast hash map
+BROADCAST_SIZE = 64
+
+# X.cross("project", "column") and cross(X, "project", "column")
+RE_CROSS_METHOD = re.compile(r"""((?:cells\s*\[\s*["'][^"']+["']\s*\]|cells\.\w+|\w+)(?:\.value)?)\.cross\(""")
+RE_CROSS = re.compile(r"""\bcross\(\s*((?:cells\s*\[\s*["'][^"']+["']\s*\]|cells\.\w+|\w+)(?:\.value)?)\s*,"""
+                      r"""\s*["'](.+?)["']\s*,\s*["'](.+?)["']\s*\)""")
+
+
+def register_project(name, path):
+    """
+    register project for cross()
+
+    :param name:    project name
+    :param path:    path to CSV file with header row or parquet
+    """
+    PROJECTS[name] = os.path.abspath(path)
+
+
+def project_size(project):
+    """
+    return size of registered project in bytes: size of data in profile report of project
+    (<path>.profile.json written by scalableor/profile), otherwise estimated size of its file
+    """
+    size = profiled_size(PROJECTS[project])
+    return input_size(PROJECTS[project]) if size is None else size
+
+
+def is_broadcast(projects):
+    """
+    return True if all projects are joined as broadcast hash maps
+    """
+    return all(p in PROJECTS and project_size(p) < BROADCAST_SIZE * 1024 * 1024 for p in projects)
+
+
+def uses_cross(exp):
+    return "cross(" in exp
+
+
+def parse_cross(exp, base_column):
+    """
+    rewrite calls of cross() to function form with index of lookup and return used lookups
+    (lookups of the same project column by different key columns have own tables)
+
+    :param exp:             GREL expression
+    :param base_column:     column of 'value' and 'cell' variables
+    :return: tuple of rewritten expression and list of (project, project column, key column)
+    """
+    exp = RE_CROSS_METHOD.sub(lambda m: "cross(%s, " % m.group(1), exp)
+    lookups = []
+
+    def add_lookup(found):
+        subject, project, column = found.groups()
+        subject = re.sub(r"\.value$", "", subject)
+        if subject in ("cell", "value"):
+            key_column = base_column
+        else:
+            names = RE_CELLS_ITEM.findall(subject) + RE_CELLS_ATTR.findall(subject)
+            if not names:
+                raise NotImplementedError("key of cross() must be a cell of current row: '%s'" % subject)
+            key_column = names[0]
+        if (project, column, key_column) not in lookups:
+            lookups.append((project, column, key_column))
+        return "%s, %d)" % (found.group(0)[:-1].rstrip(), lookups.index((project, column, key_column)))
+
+    return RE_CROSS.sub(add_lookup, exp), lookups
+
+
+def join_shuffles(exp):
+    """
+    return estimated count of shuffles of cross() lookups in expression
+    """
+    if not uses_cross(exp):
+        return 0
+    lookups = parse_cross(exp, None)[1]
+    if is_broadcast([p for p, c, k in lookups]):
+        return 0
+    # group of project and join per lookup, sort of rows to restore order
+    return 2 * len(lookups) + 1
+
+
+def make_cross(tables):
+    """
+    create cross() function of expression context (calls are rewritten by parse_cross)
+
+    :param tables:  list of lookup tables in order of lookups of expression:
+                    ((project, column, key column), column names of project, dict key -> list of rows)
+    """
+
+    def cross(cell, project, column, index=None):
+        if index is None or index >= len(tables) or tables[index][0][:2] != (project, column):
+            raise ValueError("project '%s' with column '%s' isn't joined" % (project, column))
+        lookup, names, rows_by_key = tables[index]
+        return GRELList([GRELRow(row, names) for row in rows_by_key.get(key_of(cell), [])])
+
+    return cross
+
+
+def batch_tables(batch, specs):
+    """
+    create lookup tables of batch of shuffle join from matches joined to rows
+
+    :param batch:   list of (index, row, matches of every lookup)
+    :param specs:   list of (lookup, column names of project, position of key column) in order of lookups
+    :return: lookup tables (see make_cross)
+    """
+    return [(lookup, columns, dict((key_of(e[1][key_pos]), e[2][index]) for e in batch))
+            for index, (lookup, columns, key_pos) in enumerate(specs)]
+
+
+def group_rows(rows, position):
+    """
+    group rows by key of column
+    """
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(key_of(row[position]), []).append(tuple(row))
+    return grouped
+
+
+def check_project(project):
+    if project not in PROJECTS:
+        raise ValueError("project '%s' of cross() isn't registered (--project %s=PATH)" % (project, project))
+    return PROJECTS[project]
+
+
+def load_project(project, sql_context):
+    """
+    load registered project as spark data frame
+    """
+    path = check_project(project)
+    if path.endswith(".parquet"):
+        return sql_context.read.parquet(path)
+    return sql_context.read.format("com.databricks.spark.csv").option("header", "true").load(path)
+
+
+def read_project(project):
+    """
+    read registered CSV project in local process
+
+    :return: tuple of column names and list of rows
+    """
+    path = check_project(project)
+    if path.endswith(".parquet"):
+        raise NotImplementedError("parquet projects of cross() require spark engine")
+    with open(path, "rb") as f:
+        rows = [tuple(v.decode("utf-8") for v in row) for row in csv.reader(f)]
+    return list(rows[0]), rows[1:]
+
+
+def local_tables(cmd, base_column):
+    """
+    rewrite expression of command and read lookup tables of cross() in local engine
+
+    :return: tuple of command with rewritten expression and lookup tables (see make_cross)
+    """
+    exp, lookups = parse_cross(cmd["expression"], base_column)
+    grouped = {}
+    for project, column, key_column in lookups:
+        if (project, column) not in grouped:
+            names, rows = read_project(project)
+            grouped[(project, column)] = (names, group_rows(rows, names.index(column)))
+    return dict(cmd, expression=exp), [(lookup,) + grouped[lookup[:2]] for lookup in lookups]
+
+
+def evaluate(cmd, df, position, build, otherwise, sc):
+    """
+    evaluate expression using cross() as join of rows with registered projects
+
+    :param cmd:         OpenRefine command
+    :param df:          spark data frame
+    :param position:    position of base column
+    :param build:       callback (row, value) returning new row
+    :param otherwise:   callback returning value of row not selected by facets
+    :param sc:          spark context
+    :return: rdd of new rows
+    """
+    names = df.columns[:]
+    on_error = cmd.get("onError")
+    # failures are collected by original command of program
+    tracker = failure.tracker(cmd, sc)
+    exp, lookups = parse_cross(cmd["expression"], names[position])
+    cmd = dict(cmd, expression=exp)
+    projects = [(p, c, k, load_project(p, df.sql_ctx)) for p, c, k in lookups]
+
+    if is_broadcast([p for p, c, k, o in projects]):
+        grouped = {}
+        for project, column, key_column, other in projects:
+            if (project, column) not in grouped:
+                log.logger.info("cross: broadcast hash join of project '%s' on '%s'" % (project, column))
+                rows = other.rdd.map(tuple).collect()
+                grouped[(project, column)] = (other.columns, group_rows(rows, other.columns.index(column)))
+        shared = share([(lookup,) + grouped[lookup[:2]] for lookup in lookups], sc)
+        return evaluate_partitions(cmd, df, position, build, otherwise, sc,
+                                   context=lambda: {"cross": make_cross(shared())}, tracker=tracker)
+
+    # rows are (index, row, matches of every lookup)
+    rdd = df.rdd.zipWithIndex().map(lambda e: (e[1], tuple(e[0]), ()))
+    for project, column, key_column, other in projects:
+        log.logger.info("cross: shuffle join of project '%s' on '%s'" % (project, column))
+        key_pos = names.index(key_column)
+        other_pos = other.columns.index(column)
+        grouped = other.rdd.map(lambda r, p=other_pos: (key_of(r[p]), tuple(r))).groupByKey().mapValues(list)
+        rdd = (rdd.map(lambda e, p=key_pos: (key_of(e[1][p]), e))
+               .leftOuterJoin(grouped)
+               .map(lambda kv: (kv[1][0][0], kv[1][0][1], kv[1][0][2] + (kv[1][1] or [],))))
+    rdd = rdd.sortBy(lambda e: e[0], numPartitions=df.rdd.getNumPartitions())
+
+    specs = [((p, c, k), o.columns, names.index(k)) for p, c, k, o in projects]
+    facet_filter = get_facet_filter(cmd, df, sc)
+    shared_recons = share(recon.get_tables(), sc)
+
+    def evaluate_partition(split, entries):
+        failures = failure.Failures()
+        for batch in iter_batches(entries):
+            rows = [e[1] for e in batch]
+            values = evaluate_rows(rows, position, exp, names, facet_filter, otherwise,
+                                   context={"cross": make_cross(batch_tables(batch, specs))}, on_error=on_error,
+                                   failures=failures, recons=shared_recons())
+            for row, value in zip(rows, values):
+                yield build(row, value)
+        failure.track(tracker, split, failures)
+
+    return rdd.mapPartitionsWithIndex(log_closure(cmd, evaluate_partition))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent local cache of results of remote services (sqlite file shared by local processes)
+"""
+
+import json
+import os
+import sqlite3
+
+TIMEOUT = 60
+
+
+class DiskCache(object):
+    """
+    this class implements persistent key-value cache of JSON values
+    """
+
+    def __init__(self, path, table):
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # created by parallel process
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        self.table = table
+        self.connection = sqlite3.connect(path, timeout=TIMEOUT)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT)" % table)
+
+    def get_many(self, keys):
+        """
+        :return: dict key -> cached value
+        """
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            part = keys[start:start + 500]
+            cursor = self.connection.execute("SELECT key, value FROM %s WHERE key IN (%s)" %
+                                             (self.table, ",".join("?" * len(part))), part)
+            found.update((key, json.loads(value)) for key, value in cursor)
+        return found
+
+    def put_many(self, values):
+        """
+        :param values:      dict key -> value
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)" % self.table,
+                                        [(key, json.dumps(value)) for key, value in values.iteritems()])
+
+    def close(self):
+        self.connection.close()
@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 import re
 
+from scalableor import pattern
+from scalableor.broadcast import share
+from scalableor.celltype import cell_text
 
-def get_facet_filter(cmd, df):
+
+def get_facet_filter(cmd, df, sc=None, context=None):
     """
     generate facet filter
 
     :param cmd:         OpenRefine command
     :param df:          Spark Dataframe object
+    :param sc:          spark context (large value sets of list facets are broadcast)
+    :param context:     variables of list facet expressions using facetCount() (updated by caller)
     """
     funcs = []
     if "engineConfig" in cmd and "facets" in cmd["engineConfig"]:
@@ -20,14 +26,12 @@ def get_facet_filter(cmd, df):
                     query_lower = query.lower()
                     if facet["mode"] == "text":
                         if facet["caseSensitive"] is False:
-                            return lambda e: query_lower in e[pos].lower()
+                            return lambda e: query_lower in cell_text(e[pos]).lower()
                         else:
-                            return lambda e: query in e[pos]
+                            return lambda e: query in cell_text(e[pos])
                     else:
-                        if facet["caseSensitive"] is False:
-                            return lambda e: re.search(query, e[pos], re.IGNORECASE) is not None
-                        else:
-                            return lambda e: re.search(query, e[pos]) is not None
+                        regex = pattern.compile(query, re.IGNORECASE if facet["caseSensitive"] is False else 0)
+                        return lambda e: regex.search(cell_text(e[pos])) is not None
                 # list facet
                 elif facet["type"] == "list":
                     facet_values = []
@@ -37,7 +41,18 @@ def get_facet_filter(cmd, df):
                             facet_values.append(v["v"])
                         if "l" in v:
                             facet_values.append(v["l"])
-                    return lambda e: e[pos] in facet_values
+                    expression = facet.get("expression", "value")
+                    if context is not None and "facetCount(" in expression:
+                        from scalableor.context import eval_expression
+                        from scalableor.facetcount import facet_key
+
+                        names = df.columns[:]
+                        choices = share(frozenset(facet_key(v) for v in facet_values), sc)
+                        return lambda e: facet_key(eval_expression(e, pos, expression, dict(context), names)) in \
+                            choices()
+                    # typed cells (guessCellType) are compared as text
+                    facet_values = share(frozenset(cell_text(v) for v in facet_values), sc)
+                    return lambda e: cell_text(e[pos]) in facet_values()
             funcs.append(facet_filter(facet_i))
 
     return lambda row: not len(funcs) or True in [f(row) for f in funcs]
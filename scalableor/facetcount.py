@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+GREL facetCount() with precomputed counts
+
+facetCount(choiceValue, "facetExpression", "columnName") needs the count of rows of a whole column, so
+calls in the expression and in list facets of a command are found before the step (function form and
+method form `value.facetCount("value", "Col")`). Values of the facet expression are counted once per
+lookup (groupBy().count() of column for "value") and the counts are joined back to the rows:
+    - few distinct values:  hash map of counts is broadcast to executors
+    - many distinct values: rows are joined with counts by choice value (a cell of the row or the value of
+                            choice expression), original order of rows is restored by row index
+facetCount() of every row is a lookup in the counts.
+"""
+
+import ast
+import re
+from itertools import chain
+from operator import add
+
+import log
+
+from scalableor import failure, recon
+from scalableor.broadcast import log_closure, share
+from scalableor.celltype import java_string
+from scalableor.context import eval_expression_batch, key_of, to_python_object
+from scalableor.control import get_tokens, match_brackets, split_arguments, subject_start
+from scalableor.facet import get_facet_filter
+from scalableor.plan import RE_CELLS_ATTR, RE_CELLS_ITEM
+from scalableor.vectorized import evaluate_rows, iter_batches
+
+# maximal count of distinct values of lookup broadcast as hash map
+BROADCAST_KEYS = 1000000
+
+RE_VALUE_EXPRESSION = re.compile(r"^\s*(?:grel:)?\s*value\s*$")
+
+
+def uses_facet_count(exp):
+    return bool(exp) and "facetCount(" in exp
+
+
+def facet_expressions(cmd, base_column=None):
+    """
+    return expressions of command which may use facetCount()
+
+    :return: list of (expression, column of 'value' and 'cell' variables, facet or None)
+    """
+    result = []
+    if cmd.get("expression"):
+        result.append((cmd["expression"], base_column, None))
+    for facet in cmd.get("engineConfig", {}).get("facets", []):
+        if facet.get("type") == "list" and facet.get("expression"):
+            result.append((facet["expression"], facet["columnName"], facet))
+    return result
+
+
+def command_uses_facet_count(cmd):
+    return any(uses_facet_count(exp) for exp, column, facet in facet_expressions(cmd))
+
+
+def key_column_of(subject, base_column):
+    """
+    return column of choice value of facetCount() or None if choice value isn't a cell of current row
+    """
+    subject = re.sub(r"\.value$", "", subject.strip())
+    if subject in ("cell", "value"):
+        return base_column
+    names = RE_CELLS_ITEM.findall(subject) + RE_CELLS_ATTR.findall(subject)
+    if names and RE_CELLS_ITEM.sub("", RE_CELLS_ATTR.sub("", subject)) == "":
+        return names[0]
+    return None
+
+
+def parse_facet_count(exp, base_column, choices=None):
+    """
+    rewrite calls of facetCount() to function form and return used lookups
+
+    :param exp:             GREL expression
+    :param base_column:     column of 'value' and 'cell' variables
+    :param choices:         dict lookup without key column -> list of (choice expression, base column),
+                            filled by found calls
+    :return: tuple of rewritten expression and list of (facet expression, column, key column or None)
+    """
+    body = exp[len("grel:"):] if exp.startswith("grel:") else exp
+    lookups = []
+    done = 0
+    while True:
+        tokens = get_tokens(body)
+        if tokens is None:
+            raise SyntaxError("GREL expression with facetCount() can't be parsed: '%s'" % exp)
+        matches = match_brackets(tokens)
+        calls = [i for i, t in enumerate(tokens) if t[1] == "facetCount" and i + 1 < len(tokens) and
+                 tokens[i + 1][1] == "("]
+        if len(calls) <= done:
+            break
+        index = calls[done]
+        arguments = split_arguments(body, tokens, matches, index + 1)
+        first = index
+        if index > 1 and tokens[index - 1][1] == ".":
+            first = subject_start(tokens, matches, index - 2)
+            arguments.insert(0, body[tokens[first][2]:tokens[index - 2][3]])
+        if len(arguments) != 3:
+            raise SyntaxError("facetCount() requires 3 arguments, %d given" % len(arguments))
+        try:
+            facet_exp, column = [ast.literal_eval(i) for i in arguments[1:]]
+        except (ValueError, SyntaxError):
+            raise SyntaxError("facet expression and column of facetCount() must be string literals")
+        lookup = (facet_exp, column, key_column_of(arguments[0], base_column))
+        if lookup not in lookups:
+            lookups.append(lookup)
+        if lookup[2] is None and choices is not None and (arguments[0], base_column) not in choices.get(lookup, []):
+            choices.setdefault(lookup, []).append((arguments[0], base_column))
+        body = "%sfacetCount(%s)%s" % (body[:tokens[first][2]], ", ".join(arguments),
+                                       body[tokens[matches[index + 1]][3]:])
+        done += 1
+    return ("grel:" if exp.startswith("grel:") else "") + body, lookups
+
+
+def rewrite_command(cmd, base_column=None, choices=None):
+    """
+    rewrite facetCount() calls of expression and list facets of command
+
+    :param choices:     dict filled with choice expressions of lookups (see parse_facet_count)
+    :return: tuple of rewritten command and list of lookups (see parse_facet_count)
+    """
+    lookups = []
+    cmd = dict(cmd)
+    if "engineConfig" in cmd:
+        cmd["engineConfig"] = dict(cmd["engineConfig"], facets=[dict(f) for f in
+                                                               cmd["engineConfig"].get("facets", [])])
+    for exp, column, facet in facet_expressions(cmd, base_column):
+        if not uses_facet_count(exp):
+            continue
+        exp, found = parse_facet_count(exp, column, choices)
+        lookups.extend(i for i in found if i not in lookups)
+        if facet is None:
+            cmd["expression"] = exp
+        else:
+            facet["expression"] = exp
+    return cmd, lookups
+
+
+def make_facet_count(tables):
+    """
+    create facetCount() function of expression context
+
+    :param tables:  dict (facet expression, column) -> dict key -> count
+    """
+
+    def facet_count(choice, facet_exp, column):
+        if (facet_exp, column) not in tables:
+            raise ValueError("counts of facet '%s' of column '%s' aren't computed" % (facet_exp, column))
+        return tables[(facet_exp, column)].get(key_of(to_python_object(choice)), 0)
+
+    return facet_count
+
+
+def facet_key(value):
+    """
+    normalize value of list facet to string (expression results and selected values)
+    """
+    value = to_python_object(value)
+    return None if value is None else java_string(value)
+
+
+def count_rows(rows, names, facet_exp, column):
+    """
+    count values of facet expression of rows
+
+    :return: dict key -> count
+    """
+    position = names.index(column)
+    counts = {}
+    if RE_VALUE_EXPRESSION.match(facet_exp):
+        values = (row[position] for row in rows)
+    else:
+        values = chain.from_iterable(eval_expression_batch(batch, position, facet_exp, names=names)
+                                     for batch in iter_batches(iter(rows)))
+    for value in values:
+        key = key_of(to_python_object(value))
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def local_tables(cmd, columns, chunks):
+    """
+    rewrite command and count values of its facetCount() lookups in local engine
+
+    :param cmd:         OpenRefine command
+    :param columns:     column names
+    :param chunks:      list of all row chunks
+    :return: tuple of rewritten command and counts (see make_facet_count)
+    """
+    base_column = cmd.get("baseColumnName", cmd.get("columnName"))
+    cmd, lookups = rewrite_command(cmd, base_column)
+    tables = {}
+    for facet_exp, column, key_column in lookups:
+        tables[(facet_exp, column)] = count_rows(chain.from_iterable(chunks), columns, facet_exp, column)
+    return cmd, tables
+
+
+def count_values(df, facet_exp, column):
+    """
+    count values of facet expression of column of spark data frame
+
+    :return: rdd of (key, count)
+    """
+    if RE_VALUE_EXPRESSION.match(facet_exp):
+        return df.groupBy(df[column]).count().rdd.map(lambda r: (key_of(r[0]), r[1]))
+    names = df.columns[:]
+    position = names.index(column)
+    evaluate_batches = lambda rows: chain.from_iterable(
+        eval_expression_batch(batch, position, facet_exp, names=names) for batch in iter_batches(rows))
+    return (df.rdd.mapPartitions(evaluate_batches)
+            .map(lambda v: (key_of(to_python_object(v)), 1))
+            .reduceByKey(add))
+
+
+def choice_keys(rdd, names, position, choice_exp=None):
+    """
+    key entries (index, row, counts) by choice value of facetCount()
+
+    :param rdd:         rdd of entries
+    :param names:       column names
+    :param position:    position of column of choice value or of base column of choice expression
+    :param choice_exp:  choice expression (None: choice value is the cell)
+    :return: rdd of (key, entry)
+    """
+    if choice_exp is None:
+        return rdd.map(lambda e: (key_of(e[1][position]), e))
+
+    def evaluate_partition(entries):
+        for batch in iter_batches(entries):
+            values = eval_expression_batch([e[1] for e in batch], position, choice_exp, names=names)
+            for e, value in zip(batch, values):
+                yield key_of(to_python_object(value)), e
+
+    return rdd.mapPartitions(evaluate_partition)
+
+
+def join_counts(cmd, df, sc):
+    """
+    count values of facetCount() lookups of command and join them to rows of spark data frame
+
+    :param cmd:     OpenRefine command
+    :param df:      spark data frame
+    :param sc:      spark context
+    :return: tuple of rewritten command, rdd of (row, (key, count) of joined lookups) and callback returning
+             counts (see make_facet_count) of batch of such pairs
+    """
+    from pyspark import StorageLevel
+
+    names = df.columns[:]
+    choices = {}
+    cmd, lookups = rewrite_command(cmd, cmd.get("baseColumnName", cmd.get("columnName")), choices)
+    broadcast = {}
+    joined = []
+    for facet_exp, column, key_column in lookups:
+        # counts are computed once for size probe and join
+        counts = count_values(df, facet_exp, column).persist(StorageLevel.MEMORY_AND_DISK)
+        first = counts.take(BROADCAST_KEYS + 1)
+        if len(first) <= BROADCAST_KEYS:
+            log.logger.info("facetCount: broadcast counts of '%s' of column '%s'" % (facet_exp, column))
+            broadcast[(facet_exp, column)] = dict(first)
+            counts.unpersist()
+            continue
+        log.logger.info("facetCount: shuffle join of counts of '%s' of column '%s'" % (facet_exp, column))
+        if key_column is not None:
+            joined.append(((facet_exp, column), names.index(key_column), None, counts))
+        for choice_exp, base_column in choices.get((facet_exp, column, key_column), []):
+            joined.append(((facet_exp, column), names.index(base_column), choice_exp, counts))
+
+    if joined:
+        # rows are (index, row, (key, count) of every joined lookup)
+        rdd = df.rdd.zipWithIndex().map(lambda e: (e[1], tuple(e[0]), ()))
+        for name, position, choice_exp, counts in joined:
+            rdd = (choice_keys(rdd, names, position, choice_exp)
+                   .leftOuterJoin(counts)
+                   .map(lambda kv: (kv[1][0][0], kv[1][0][1], kv[1][0][2] + ((kv[0], kv[1][1] or 0),))))
+        rdd = rdd.sortBy(lambda e: e[0], numPartitions=df.rdd.getNumPartitions()).map(lambda e: (e[1], e[2]))
+    else:
+        rdd = df.rdd.map(lambda r: (tuple(r), ()))
+
+    shared = share(broadcast, sc)
+    joined_names = [name for name, position, choice_exp, counts in joined]
+
+    def batch_tables(batch):
+        tables = dict(shared())
+        for index, name in enumerate(joined_names):
+            tables.setdefault(name, {}).update(counts[index] for row, counts in batch)
+        return tables
+
+    return cmd, rdd, batch_tables
+
+
+def evaluate(cmd, df, position, build, otherwise, sc):
+    """
+    evaluate expression of command using facetCount() (in expression or list facets) with precomputed counts
+
+    :param cmd:         OpenRefine command
+    :param df:          spark data frame
+    :param position:    position of base column
+    :param build:       callback (row, value) returning new row
+    :param otherwise:   callback returning value of row not selected by facets
+    :param sc:          spark context
+    :return: rdd of new rows
+    """
+    names = df.columns[:]
+    on_error = cmd.get("onError")
+    tracker = failure.tracker(cmd, sc)
+    cmd, rdd, batch_tables = join_counts(cmd, df, sc)
+    exp = share(cmd["expression"], sc)
+    # variables of expression and facets are changed for every batch
+    variables = {}
+    facet_filter = get_facet_filter(cmd, df, sc, variables)
+    shared_recons = share(recon.get_tables(), sc)
+
+    def evaluate_partition(split, entries):
+        failures = failure.Failures()
+        recons = shared_recons()
+        for batch in iter_batches(entries):
+            variables["facetCount"] = make_facet_count(batch_tables(batch))
+            rows = [e[0] for e in batch]
+            values = evaluate_rows(rows, position, exp(), names, facet_filter, otherwise, dict(variables),
+                                   on_error, failures, recons)
+            for row, value in zip(rows, values):
+                yield build(row, value)
+        failure.track(tracker, split, failures)
+
+    return rdd.mapPartitionsWithIndex(log_closure(cmd, evaluate_partition))
+
+
+def remove_rows(cmd, df, sc):
+    """
+    remove rows selected by list facets using facetCount() with precomputed counts
+
+    :return: rdd of kept rows
+    """
+    cmd, rdd, batch_tables = join_counts(cmd, df, sc)
+    variables = {}
+    facet_filter = get_facet_filter(cmd, df, sc, variables)
+
+    def remove_partition(entries):
+        for batch in iter_batches(entries):
+            variables["facetCount"] = make_facet_count(batch_tables(batch))
+            for row, counts in batch:
+                if facet_filter(row) is False:
+                    yield row
+
+    return rdd.mapPartitions(log_closure(cmd, remove_partition))
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Per-row failures of expression steps (OpenRefine onError)
+
+An expression failing on a row doesn't fail the job, if the step has onError mode:
+    - keep-original:    value of base column is kept
+    - set-to-blank:     value is blank
+    - store-error:      value is error message
+Failures are counted (accumulators of spark tasks) and a sample of failed rows is written to a side
+output after the run. Accumulators keep failures per partition: a partition evaluated again (e.g. by head(),
+schema inference or a counting pass) replaces its failures instead of adding them twice.
+"""
+
+import json
+
+import log
+
+KEEP_ORIGINAL = "keep-original"
+SET_TO_BLANK = "set-to-blank"
+STORE_ERROR = "store-error"
+ON_ERROR_MODES = (KEEP_ORIGINAL, SET_TO_BLANK, STORE_ERROR)
+# count of sampled failed rows per step
+SAMPLE_SIZE = 20
+# collectors of failures of steps (driver): list of (command, collector)
+STEPS = []
+
+
+def to_text(value):
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    return unicode(value)
+
+
+def error_message(error):
+    try:
+        message = unicode(error)
+    except UnicodeDecodeError:
+        message = to_text(str(error))
+    return u"%s: %s" % (error.__class__.__name__, message)
+
+
+def fallback(on_error, original, error):
+    """
+    return value of failed row by onError mode
+    """
+    if on_error == KEEP_ORIGINAL:
+        return original
+    if on_error == SET_TO_BLANK:
+        return ""
+    return error_message(error)
+
+
+class Failures(object):
+    """
+    this class counts failed rows of step and keeps a sample of them
+    """
+
+    def __init__(self, size=SAMPLE_SIZE):
+        self.size = size
+        self.count = 0
+        self.samples = []
+
+    def add(self, row, error):
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append({"row": [i if i is None or isinstance(i, (bool, int, long, float)) else to_text(i)
+                                         for i in row],
+                                 "error": error_message(error)})
+
+    def merge(self, other):
+        self.count += other.count
+        self.samples.extend(other.samples[:max(0, self.size - len(self.samples))])
+        return self
+
+
+class FailuresParam(object):
+    """
+    accumulator param of failures per partition: key of partition -> Failures
+    """
+
+    def zero(self, value):
+        return {}
+
+    def addInPlace(self, value1, value2):
+        for key, failures in value2.iteritems():
+            # the most complete evaluation of partition is kept
+            if key not in value1 or failures.count > value1[key].count:
+                value1[key] = failures
+        return value1
+
+
+def track(tracker, key, failures):
+    """
+    add failures of partition evaluated by spark task to collector of step
+
+    :param tracker:     accumulator of step (None: step has no onError mode)
+    :param key:         key of partition (e.g. partition index)
+    :param failures:    failures of partition
+    """
+    if tracker is not None and failures.count:
+        tracker.add({key: failures})
+
+
+def tracker(cmd, sc=None):
+    """
+    create collector of failures of step
+
+    :param cmd:     OpenRefine command
+    :param sc:      spark context (None: failures are collected in this process)
+    :return: accumulator, Failures or None if step has no onError mode (failure stops job)
+    """
+    if cmd.get("onError") is None:
+        return None
+    collector = sc.accumulator({}, FailuresParam()) if sc is not None else Failures()
+    STEPS.append((cmd, collector))
+    return collector
+
+
+def collect(or_program):
+    """
+    remove collectors of steps of OpenRefine program and return their failures
+
+    :return: dict index of step -> Failures
+    """
+    indexes = dict((id(cmd), index) for index, cmd in enumerate(or_program))
+    result = {}
+    for cmd, collector in [i for i in STEPS if id(i[0]) in indexes]:
+        STEPS.remove((cmd, collector))
+        partitions = [collector] if isinstance(collector, Failures) else \
+            [failures for key, failures in sorted(collector.value.items())]
+        for failures in partitions:
+            result.setdefault(indexes[id(cmd)], Failures()).merge(failures)
+    return result
+
+
+def write_report(path, or_program, failures):
+    """
+    write failed rows of steps to side output
+
+    :param path:        path to JSON report
+    :param or_program:  sequence of OpenRefine commands
+    :param failures:    dict index of step -> Failures
+    """
+    steps = [{"step": index + 1, "op": or_program[index]["op"], "onError": or_program[index]["onError"],
+              "count": failures[index].count, "samples": failures[index].samples}
+             for index in sorted(failures) if failures[index].count]
+    if not steps:
+        return
+    with open(path, "w") as output:
+        json.dump(steps, output, indent=2)
+    log.logger.warn("%d failed rows, sample is written to '%s'" % (sum(i["count"] for i in steps), path))
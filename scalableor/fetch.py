@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Column addition by fetching URLs (core/column-addition-by-fetching-urls)
+
+URLs are evaluated for windows of rows of partition, and every distinct URL of window is fetched once by
+a thread pool. Connections are kept alive in a pool per host, which limits concurrent requests to the host
+(--fetch-connections). `delay` (ms) of command is a rate limit: requests to the same host start at least
+`delay` apart (per partition task), instead of a sleep after every row. Responses are kept in a persistent
+local cache keyed by URL (--fetch-cache), so reruns don't fetch them again; failed requests aren't cached.
+"""
+
+import httplib
+import os
+import Queue
+import socket
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+import log
+
+from scalableor import failure
+from scalableor.diskcache import DiskCache
+from scalableor.vectorized import evaluate_rows, iter_batches
+
+# path of persistent cache of responses
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "scalableor", "fetch.db")
+# concurrent connections per host
+HOST_CONNECTIONS = 4
+# threads fetching URLs of window
+WORKERS = 16
+# rows of partition whose URLs are fetched together
+WINDOW_SIZE = 1024
+TIMEOUT = 30
+RETRIES = 3
+MAX_REDIRECTS = 5
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class HostPool(object):
+    """
+    this class keeps persistent connections to host and limits rate of requests
+    """
+
+    def __init__(self, scheme, host, connections=HOST_CONNECTIONS, delay=0, timeout=TIMEOUT):
+        self.connection_class = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        self.host = host
+        self.timeout = timeout
+        self.interval = delay / 1000.0
+        self.lock = threading.Lock()
+        self.next_start = 0
+        self.pool = Queue.Queue()
+        for _ in range(connections):
+            self.pool.put(None)
+
+    def wait_turn(self):
+        """
+        wait for start of next request (requests start `delay` apart)
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def get(self, path, headers):
+        """
+        :return: tuple of HTTP status, response headers and body
+        """
+        connection = self.pool.get()
+        try:
+            for attempt in range(RETRIES):
+                if connection is None:
+                    connection = self.connection_class(self.host, timeout=self.timeout)
+                self.wait_turn()
+                try:
+                    connection.request("GET", path, headers=headers)
+                    response = connection.getresponse()
+                    return response.status, dict(response.getheaders()), response.read()
+                except (httplib.HTTPException, socket.error):
+                    # connection closed by host
+                    connection.close()
+                    connection = None
+                    if attempt == RETRIES - 1:
+                        raise
+        finally:
+            self.pool.put(connection)
+
+    def close(self):
+        while not self.pool.empty():
+            connection = self.pool.get()
+            if connection is not None:
+                connection.close()
+
+
+class Fetcher(object):
+    """
+    this class fetches URLs over connection pools of their hosts
+    """
+
+    def __init__(self, headers=None, delay=0, connections=HOST_CONNECTIONS, workers=WORKERS):
+        self.headers = dict(headers or {})
+        self.delay = delay
+        self.connections = connections
+        self.workers = workers
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def host_pool(self, scheme, host):
+        with self.lock:
+            if (scheme, host) not in self.hosts:
+                self.hosts[(scheme, host)] = HostPool(scheme, host, self.connections, self.delay)
+            return self.hosts[(scheme, host)]
+
+    def fetch(self, url):
+        """
+        fetch URL (redirects are followed)
+
+        :return: response body (unicode)
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):
+                raise IOError("URL '%s' isn't supported" % url)
+            path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+            status, headers, body = self.host_pool(parts.scheme, parts.netloc).get(path, self.headers)
+            self.requests += 1
+            if status in REDIRECTS and "location" in headers:
+                url = urlparse.urljoin(url, headers["location"])
+                continue
+            if status != 200:
+                raise IOError("HTTP %d: %s" % (status, url))
+            return body.decode(response_charset(headers), "replace")
+        raise IOError("too many redirects: %s" % url)
+
+    def fetch_many(self, urls):
+        """
+        fetch URLs in parallel
+
+        :return: dict URL -> tuple of body and error (None if URL is fetched)
+        """
+        def fetch_one(url):
+            try:
+                return url, (self.fetch(url), None)
+            except Exception as error:
+                return url, (None, error)
+
+        if not urls:
+            return {}
+        workers = ThreadPool(min(self.workers, len(urls)))
+        try:
+            return dict(workers.map(fetch_one, urls))
+        finally:
+            workers.close()
+
+    def close(self):
+        for pool in self.hosts.values():
+            pool.close()
+
+
+def response_charset(headers):
+    content_type = headers.get("content-type", "")
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.strip().partition("=")
+        if name.lower() == "charset" and value:
+            return value.strip("\"'")
+    return "utf-8"
+
+
+def get_headers(cmd):
+    """
+    return HTTP headers of command (httpHeadersJson)
+    """
+    return dict((h["name"], h["value"]) for h in cmd.get("httpHeadersJson") or [] if h.get("value"))
+
+
+def fetch_partition(cmd, rows, names, position, facet_filter, failures=None, recons=None, cache_path=None,
+                    connections=HOST_CONNECTIONS):
+    """
+    fetch URLs of rows and return values of new column
+
+    :param cmd:             OpenRefine command
+    :param rows:            iterator of rows
+    :param names:           column names
+    :param position:        position of base column
+    :param facet_filter:    facet filter
+    :param failures:        collector of failed rows (failure.Failures)
+    :param recons:          reconciled columns (see recon.get_tables)
+    :param cache_path:      path of persistent cache (None: responses aren't cached)
+    :param connections:     concurrent connections per host
+    :return: iterator of (row, value)
+    """
+    on_error = cmd.get("onError")
+    fetcher = Fetcher(get_headers(cmd), int(cmd.get("delay") or 0), connections)
+    cache = DiskCache(cache_path, "responses") if cache_path else None
+    fetched = 0
+    try:
+        for window in iter_batches(rows, WINDOW_SIZE):
+            # failed URL expression gives blank cell
+            urls = evaluate_rows(window, position, cmd["urlExpression"], names, facet_filter, lambda e: None,
+                                 None, on_error and failure.SET_TO_BLANK, failures, recons)
+            urls = [unicode(u).strip() if u is not None else u"" for u in urls]
+            distinct = set(u for u in urls if u)
+            responses = dict((u, (b, None)) for u, b in (cache.get_many(distinct) if cache else {}).iteritems())
+            missing = [u for u in distinct if u not in responses]
+            responses.update(fetcher.fetch_many(missing))
+            fetched += len(missing)
+            if cache:
+                cache.put_many(dict((u, responses[u][0]) for u in missing if responses[u][1] is None))
+            for row, url in zip(window, urls):
+                if not url:
+                    yield row, u""
+                    continue
+                body, error = responses[url]
+                if error is not None:
+                    if on_error is None:
+                        raise error
+                    failures is not None and failures.add(row, error)
+                    body = failure.fallback(on_error, row[position], error)
+                yield row, body
+    finally:
+        fetcher.close()
+        cache and cache.close()
+    log.logger.info("fetch: %d URLs fetched in %d requests" % (fetched, fetcher.requests))
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental refinement of append-only input
+
+Processed input files and byte offsets are kept in a state file next to the output. If every step
+of the OpenRefine program is row-local, only the appended tail of input (new bytes of plain files
+and new files of input directory) is refined and appended to the existing output. Otherwise
+(order-dependent steps like fill-down, changed program or rewritten input) the whole input is refined.
+
+Input files are scanned before the run and only the scanned bytes up to the last complete line are
+copied and refined, so rows appended during a run (and a half-written last line) are left to the next run.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import log
+import plan
+
+# count of bytes at beginning of file compared to detect rewritten input
+HEAD_SIZE = 64 * 1024
+# size of blocks of copied input
+BLOCK_SIZE = 1024 * 1024
+
+FULL = "full"
+INCREMENTAL = "incremental"
+UNCHANGED = "unchanged"
+
+
+def program_hash(or_program):
+    """
+    return hash of OpenRefine program
+    """
+    return hashlib.sha1(json.dumps(or_program, sort_keys=True)).hexdigest()
+
+
+def head_hash(path, size):
+    """
+    return hash of first bytes of file
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(min(size, HEAD_SIZE))).hexdigest()
+
+
+def list_files(path):
+    """
+    return input files by name (single file or part files of directory)
+    """
+    if not os.path.isdir(path):
+        return {os.path.basename(path): path}
+    return dict((i, os.path.join(path, i)) for i in os.listdir(path) if not i.startswith((".", "_")))
+
+
+def complete_size(f, size):
+    """
+    return size of complete lines of first bytes of file (trailing line without newline may be half-written)
+    """
+    end = size
+    while end > 0:
+        start = max(end - BLOCK_SIZE, 0)
+        f.seek(start)
+        found = f.read(end - start).rfind("\n")
+        if found >= 0:
+            return start + found + 1
+        end = start
+    return 0
+
+
+def scan_input(path):
+    """
+    describe current state of input files: sizes of complete lines (whole compressed files)
+    """
+    files = {}
+    for name, fpath in list_files(path).items():
+        size = os.path.getsize(fpath)
+        if not name.endswith(".gz"):
+            with open(fpath, "rb") as f:
+                size = complete_size(f, size)
+        files[name] = {"size": size, "head": head_hash(fpath, size)}
+    return files
+
+
+def is_row_local(or_program):
+    """
+    check that all steps of OpenRefine program (with import/export commands) are row-local
+
+    :return: tuple of status and reason of full refinement
+    """
+    program_plan = plan.build_plan(or_program)
+    if program_plan.errors:
+        return False, "plan has errors"
+    for step in program_plan.steps + program_plan.pruned:
+        if not step["row_local"]:
+            return False, "step %d '%s' isn't row-local" % (step["index"] + 1, step["op"])
+    return True, None
+
+
+def find_tail(state, input_path, files):
+    """
+    compare processed and current input files
+
+    :param state:       state of last refinement
+    :param input_path:  path to input file or directory
+    :param files:       current input files
+    :return: tuple of tail offsets by file name (None: full refinement required) and reason
+    """
+    paths = list_files(input_path)
+    offsets = {}
+    for name, done in state["files"].items():
+        current = files.get(name)
+        if current is None:
+            return None, "input file '%s' is removed" % name
+        if current["size"] < done["size"] or head_hash(paths[name], done["size"]) != done["head"]:
+            return None, "input file '%s' is rewritten" % name
+        if current["size"] > done["size"]:
+            if name.endswith(".gz"):
+                return None, "compressed input file '%s' is changed" % name
+            offsets[name] = done["size"]
+    last_name = max(state["files"]) if state["files"] else ""
+    for name in files:
+        if name not in state["files"]:
+            # new file must follow processed files in order of rows
+            if name < last_name:
+                return None, "new input file '%s' is ordered before processed files" % name
+            offsets[name] = 0
+    return offsets, None
+
+
+def copy_range(source, target, length):
+    """
+    copy length bytes of source file from its current position
+    """
+    while length > 0:
+        block = source.read(min(length, BLOCK_SIZE))
+        if not block:
+            raise IOError("input file '%s' is truncated during refinement" % source.name)
+        target.write(block)
+        length -= len(block)
+
+
+def write_tail(input_path, offsets, tail_dir, files):
+    """
+    write scanned data of input files from offsets to directory (files are ordered by name)
+
+    :param offsets:     offsets of copied data by file name
+    :param files:       scanned input files (data after scanned size isn't copied)
+    """
+    paths = list_files(input_path)
+    for index, name in enumerate(sorted(offsets)):
+        tail_path = os.path.join(tail_dir, "%05d-%s" % (index, name))
+        with open(paths[name], "rb") as source, open(tail_path, "wb") as target:
+            source.seek(offsets[name])
+            copy_range(source, target, files[name]["size"] - offsets[name])
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.rename(tmp_path, path)
+
+
+def run(scalable_or, input_path, output_path, or_program, state_path=None):
+    """
+    refine only appended input if it is possible, otherwise the whole input
+
+    :param scalable_or:     ScalableOR object
+    :param input_path:      path to input file or directory
+    :param output_path:     path to output file
+    :param or_program:      sequence of OpenRefine commands
+    :param state_path:      path to state file (default: output path + ".state.json")
+    :return: refinement mode (full, incremental, unchanged)
+    """
+    state_path = state_path or output_path + ".state.json"
+    files = scan_input(input_path)
+    state = {"input": input_path, "program": program_hash(or_program), "files": files}
+
+    row_local, reason = is_row_local(scalable_or.add_io_commands(input_path, output_path, or_program))
+    last = load_state(state_path)
+    offsets = None
+    if not row_local:
+        pass
+    elif last is None or not os.path.exists(output_path):
+        reason = "no state of last refinement"
+    elif last["input"] != input_path or last["program"] != state["program"]:
+        reason = "input or OR program is changed"
+    else:
+        offsets, reason = find_tail(last, input_path, files)
+
+    if offsets is None:
+        log.logger.info("incremental: refine whole input (%s)" % reason)
+        # scanned data of all files
+        offsets = dict.fromkeys(files, 0)
+        tail_dir = tempfile.mkdtemp(suffix=".scalable.or")
+        try:
+            write_tail(input_path, offsets, tail_dir, files)
+            scalable_or.run_job(tail_dir, output_path, or_program)
+        finally:
+            shutil.rmtree(tail_dir, ignore_errors=True)
+        save_state(state_path, state)
+        return FULL
+
+    if not offsets:
+        log.logger.info("incremental: input is unchanged")
+        return UNCHANGED
+
+    log.logger.info("incremental: refine appended data of %d file(s)" % len(offsets))
+    tail_dir = tempfile.mkdtemp(suffix=".scalable.or")
+    fd, tail_output = tempfile.mkstemp(suffix=".csv", dir=os.path.dirname(output_path))
+    os.close(fd)
+    try:
+        write_tail(input_path, offsets, tail_dir, files)
+        scalable_or.run_job(tail_dir, tail_output, or_program)
+        with open(output_path, "ab") as output, open(tail_output, "rb") as tail:
+            shutil.copyfileobj(tail, output)
+    finally:
+        shutil.rmtree(tail_dir, ignore_errors=True)
+        if os.path.exists(tail_output):
+            os.remove(tail_output)
+    save_state(state_path, state)
+    return INCREMENTAL
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Keying functions of key collision clustering (OpenRefine keyers) and hashing
+
+Normalisation tables (ASCII folding, removed punctuation/control characters) are built once on
+import and applied with unicode.translate, so a key is computed without regular expressions.
+https://github.com/OpenRefine/OpenRefine/wiki/Clustering-In-Depth
+"""
+
+import hashlib
+import string
+import unicodedata
+
+# characters without canonical decomposition to ASCII
+SPECIAL_ASCII = {
+    u"ß": u"ss", u"æ": u"ae", u"Æ": u"AE", u"ø": u"o", u"Ø": u"O", u"œ": u"oe", u"Œ": u"OE",
+    u"đ": u"d", u"Đ": u"D", u"ð": u"d", u"Ð": u"D", u"ł": u"l", u"Ł": u"L", u"þ": u"th", u"Þ": u"TH",
+    u"ı": u"i", u"ŀ": u"l", u"Ŀ": u"L", u"ħ": u"h", u"Ħ": u"H", u"ŧ": u"t", u"Ŧ": u"T",
+}
+
+
+def build_ascii_table():
+    """
+    build translation table folding latin characters to ASCII
+    """
+    table = {}
+    for code in range(0x80, 0x250):
+        char = unichr(code)
+        folded = SPECIAL_ASCII.get(char)
+        if folded is None:
+            folded = u"".join(c for c in unicodedata.normalize("NFKD", char) if not unicodedata.combining(c))
+            if not folded or any(ord(c) >= 0x80 for c in folded):
+                continue
+        table[code] = folded
+    return table
+
+
+# precompiled normalisation tables
+ASCII_TABLE = build_ascii_table()
+PUNCTUATION_TABLE = dict((ord(c), None) for c in string.punctuation)
+PUNCTUATION_TABLE.update((i, None) for i in range(0x20))
+PUNCTUATION_TABLE[0x7F] = None
+NGRAM_TABLE = dict(PUNCTUATION_TABLE)
+NGRAM_TABLE.update((ord(c), None) for c in string.whitespace)
+
+SOUNDEX_CODES = dict(zip(u"bfpvcgjkqsxzdtlmnr", u"111122222222334556"))
+
+
+def to_unicode(value):
+    if value is None:
+        return u""
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    if not isinstance(value, unicode):
+        return unicode(value)
+    return value
+
+
+def fingerprint(value):
+    """
+    fingerprint key: sorted unique tokens of lower case ASCII folded value without punctuation
+    """
+    value = to_unicode(value).strip().lower().translate(ASCII_TABLE).translate(PUNCTUATION_TABLE)
+    return u" ".join(sorted(set(value.split())))
+
+
+def ngram_fingerprint(value, n=2):
+    """
+    n-gram fingerprint key: sorted unique n-grams of lower case ASCII folded value without
+    punctuation and whitespace
+    """
+    n = int(n)
+    value = to_unicode(value).lower().translate(ASCII_TABLE).translate(NGRAM_TABLE)
+    return u"".join(sorted(set(value[i:i + n] for i in range(len(value) - n + 1))))
+
+
+def soundex(value):
+    """
+    american soundex code
+    """
+    value = [c for c in to_unicode(value).lower().translate(ASCII_TABLE) if c.isalpha()]
+    if not value:
+        return u""
+    code = [value[0].upper()]
+    last = SOUNDEX_CODES.get(value[0])
+    for c in value[1:]:
+        digit = SOUNDEX_CODES.get(c)
+        if digit is not None and digit != last:
+            code.append(digit)
+        # h and w don't separate equal codes
+        if c not in u"hw":
+            last = digit
+    return (u"".join(code) + u"000")[:4]
+
+
+def cologne(value):
+    """
+    cologne phonetic code (german names)
+    """
+    value = [c for c in to_unicode(value).lower().replace(u"ß", u"s").translate(ASCII_TABLE) if c.isalpha()]
+    codes = []
+    for i, c in enumerate(value):
+        before = value[i - 1] if i else None
+        after = value[i + 1] if i + 1 < len(value) else None
+        if c in u"aeijouy":
+            code = u"0"
+        elif c == u"h":
+            code = u""
+        elif c == u"b" or (c == u"p" and after != u"h"):
+            code = u"1"
+        elif c in u"dt":
+            code = u"8" if after and after in u"csz" else u"2"
+        elif c in u"fvwp":
+            code = u"3"
+        elif c in u"gkq":
+            code = u"4"
+        elif c == u"c":
+            if before is None:
+                code = u"4" if after and after in u"ahkloqrux" else u"8"
+            else:
+                code = u"4" if after and after in u"ahkoqux" and before not in u"sz" else u"8"
+        elif c == u"x":
+            code = u"8" if before and before in u"ckq" else u"48"
+        elif c == u"l":
+            code = u"5"
+        elif c in u"mn":
+            code = u"6"
+        elif c == u"r":
+            code = u"7"
+        else:
+            code = u"8"
+        codes.append(code)
+
+    result = []
+    for code in u"".join(codes):
+        if not result or result[-1] != code:
+            result.append(code)
+    # "0" is kept only at beginning
+    return u"".join(result[:1] + [c for c in result[1:] if c != u"0"])
+
+
+PHONETIC_ENCODINGS = {
+    "soundex": soundex,
+    "cologne": cologne,
+}
+
+
+def phonetic(value, encoding="soundex"):
+    """
+    phonetic key of value
+
+    :param encoding:    soundex or cologne
+    """
+    if encoding not in PHONETIC_ENCODINGS:
+        raise NotImplementedError("phonetic encoding '%s' isn't supported (%s)" % (
+            encoding, ", ".join(sorted(PHONETIC_ENCODINGS))))
+    return PHONETIC_ENCODINGS[encoding](value)
+
+
+def md5(value):
+    return hashlib.md5(to_unicode(value).encode("utf-8")).hexdigest()
+
+
+def sha1(value):
+    return hashlib.sha1(to_unicode(value).encode("utf-8")).hexdigest()
+
+
+KEYERS = {
+    "fingerprint": lambda value, params: fingerprint(value),
+    "ngram-fingerprint": lambda value, params: ngram_fingerprint(value, params.get("ngramSize", 2)),
+    "phonetic": lambda value, params: phonetic(value, params.get("encoding", "soundex")),
+}
+
+
+def get_keyer(name, params=None):
+    """
+    return keying function by name
+
+    :param name:    fingerprint, ngram-fingerprint or phonetic
+    :param params:  keyer parameters (ngramSize, encoding)
+    """
+    if name not in KEYERS:
+        raise NotImplementedError("keyer '%s' isn't supported (%s)" % (name, ", ".join(sorted(KEYERS))))
+    keyer = KEYERS[name]
+    params = params or {}
+    return lambda value: keyer(value, params)
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Local execution engine (without spark) for small inputs
+
+Data is kept as streaming table of row chunks. Steps are applied chunk by chunk, python
+expression steps are evaluated by a multiprocessing pool over all cores. The registered
+methods produce the same output as the methods of spark engine.
+"""
+
+import collections
+import contextlib
+import gzip
+import io
+import itertools
+import multiprocessing
+import os
+import threading
+
+from scalableor import celltype, failure, fetch, pattern, recon
+from scalableor.celltype import java_string
+from scalableor.cluster import get_cluster_keyer, write_clusters
+from scalableor.constant import COLUMN_NAME, ENGINE_LOCAL
+from scalableor.cross import local_tables, make_cross, uses_cross
+from scalableor.facet import get_facet_filter
+from scalableor.facetcount import command_uses_facet_count, local_tables as facet_count_tables, make_facet_count
+from scalableor.manager import MethodsManager
+from scalableor.method import get_mass_edit_function, get_move_order, get_multivalued_split_function, \
+    get_split_column_names, get_split_function, join_partition
+from scalableor.profiling import get_profile_params, profile_rows, write_profile
+from scalableor.sample import SEED, sample_rows
+from scalableor.vectorized import evaluate_rows, iter_batches
+
+CHUNK_SIZE = 10000
+# size of multiprocessing pool (None: count of cpu, 1: evaluate in this process)
+PROCESSES = None
+POOL = None
+# count of running jobs using the pool (jobs of service run concurrently)
+POOL_USERS = 0
+POOL_LOCK = threading.Lock()
+
+
+class LocalTable(object):
+    """
+    this class implements streaming in-process table: column names and iterator of row chunks
+    """
+
+    def __init__(self, columns, chunks):
+        self.columns = list(columns)
+        self.chunks = iter(chunks)
+
+    def head(self, n):
+        """
+        return first rows without consuming them
+        """
+        peeked = []
+        rows = []
+        for chunk in self.chunks:
+            peeked.append(chunk)
+            rows.extend(chunk)
+            if len(rows) >= n:
+                break
+        self.chunks = itertools.chain(peeked, self.chunks)
+        return rows[:n]
+
+    def rows(self):
+        for chunk in self.chunks:
+            for row in chunk:
+                yield row
+
+    def map_chunks(self, func, columns=None):
+        return LocalTable(self.columns if columns is None else columns, itertools.imap(func, self.chunks))
+
+    def map(self, func, columns=None):
+        return self.map_chunks(lambda chunk: [func(e) for e in chunk], columns)
+
+    def filter(self, func):
+        return self.map_chunks(lambda chunk: [e for e in chunk if func(e)])
+
+
+def get_pool():
+    """
+    return multiprocessing pool (created once), None if expressions are evaluated in this process
+    """
+    global POOL
+    with POOL_LOCK:
+        if POOL is None and PROCESSES != 1:
+            POOL = multiprocessing.Pool(PROCESSES)
+        return POOL
+
+
+@contextlib.contextmanager
+def pool_scope():
+    """
+    keep multiprocessing pool during job, pool is terminated after the last running job
+    """
+    global POOL, POOL_USERS
+    with POOL_LOCK:
+        POOL_USERS += 1
+    try:
+        yield
+    finally:
+        with POOL_LOCK:
+            POOL_USERS -= 1
+            pool, POOL = (POOL, None) if POOL_USERS == 0 else (None, POOL)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def evaluate_chunk(task):
+    """
+    evaluate expression for chunk of rows (executed in pool process)
+
+    :param task:    tuple of command, column names, position of base column, keep original value flag,
+                    lookup tables of cross(), counts of facetCount(), reconciled columns, rows
+    :return: tuple of list of values, counters of regex cache and failed rows
+    """
+    cmd, columns, position, keep_original, tables, counts, recons, chunk = task
+    before = pattern.stats()
+    failures = failure.Failures()
+    context = {}
+    if tables:
+        context["cross"] = make_cross(tables)
+    if counts:
+        context["facetCount"] = make_facet_count(counts)
+    facet_filter = get_facet_filter(cmd, LocalTable(columns, []), context=context if counts else None)
+    otherwise = (lambda e: e[position]) if keep_original else (lambda e: "")
+    context = context or None
+    values = evaluate_rows(chunk, position, cmd["expression"], columns, facet_filter, otherwise, context,
+                           cmd.get("onError"), failures, recons)
+    return values, pattern.diff(pattern.stats(), before), failures
+
+
+def map_expression(cmd, df, position, keep_original):
+    """
+    evaluate expression of command over chunks in process pool
+
+    :return: iterator of (chunk, values) pairs
+    """
+    tracker = failure.tracker(cmd)
+    tables = None
+    if uses_cross(cmd["expression"]):
+        cmd, tables = local_tables(cmd, df.columns[position])
+    counts = None
+    all_chunks = df.chunks
+    if command_uses_facet_count(cmd):
+        # counts of whole columns are computed before the step
+        all_chunks = list(all_chunks)
+        cmd, counts = facet_count_tables(cmd, df.columns, all_chunks)
+
+    # reconciled columns of this step (rows are evaluated lazily by later steps)
+    recons = recon.get_tables()
+
+    def evaluate_chunks():
+        pool = get_pool()
+        window = (PROCESSES or multiprocessing.cpu_count()) * 2
+        for chunks in iter_batches(iter(all_chunks), window):
+            tasks = [(cmd, df.columns, position, keep_original, tables, counts, recons, chunk) for chunk in chunks]
+            if pool and len(tasks) > 1:
+                results = pool.map(evaluate_chunk, tasks)
+                # counters of pool processes
+                map(pattern.merge, [counters for values, counters, failures in results])
+            else:
+                results = map(evaluate_chunk, tasks)
+            for chunk, (values, counters, failures) in zip(chunks, results):
+                if tracker is not None:
+                    tracker.merge(failures)
+                yield chunk, values
+
+    return evaluate_chunks()
+
+
+def read_lines(path):
+    """
+    read lines of input file (plain or gzip) or of all files in directory
+    """
+    if os.path.isdir(path):
+        for fname in sorted(os.listdir(path)):
+            if not fname.startswith((".", "_")):
+                for line in read_lines(os.path.join(path, fname)):
+                    yield line
+        return
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        for line in f:
+            if line.endswith("\n"):
+                line = line[:-1]
+            if line.endswith("\r"):
+                line = line[:-1]
+            yield line.decode("utf-8")
+
+
+def format_csv_row(row, delimiter=u",", quote=u'"', null_value=u"null"):
+    """
+    format row as CSV line with minimal quoting of spark CSV writer (commons-csv)
+    """
+    fields = []
+    for index, value in enumerate(row):
+        value = null_value if value is None else java_string(value)
+        quoted = False
+        if not value:
+            # empty first field is quoted, otherwise empty line has no fields
+            quoted = index == 0
+        else:
+            c = value[0]
+            if index == 0 and (c < u"0" or u"9" < c < u"A" or u"Z" < c < u"a" or c > u"z"):
+                quoted = True
+            elif c <= u"#":
+                quoted = True
+            elif any(i in value for i in (u"\n", u"\r", quote, delimiter)):
+                quoted = True
+            elif value[-1] <= u" ":
+                quoted = True
+        fields.append(quote + value.replace(quote, quote * 2) + quote if quoted else value)
+    return delimiter.join(fields)
+
+
+@MethodsManager.register("scalableor/import", engine=ENGINE_LOCAL)
+def local_import(cmd, **kwargs):
+    """
+    import data in local table and split rows in column
+    """
+    rows = (tuple(line.split(cmd["separator"])) for line in read_lines(cmd["path"]))
+    if cmd.get("guessCellType") is True:
+        # first pass guesses types of columns
+        types = celltype.guess_types(tuple(line.split(cmd["separator"])) for line in read_lines(cmd["path"]))
+        rows = itertools.imap(celltype.row_parser(types), rows)
+    chunks = iter_batches(rows, CHUNK_SIZE)
+    first = next(chunks, [])
+    width = len(first[0]) if first else 0
+    return LocalTable([COLUMN_NAME % (i + 1) for i in range(width)], itertools.chain([first], chunks))
+
+
+@MethodsManager.register("scalableor/export", engine=ENGINE_LOCAL)
+def local_export(cmd, df=None, **kwargs):
+    """
+    export local table to CSV file
+    """
+    with io.open(cmd["path"], "w", encoding="utf-8", newline="") as output:
+        for row in df.rows():
+            output.write(format_csv_row(row, null_value=cmd.get("nullValue", u"null")) + u"\n")
+
+
+@MethodsManager.register("scalableor/sample", engine=ENGINE_LOCAL)
+def local_sample(cmd, df, **kwargs):
+    fraction, seed = cmd["fraction"], cmd.get("seed", SEED)
+    return LocalTable(df.columns, (sample_rows(chunk, fraction, seed, index) for index, chunk in enumerate(df.chunks)))
+
+
+@MethodsManager.register("core/column-rename", engine=ENGINE_LOCAL)
+def local_column_rename(cmd, df, **kwargs):
+    recon.rename_column(cmd["oldColumnName"], cmd["newColumnName"])
+    columns = [cmd["newColumnName"] if c == cmd["oldColumnName"] else c for c in df.columns]
+    return LocalTable(columns, df.chunks)
+
+
+@MethodsManager.register("core/column-removal", engine=ENGINE_LOCAL)
+def local_column_removal(cmd, df, **kwargs):
+    recon.remove_column(cmd["columnName"])
+    if cmd["columnName"] not in df.columns:
+        return df
+    pos = df.columns.index(cmd["columnName"])
+    return df.map(lambda e: e[:pos] + e[pos + 1:], df.columns[:pos] + df.columns[pos + 1:])
+
+
+@MethodsManager.register("core/column-move", engine=ENGINE_LOCAL)
+def local_column_move(cmd, df, **kwargs):
+    columns, replace_order = get_move_order(cmd, df.columns)
+    return df.map(lambda row: tuple(row[i] for i in replace_order), columns)
+
+
+@MethodsManager.register("core/row-removal", engine=ENGINE_LOCAL)
+def local_row_removal(cmd, df=None, **kwargs):
+    if command_uses_facet_count(cmd):
+        chunks = list(df.chunks)
+        cmd, counts = facet_count_tables(cmd, df.columns, chunks)
+        facet_filter = get_facet_filter(cmd, df, context={"facetCount": make_facet_count(counts)})
+        return LocalTable(df.columns, chunks).filter(lambda e: facet_filter(e) is False)
+    facet_filter = get_facet_filter(cmd, df)
+    return df.filter(lambda e: facet_filter(e) is False)
+
+
+@MethodsManager.register("core/column-split", engine=ENGINE_LOCAL)
+def local_column_split(cmd, df=None, **kwargs):
+    pos = df.columns.index(cmd["columnName"])
+    func = get_split_function(cmd, pos, lambda: df.head(20))
+    if func is None:
+        return df
+
+    result = df.map(func)
+    first = result.head(1)
+    result.columns = get_split_column_names(cmd, df.columns, len(first[0]) if first else len(df.columns))
+
+    if cmd.get("removeOriginalColumn") is True:
+        result = result.map(lambda e: e[:pos] + e[pos + 1:], result.columns[:pos] + result.columns[pos + 1:])
+    return result
+
+
+@MethodsManager.register("core/column-addition", engine=ENGINE_LOCAL)
+def local_column_addition(cmd, df, **kwargs):
+    pos = df.columns.index(cmd["baseColumnName"])
+    columns = df.columns[:pos + 1] + [cmd["newColumnName"]] + df.columns[pos + 1:]
+    return LocalTable(columns, ([e[:pos + 1] + (v,) + e[pos + 1:] for e, v in zip(chunk, values)]
+                                for chunk, values in map_expression(cmd, df, pos, False)))
+
+
+@MethodsManager.register("core/column-addition-by-fetching-urls", engine=ENGINE_LOCAL)
+def local_column_addition_by_fetching_urls(cmd, df, **kwargs):
+    """
+    create new column of responses of URLs (fetched by threads of this process)
+    """
+    pos = df.columns.index(cmd["baseColumnName"])
+    columns = df.columns[:pos + 1] + [cmd["newColumnName"]] + df.columns[pos + 1:]
+    cache_path = fetch.CACHE_PATH if cmd.get("cacheResponses", True) else None
+    rows = fetch.fetch_partition(cmd, df.rows(), df.columns, pos, get_facet_filter(cmd, df), failure.tracker(cmd),
+                                 recon.get_tables(), cache_path, fetch.HOST_CONNECTIONS)
+    return LocalTable(columns, iter_batches((e[:pos + 1] + (v,) + e[pos + 1:] for e, v in rows), CHUNK_SIZE))
+
+
+@MethodsManager.register("core/text-transform", engine=ENGINE_LOCAL)
+def local_text_transform(cmd, df, **kwargs):
+    pos = df.columns.index(cmd["columnName"])
+    return LocalTable(df.columns, ([e[:pos] + (v,) + e[pos + 1:] for e, v in zip(chunk, values)]
+                                   for chunk, values in map_expression(cmd, df, pos, True)))
+
+
+@MethodsManager.register("core/mass-edit", engine=ENGINE_LOCAL)
+def local_mass_edit(cmd, df, **kwargs):
+    return df.map(get_mass_edit_function(cmd, df.columns.index(cmd["columnName"])))
+
+
+@MethodsManager.register("scalableor/cluster", engine=ENGINE_LOCAL)
+def local_cluster(cmd, df, **kwargs):
+    """
+    cluster values of column by key collision (rows are kept in memory for next steps)
+    """
+    pos = df.columns.index(cmd["columnName"])
+    chunks = list(df.chunks)
+    counts = collections.Counter(e[pos] for chunk in chunks for e in chunk if e[pos])
+    keyer = get_cluster_keyer(cmd)
+    groups = {}
+    for value, count in counts.iteritems():
+        groups.setdefault(keyer(value), []).append((value, count))
+    write_clusters(cmd, groups.iteritems())
+    return LocalTable(df.columns, chunks)
+
+
+@MethodsManager.register("scalableor/profile", engine=ENGINE_LOCAL)
+def local_profile(cmd, df, **kwargs):
+    """
+    profile all columns in one pass (rows are kept in memory for next steps)
+    """
+    chunks = list(df.chunks)
+    precision, size = get_profile_params(cmd)
+    write_profile(cmd, df.columns, profile_rows(itertools.chain(*chunks), len(df.columns), precision, size))
+    return LocalTable(df.columns, chunks)
+
+
+@MethodsManager.register("core/multivalued-cell-split", engine=ENGINE_LOCAL)
+def local_multivalued_cell_split(cmd, df, **kwargs):
+    func = get_multivalued_split_function(cmd, df.columns.index(cmd["columnName"]))
+    return df.map_chunks(lambda chunk: [row for e in chunk for row in func(e)])
+
+
+@MethodsManager.register("core/multivalued-cell-join", engine=ENGINE_LOCAL)
+def local_multivalued_cell_join(cmd, df, **kwargs):
+    """
+    join multi-valued cells of records (records span chunks, rows are streamed)
+    """
+    rows = join_partition(df.rows(), df.columns.index(cmd["columnName"]), df.columns.index(cmd["keyColumnName"]),
+                          cmd["separator"])
+    return LocalTable(df.columns, iter_batches(rows, CHUNK_SIZE))
+
+
+@MethodsManager.register("core/recon", engine=ENGINE_LOCAL)
+def local_recon(cmd, df, **kwargs):
+    """
+    reconcile distinct values of column selected by facets (rows are kept in memory for next steps)
+    """
+    chunks = list(df.chunks)
+    facet_filter = get_facet_filter(cmd, df)
+    query_key = recon.query_function(cmd, df.columns)
+    keys = set(query_key(e) for e in itertools.chain(*chunks) if facet_filter(e))
+    keys.discard(None)
+    recon.register(cmd["columnName"], recon.ReconTable(cmd, dict(recon.reconcile_keys(cmd["config"], keys))))
+    return LocalTable(df.columns, chunks)
+
+
+@MethodsManager.register("core/fill-down", engine=ENGINE_LOCAL)
+def local_fill_down(cmd, df, **kwargs):
+    """
+    dummy function
+    """
+    return df
@@ -7,6 +7,11 @@ from constant import NAME
 logger = logging.getLogger(NAME.replace(".", "-"))
 
 
+def set_python_logger(verbosity=False):
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+                        level=logging.DEBUG if verbosity else logging.INFO)
+
+
 def set_logger(sc, verbosity=False):
     global logger
     log4j = sc._jvm.org.apache.log4j
@@ -4,37 +4,39 @@ from functools import wraps
 
 import log
 
+from constant import ENGINE_SPARK
+
 
 class MethodsManager(object):
     fn = {}
 
     @staticmethod
-    def register(name):
+    def register(name, engine=ENGINE_SPARK):
         def register_(func):
-            MethodsManager.add(name, func)
+            MethodsManager.add(name, func, engine=engine)
             return func
 
         return register_
 
     @staticmethod
-    def add(name, func):
-        MethodsManager.fn[name] = func
+    def add(name, func, engine=ENGINE_SPARK):
+        MethodsManager.fn.setdefault(engine, {})[name] = func
 
     @staticmethod
-    def has(name):
-        return name in MethodsManager.fn
+    def has(name, engine=ENGINE_SPARK):
+        return name in MethodsManager.fn.get(engine, {})
 
     @staticmethod
-    def call(cmd, df=None, rdd=None, sc=None):
+    def call(cmd, df=None, rdd=None, sc=None, engine=ENGINE_SPARK):
         name = cmd["op"]
-        if MethodsManager.has(name):
-            return MethodsManager.get(name)(cmd, df=df, rdd=rdd, sc=sc)
+        if MethodsManager.has(name, engine=engine):
+            return MethodsManager.get(name, engine=engine)(cmd, df=df, rdd=rdd, sc=sc)
         else:
-            raise NotImplementedError("Method '%s' doesn't found" % name)
+            raise NotImplementedError("Method '%s' doesn't found (engine: %s)" % (name, engine))
 
     @staticmethod
-    def get(name):
-        return MethodsManager.fn[name]
+    def get(name, engine=ENGINE_SPARK):
+        return MethodsManager.fn[engine][name]
 
 
 class VerifiersManager(object):
@@ -68,3 +70,31 @@ class VerifiersManager(object):
     @staticmethod
     def get(name):
         return VerifiersManager.fn[name]
+
+
+class PlannersManager(object):
+    fn = {}
+
+    @staticmethod
+    def register(name):
+        def register_(func):
+            PlannersManager.add(name, func)
+            return func
+
+        return register_
+
+    @staticmethod
+    def add(name, func):
+        PlannersManager.fn[name] = func
+
+    @staticmethod
+    def has(name):
+        return name in PlannersManager.fn
+
+    @staticmethod
+    def call(cmd, columns, errors):
+        return PlannersManager.get(cmd["op"])(cmd, columns, errors)
+
+    @staticmethod
+    def get(name):
+        return PlannersManager.fn[name]
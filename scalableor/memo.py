@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Memoization of pure GREL builtins
+
+Expression steps over the same rows run together (narrow steps of a spark stage are pipelined in one
+python worker), so steps adding several columns from the same cell call e.g. `value.parseJson()` or
+`value.split("|")` on the same input once per step. Builtins registered as pure return the same result for
+the same arguments without side effects, so their results are reused by every step and sub-expression with
+equal arguments (function and method form share results).
+
+Results are kept only in a scope (a partition of pipelined steps or a batch of rows), which is opened per
+thread and discarded when its outermost user ends, so nothing is kept between jobs. Outside a scope builtins
+are called directly. Mutable results (lists, parsed JSON) are copied for every caller, since jython
+expressions may modify them. The memo of every builtin keeps two generations of results: when the current
+generation is full, it replaces the previous one, so results of the rows in flight are kept while memory
+stays bounded.
+"""
+
+import marshal
+import threading
+
+from contextlib import contextmanager
+
+# maximal count of results per generation of builtin
+GENERATION_SIZE = 4096
+COUNTERS = ("hits", "misses")
+# name -> hit/miss counters of pure builtin (summed over scopes of this process)
+PURE_BUILTINS = {}
+# memos of open scope of thread: name -> memo
+STATE = threading.local()
+
+
+class Memo(object):
+    """
+    this class keeps results of pure function in two generations with hit/miss counters
+    """
+
+    def __init__(self, size=GENERATION_SIZE, counters=None):
+        self.size = size
+        self.current = {}
+        self.previous = {}
+        self.counters = dict.fromkeys(COUNTERS, 0) if counters is None else counters
+
+    def call(self, func, args):
+        # equal arguments of different types (e.g. 1 and 1.0) have different results
+        key = args + tuple(type(i) for i in args)
+        try:
+            if key in self.current:
+                self.counters["hits"] += 1
+                return self.current[key]
+        except TypeError:
+            # unhashable arguments
+            return func(*args)
+        if key in self.previous:
+            self.counters["hits"] += 1
+            result = self.previous[key]
+        else:
+            self.counters["misses"] += 1
+            result = func(*args)
+        if len(self.current) >= self.size:
+            self.previous, self.current = self.current, {}
+        self.current[key] = result
+        return result
+
+    def clear(self):
+        self.current, self.previous = {}, {}
+
+
+@contextmanager
+def scope():
+    """
+    keep results of pure builtins until the outermost scope of thread ends (nested scopes of pipelined
+    steps share results)
+    """
+    outermost = getattr(STATE, "memos", None) is None
+    if outermost:
+        STATE.memos = {}
+    try:
+        yield
+    finally:
+        if outermost:
+            STATE.memos = None
+
+
+def copy_list(result):
+    """
+    copy GREL list (or None) returned by builtin, items are immutable
+    """
+    return result if result is None else type(result)(result)
+
+
+def copy_json(result):
+    """
+    copy parsed JSON value (marshal is faster than parsing again and deep copy)
+    """
+    return marshal.loads(marshal.dumps(result)) if isinstance(result, (dict, list)) else result
+
+
+def pure(name, copy=None):
+    """
+    register function as pure builtin and memoize its results in open scope (decorator)
+
+    :param name:    name of GREL builtin
+    :param copy:    function copying mutable result for every caller
+    """
+
+    def decorator(func):
+        counters = PURE_BUILTINS.setdefault(name, dict.fromkeys(COUNTERS, 0))
+
+        def memoized(*args):
+            memos = getattr(STATE, "memos", None)
+            if memos is None:
+                return func(*args)
+            memo = memos.get(name)
+            if memo is None:
+                memo = memos[name] = Memo(counters=counters)
+            result = memo.call(func, args)
+            return result if copy is None else copy(result)
+
+        memoized.__name__ = func.__name__
+        memoized.__doc__ = func.__doc__
+        return memoized
+
+    return decorator
+
+
+def is_pure(name):
+    return name in PURE_BUILTINS
+
+
+def stats():
+    """
+    return counters of memos of this process summed over builtins
+    """
+    return dict((c, sum(m[c] for m in PURE_BUILTINS.values())) for c in COUNTERS)
@@ -3,17 +3,26 @@
 import cStringIO
 import csv
 import os
-
-import re
 import tempfile
 
-from pyspark.sql import SQLContext
+import log
 
+from scalableor import celltype, failure, fetch, memo, pattern, recon
+from scalableor.broadcast import log_closure, share
+from scalableor.celltype import cell_text, java_string
+from scalableor.cluster import get_cluster_keyer, write_clusters
 from scalableor.constant import COLUMN_NAME
 from scalableor.context import eval_expression, to_grel_object
+from scalableor.cross import evaluate as evaluate_cross, uses_cross
 from scalableor.manager import MethodsManager
 
 from scalableor.facet import get_facet_filter
+from scalableor.facetcount import command_uses_facet_count, evaluate as evaluate_facet_count, \
+    remove_rows as remove_facet_count_rows
+from scalableor.partition import read_input, before_export
+from scalableor.profiling import get_profile_params, profile_rows, write_profile, merge as merge_profiles
+from scalableor.sample import SEED
+from scalableor.vectorized import arrow_column, evaluate_partitions
 
 
 @MethodsManager.register("scalableor/import")
@@ -24,9 +33,32 @@ def sc_or_import(cmd, sc=None, **kwargs):
     :param cmd:         import parameters
     :param sc:          spark context object
     """
-    rdd = sc.textFile(cmd["path"])
-    rdd_splitted = rdd.map(lambda el: el.split(cmd["separator"]))
-    sql_context = SQLContext(sc)
+    from pyspark.sql import SQLContext
+
+    return split_lines(read_input(cmd, sc), cmd["separator"], SQLContext(sc), cmd.get("guessCellType") is True)
+
+
+def split_lines(rdd, separator, sql_context, guess_cell_type=False):
+    """
+    split lines in columns and create data frame with default column names
+
+    :param rdd:             rdd of lines
+    :param separator:       column separator
+    :param sql_context:     spark SQL context
+    :param guess_cell_type: store numbers, booleans and dates as spark types (additional pass over data)
+    """
+    rdd_splitted = rdd.map(lambda el: el.split(separator))
+    if guess_cell_type:
+        from pyspark import StorageLevel
+
+        # split rows are kept for second pass
+        rdd_splitted.persist(StorageLevel.MEMORY_AND_DISK)
+        types = celltype.guess_rdd(rdd_splitted)
+        names = [COLUMN_NAME % (i + 1) for i in range(len(types))]
+        log.logger.info("guessCellType: %s" % ", ".join("%s: %s" % i for i in zip(names, types)))
+        return sql_context.createDataFrame(rdd_splitted.map(celltype.row_parser(types)),
+                                           celltype.spark_schema(types, names))
+
     df = sql_context.createDataFrame(rdd_splitted)
 
     for i in range(len(df.columns)):
@@ -35,15 +67,20 @@ def sc_or_import(cmd, sc=None, **kwargs):
 
 
 @MethodsManager.register("scalableor/export")
-def sc_or_export(cmd, df=None, **kwargs):
+def sc_or_export(cmd, df=None, sc=None, **kwargs):
     """
     export data to file system
 
     :param cmd:         export parameters
     :param df:          spark data frame
+    :param sc:          spark context object
     """
+    df = before_export(cmd, df, sc)
     tmp = tempfile.mkdtemp() + ".scalable.or"
-    df.write.format("com.databricks.spark.csv").save(tmp)
+    writer = df.write.format("com.databricks.spark.csv")
+    if "nullValue" in cmd:
+        writer = writer.option("nullValue", cmd["nullValue"])
+    writer.save(tmp)
 
     with open(cmd["path"], "w") as output:
         for fpath in sorted(os.listdir(tmp)):
@@ -53,11 +90,20 @@ def sc_or_export(cmd, df=None, **kwargs):
                         output.write(line)
 
 
+@MethodsManager.register("scalableor/sample")
+def sc_or_sample(cmd, df, **kwargs):
+    """
+    keep seeded sample of rows (every partition is sampled with its own seed)
+    """
+    return df.sample(False, cmd["fraction"], cmd.get("seed", SEED))
+
+
 @MethodsManager.register("core/column-rename")
 def core_column_rename(cmd, df, **kwargs):
     """
     rename column
     """
+    recon.rename_column(cmd["oldColumnName"], cmd["newColumnName"])
     return df.withColumnRenamed(cmd["oldColumnName"], cmd["newColumnName"])
 
 
@@ -66,57 +112,68 @@ def core_column_removal(cmd, df, **kwargs):
     """
     remove column by name
     """
+    recon.remove_column(cmd["columnName"])
     return df.drop(cmd["columnName"])
 
 
-@MethodsManager.register("core/column-move")
-def core_column_move(cmd, df, **kwargs):
+def get_move_order(cmd, columns):
     """
-    move column to index by name
+    return column names and order of row values after column move
     """
-    columns = df.columns[:]
+    columns = columns[:]
     current_index = columns.index(cmd["columnName"])
     columns.insert(cmd["index"], columns.pop(current_index))
 
     replace_order = [i for i in range(len(columns))]
     replace_order.insert(cmd["index"], replace_order.pop(current_index))
+    return columns, replace_order
+
+
+@MethodsManager.register("core/column-move")
+def core_column_move(cmd, df, **kwargs):
+    """
+    move column to index by name
+    """
+    columns, replace_order = get_move_order(cmd, df.columns)
 
-    rdd_moved = df.rdd.map(lambda row: [row[i] for i in replace_order])
+    rdd_moved = df.rdd.map(log_closure(cmd, lambda row: [row[i] for i in replace_order]))
     return df.sql_ctx.createDataFrame(rdd_moved, columns)
 
 
 @MethodsManager.register("core/row-removal")
-def core_row_removal(cmd, df=None, **kwargs):
+def core_row_removal(cmd, df=None, sc=None, **kwargs):
     """
     remove rows selected by facet filter
     """
-    facet_filter = get_facet_filter(cmd, df)
-    result = df.rdd.filter(lambda e: facet_filter(e) is False)
+    if command_uses_facet_count(cmd):
+        return df.sql_ctx.createDataFrame(remove_facet_count_rows(cmd, df, sc), df.columns)
+    facet_filter = get_facet_filter(cmd, df, sc)
+    result = df.rdd.filter(log_closure(cmd, lambda e: facet_filter(e) is False))
     return df.sql_ctx.createDataFrame(result, df.columns)
 
 
-@MethodsManager.register("core/column-split")
-def core_column_split(cmd, df=None, **kwargs):
-    """
-    split column by separator or field length
+def get_split_function(cmd, pos, head):
     """
-    column_names = df.columns[:]
-    pos = column_names.index(cmd["columnName"])
-
-    before_columns = column_names[:pos]
-    after_columns = column_names[pos + 1:]
+    generate row callback of column split
 
+    :param cmd:         split command
+    :param pos:         position of split column
+    :param head:        callback returning first rows of data
+    :return: row callback or None if column isn't split
+    """
     if "fieldLengths" in cmd:
         func = lambda e: \
             e[:pos + 1] + \
-            tuple(to_grel_object(e[pos]).splitByLengths(*cmd["fieldLengths"])) + \
+            tuple(to_grel_object(cell_text(e[pos])).splitByLengths(*cmd["fieldLengths"])) + \
             e[pos + 1:]
     else:
+        regex = pattern.compile(cmd["separator"]) if cmd.get("regex") is True else None
+
         # max column logic
         if "maxColumns" in cmd:
             max_column = cmd["maxColumns"]
             if max_column == 1:
-                return df
+                return None
             if max_column > 1:
                 max_column -= 1
         else:
@@ -125,12 +182,11 @@ def core_column_split(cmd, df=None, **kwargs):
         # if max column doesn't defined analyse first 20 column und select maximal column count
         if max_column < 1:
             max_column = 2
-            for row in df.head(20):
-                if hasattr(row[pos], "split"):
-                    if cmd.get("regex") is True:
-                        max_column = max(len(re.split(cmd["separator"], row[pos])), max_column)
-                    else:
-                        max_column = max(len(row[pos].split(cmd["separator"])), max_column)
+            for row in head():
+                if cmd.get("regex") is True:
+                    max_column = max(len(regex.split(cell_text(row[pos]))), max_column)
+                else:
+                    max_column = max(len(cell_text(row[pos]).split(cmd["separator"])), max_column)
             max_column -= 1
 
         # generate split callback
@@ -138,23 +194,47 @@ def core_column_split(cmd, df=None, **kwargs):
         if cmd.get("regex") is True:
             func = lambda e: \
                 e[:pos + 1] + \
-                tuple((re.split(cmd["separator"], e[pos], max_column) + add_to)[:max_column + 1]) + \
+                tuple((regex.split(cell_text(e[pos]), max_column) + add_to)[:max_column + 1]) + \
                 e[pos + 1:]
         else:
             func = lambda e: \
                 e[:pos + 1] + \
-                tuple((e[pos].split(cmd["separator"], max_column) + add_to)[:max_column + 1]) + \
+                tuple((cell_text(e[pos]).split(cmd["separator"], max_column) + add_to)[:max_column + 1]) + \
                 e[pos + 1:]
+    return func
 
-    result = df.sql_ctx.createDataFrame(df.rdd.map(func))
 
-    # generate new column names
-    new_column_names = (
-        before_columns +
+def get_split_column_names(cmd, columns, width):
+    """
+    generate column names after column split
+
+    :param cmd:         split command
+    :param columns:     column names before split
+    :param width:       column count after split
+    """
+    pos = columns.index(cmd["columnName"])
+    return (
+        columns[:pos] +
         [cmd["columnName"]] +
         ["%s %s" % (
-            cmd["columnName"], i + 1) for i in range(len(result.columns) - len(df.columns))] +
-        after_columns)
+            cmd["columnName"], i + 1) for i in range(width - len(columns))] +
+        columns[pos + 1:])
+
+
+@MethodsManager.register("core/column-split")
+def core_column_split(cmd, df=None, **kwargs):
+    """
+    split column by separator or field length
+    """
+    pos = df.columns.index(cmd["columnName"])
+    func = get_split_function(cmd, pos, lambda: df.head(20))
+    if func is None:
+        return df
+
+    result = df.sql_ctx.createDataFrame(df.rdd.map(log_closure(cmd, func)))
+
+    # generate new column names
+    new_column_names = get_split_column_names(cmd, df.columns, len(result.columns))
 
     for index, name in enumerate(new_column_names):
         result = result.withColumnRenamed("_%d" % (index + 1), name)
@@ -164,74 +244,395 @@ def core_column_split(cmd, df=None, **kwargs):
     return result
 
 
+def get_row_function(cmd, df, position, build, otherwise, sc=None):
+    """
+    generate partition callback (split, rows) evaluating expression of command for every row separately
+    (execution "row")
+
+    :param cmd:         OpenRefine command
+    :param df:          spark data frame
+    :param position:    position of base column
+    :param build:       callback (row, value) returning new row
+    :param otherwise:   callback returning value of row not selected by facets
+    :param sc:          spark context (large expressions are broadcast)
+    """
+    names = df.columns[:]
+    facet_filter = get_facet_filter(cmd, df, sc)
+    exp = share(cmd["expression"], sc)
+    on_error = cmd.get("onError")
+    tracker = failure.tracker(cmd, sc)
+    recons = share(recon.get_tables(), sc)
+
+    def evaluate_row(e, failures):
+        if not facet_filter(e):
+            return build(e, otherwise(e))
+        try:
+            value = eval_expression(e, position, exp(), names=names, recons=recons())
+        except Exception as error:
+            if on_error is None:
+                raise
+            failures.add(e, error)
+            value = failure.fallback(on_error, e[position], error)
+        return build(e, value)
+
+    def evaluate_partition(split, rows):
+        failures = failure.Failures()
+        # pipelined steps of partition share results of pure builtins
+        with memo.scope():
+            for e in rows:
+                yield evaluate_row(e, failures)
+        failure.track(tracker, split, failures)
+
+    return evaluate_partition
+
+
 @MethodsManager.register("core/column-addition")
-def core_column_addition(cmd, df, **kwargs):
+def core_column_addition(cmd, df, sc=None, **kwargs):
     """
     create new column based on existing one
     """
-    names = df.columns[:]
     position_of_column = df.columns.index(cmd["baseColumnName"])
 
     before_columns = df.columns[:position_of_column + 1]
     after_columns = df.columns[position_of_column + 1:]
 
-    facet_fitler = get_facet_filter(cmd, df)
-
-    # generate spark callback
-    result_rdd = df.rdd.map(lambda e: (
-        e[:position_of_column + 1] +
-        ((eval_expression(e,
-                          position_of_column,
-                          cmd["expression"],
-                          names=names),) if facet_fitler(e) else ("",)) +
-        e[position_of_column + 1:]))
+    if cmd.get("execution") == "arrow" and not uses_cross(cmd["expression"]) and not command_uses_facet_count(cmd):
+        column = arrow_column(cmd, df, position_of_column, lambda e: "", sc)
+        return df.select([df[i] for i in before_columns] +
+                         [column.alias(cmd["newColumnName"])] +
+                         [df[i] for i in after_columns])
+
+    build = lambda e, value: e[:position_of_column + 1] + (value,) + e[position_of_column + 1:]
+
+    if uses_cross(cmd["expression"]):
+        # rows of other projects are joined instead of searched per row
+        result_rdd = evaluate_cross(cmd, df, position_of_column, build, lambda e: "", sc)
+    elif command_uses_facet_count(cmd):
+        # counts of whole columns are computed before the step
+        result_rdd = evaluate_facet_count(cmd, df, position_of_column, build, lambda e: "", sc)
+    elif cmd.get("execution") == "row":
+        result_rdd = df.rdd.mapPartitionsWithIndex(log_closure(cmd, get_row_function(cmd, df, position_of_column, build,
+                                                                  lambda e: "", sc)))
+    else:
+        result_rdd = evaluate_partitions(cmd, df, position_of_column, build, lambda e: "", sc)
 
     return df.sql_ctx.createDataFrame(
         result_rdd,
         before_columns + [cmd["newColumnName"]] + after_columns)
 
 
+@MethodsManager.register("core/column-addition-by-fetching-urls")
+def core_column_addition_by_fetching_urls(cmd, df, sc=None, **kwargs):
+    """
+    create new column of responses of URLs, every partition fetches its distinct URLs over pooled connections
+    """
+    names = df.columns[:]
+    position = names.index(cmd["baseColumnName"])
+    facet_filter = get_facet_filter(cmd, df, sc)
+    tracker = failure.tracker(cmd, sc)
+    shared_recons = share(recon.get_tables(), sc)
+    cache_path = fetch.CACHE_PATH if cmd.get("cacheResponses", True) else None
+    connections = fetch.HOST_CONNECTIONS
+
+    def fetch_rows(split, rows):
+        failures = failure.Failures()
+        for e, value in fetch.fetch_partition(cmd, rows, names, position, facet_filter, failures, shared_recons(),
+                                              cache_path, connections):
+            yield e[:position + 1] + (value,) + e[position + 1:]
+        failure.track(tracker, split, failures)
+
+    return df.sql_ctx.createDataFrame(df.rdd.mapPartitionsWithIndex(log_closure(cmd, fetch_rows)),
+                                      names[:position + 1] + [cmd["newColumnName"]] + names[position + 1:])
+
+
 @MethodsManager.register("core/text-transform")
-def core_text_transform(cmd, df, **kwargs):
+def core_text_transform(cmd, df, sc=None, **kwargs):
     """
     transform row values of selected column
     """
-    names = df.columns[:]
     pos_of_column = df.columns.index(cmd["columnName"])
-    facet_fitler = get_facet_filter(cmd, df)
 
-    result_rdd = df.rdd.map(lambda e: (
-        e[:pos_of_column] +
-        ((eval_expression(e,
-                          pos_of_column,
-                          cmd["expression"],
-                          names=names),) if facet_fitler(e) else (e[pos_of_column],)) +
-        e[pos_of_column + 1:]))
+    if cmd.get("execution") == "arrow" and not uses_cross(cmd["expression"]) and not command_uses_facet_count(cmd):
+        column = arrow_column(cmd, df, pos_of_column, lambda e: e[pos_of_column], sc)
+        return df.withColumn(cmd["columnName"], column)
+
+    build = lambda e, value: e[:pos_of_column] + (value,) + e[pos_of_column + 1:]
+
+    if uses_cross(cmd["expression"]):
+        result_rdd = evaluate_cross(cmd, df, pos_of_column, build, lambda e: e[pos_of_column], sc)
+    elif command_uses_facet_count(cmd):
+        result_rdd = evaluate_facet_count(cmd, df, pos_of_column, build, lambda e: e[pos_of_column], sc)
+    elif cmd.get("execution") == "row":
+        result_rdd = df.rdd.mapPartitionsWithIndex(log_closure(cmd, get_row_function(cmd, df, pos_of_column, build,
+                                                                  lambda e: e[pos_of_column], sc)))
+    else:
+        result_rdd = evaluate_partitions(cmd, df, pos_of_column, build, lambda e: e[pos_of_column], sc)
 
     return df.sql_ctx.createDataFrame(result_rdd, df.columns)
 
 
-@MethodsManager.register("core/mass-edit")
-def core_mass_edit(cmd, df, **kwargs):
+def get_edit_map(cmd):
     """
-    change row values of selected column using filter
+    return map of old to new values of mass edit (first matching edit wins)
     """
-    pos_of_column = df.columns.index(cmd["columnName"])
+    edit_map = {}
+    for edit in cmd["edits"]:
+        for value in edit["from"]:
+            edit_map.setdefault(cell_text(value), edit["to"])
+    return edit_map
+
+
+def get_mass_edit_function(cmd, pos_of_column, sc=None):
+    """
+    generate row callback of mass edit
+
+    :param cmd:             mass edit command
+    :param pos_of_column:   position of edited column
+    :param sc:              spark context (large edit maps are broadcast)
+    """
+    edit_map = share(get_edit_map(cmd), sc)
 
     def core_mass_edit_callback(e):
-        current_value = e[pos_of_column]
-        new_value = None
-        for edit in cmd["edits"]:
-            if current_value in edit["from"]:
-                new_value = edit["to"]
-                break
+        # typed cells (guessCellType) are edited as text, the column becomes a string column
+        current_value = cell_text(e[pos_of_column])
+        new_value = edit_map().get(current_value)
         if new_value is None:
             new_value = current_value
         return (e[:pos_of_column] +
                 (new_value,) +
                 e[pos_of_column + 1:])
 
-    return df.sql_ctx.createDataFrame(df.rdd.map(core_mass_edit_callback), df.columns)
+    return core_mass_edit_callback
+
+
+@MethodsManager.register("core/mass-edit")
+def core_mass_edit(cmd, df, sc=None, **kwargs):
+    """
+    change row values of selected column using filter
+    """
+    pos_of_column = df.columns.index(cmd["columnName"])
+    func = log_closure(cmd, get_mass_edit_function(cmd, pos_of_column, sc))
+    return df.sql_ctx.createDataFrame(df.rdd.map(func), df.columns)
+
+
+@MethodsManager.register("scalableor/cluster")
+def sc_or_cluster(cmd, df, **kwargs):
+    """
+    cluster values of column by key collision and write cluster report or mass edit program,
+    data frame isn't changed
+    """
+    from operator import add
+
+    pos_of_column = df.columns.index(cmd["columnName"])
+    keyer = get_cluster_keyer(cmd)
+    groups = (df.rdd.map(lambda e: e[pos_of_column])
+              .filter(lambda v: v)
+              .map(lambda v: (v, 1))
+              .reduceByKey(add)
+              .map(log_closure(cmd, lambda vc: (keyer(vc[0]), vc)))
+              .groupByKey()
+              .filter(lambda kv: len(kv[1]) > 1)
+              .mapValues(list)
+              .collect())
+    write_clusters(cmd, groups)
+    return df
+
+
+@MethodsManager.register("scalableor/profile")
+def sc_or_profile(cmd, df, **kwargs):
+    """
+    profile all columns in one pass (partition profiles are merged) and write profile report,
+    data frame isn't changed
+    """
+    width = len(df.columns)
+    precision, size = get_profile_params(cmd)
+    profiles = (df.rdd.mapPartitions(log_closure(cmd, lambda rows: [profile_rows(rows, width, precision, size)]))
+                .treeReduce(merge_profiles))
+    write_profile(cmd, df.columns, profiles)
+    return df
+
+
+def is_blank(value):
+    return value is None or value == ""
+
+
+def blank_of(value):
+    """
+    return blank cell of the same kind as value (empty string, null of typed cell)
+    """
+    return "" if value is None or isinstance(value, basestring) else None
+
+
+def get_multivalued_split_function(cmd, pos):
+    """
+    generate row callback of multi-valued cell split, returning list of rows: first value stays in row,
+    every next value is a new row with blank other cells
+
+    :param cmd:     multi-valued cell split command
+    :param pos:     position of split column
+    """
+    if cmd.get("mode") == "lengths" or "fieldLengths" in cmd:
+        lengths = cmd["fieldLengths"]
+        split = lambda value: [v for v in to_grel_object(value).splitByLengths(*lengths) if v] or [value]
+    elif cmd.get("mode") == "regex" or cmd.get("regex") is True:
+        regex = pattern.compile(cmd["separator"])
+        split = lambda value: regex.split(value)
+    else:
+        separator = cmd["separator"]
+        split = lambda value: value.split(separator)
+
+    def core_multivalued_cell_split_callback(e):
+        if is_blank(e[pos]):
+            return [e]
+        # typed cells (guessCellType) are split as text
+        values = split(cell_text(e[pos]))
+        blanks = tuple(blank_of(v) for v in e)
+        return [e[:pos] + (values[0],) + e[pos + 1:]] + [blanks[:pos] + (v,) + blanks[pos + 1:] for v in values[1:]]
+
+    return core_multivalued_cell_split_callback
+
+
+@MethodsManager.register("core/multivalued-cell-split")
+def core_multivalued_cell_split(cmd, df, **kwargs):
+    """
+    split multi-valued cells of column into rows (order of rows is kept by flatMap of partitions)
+    """
+    func = get_multivalued_split_function(cmd, df.columns.index(cmd["columnName"]))
+    return df.sql_ctx.createDataFrame(df.rdd.flatMap(log_closure(cmd, lambda e: func(tuple(e)))), df.columns)
+
+
+def join_record(record, pos, separator, extra=()):
+    """
+    join non-blank values of column of record (list of rows) into its first row, the values are removed
+    from other rows and rows which become blank are removed
+
+    :param extra:   values of rows of record in next partitions
+    :return: list of rows
+    """
+    values = [java_string(r[pos]) for r in record if not is_blank(r[pos])] + list(extra)
+    head = record[0]
+    if values:
+        head = head[:pos] + (separator.join(values),) + head[pos + 1:]
+    rest = [r[:pos] + (blank_of(r[pos]),) + r[pos + 1:] for r in record[1:]]
+    return [head] + [r for r in rest if not all(is_blank(v) for v in r)]
+
+
+def join_partition(rows, pos, key_pos, separator, first=True, extra=()):
+    """
+    join multi-valued cells of records of partition: a record starts at row with non-blank key cell,
+    rows before first record start of partition belong to record of previous partitions
+
+    :param rows:        iterable of rows
+    :param pos:         position of joined column
+    :param key_pos:     position of key column
+    :param separator:   separator of joined values
+    :param first:       first row of partition starts record (first partition with rows)
+    :param extra:       values of rows of last record in next partitions
+    :return: iterator of rows
+    """
+    record = []
+    leading = not first
+    for row in rows:
+        row = tuple(row)
+        if first or not is_blank(row[key_pos]):
+            first = leading = False
+            if record:
+                for joined in join_record(record, pos, separator):
+                    yield joined
+            record = [row]
+        elif leading:
+            # value is joined into record of previous partition
+            row = row[:pos] + (blank_of(row[pos]),) + row[pos + 1:]
+            if not all(is_blank(v) for v in row):
+                yield row
+        else:
+            record.append(row)
+    if record:
+        for joined in join_record(record, pos, separator, extra):
+            yield joined
+
+
+def leading_values(rows, pos, key_pos, first=False):
+    """
+    return summary of partition: flag of record start in partition, non-blank values of column of
+    rows before first record start and flag of rows in partition
+    """
+    values = []
+    has_rows = False
+    for row in rows:
+        has_rows = True
+        if first or not is_blank(row[key_pos]):
+            return [(True, values, True)]
+        if not is_blank(row[pos]):
+            values.append(java_string(row[pos]))
+    return [(False, values, has_rows)]
+
+
+def record_start(summaries):
+    """
+    return index of first partition with rows, its first row starts the first record (None: no rows)
+
+    :param summaries:   list of summaries of partitions (see leading_values)
+    """
+    return next((index for index, summary in enumerate(summaries) if summary[2]), None)
+
+
+def get_record_extras(summaries):
+    """
+    assign values of leading rows of partitions to last record start of previous partitions
+
+    :param summaries:   list of summaries of partitions (see leading_values)
+    :return: dict index of partition -> values joined into its last record
+    """
+    extras = {}
+    last = None
+    start = record_start(summaries)
+    for index, (has_start, values, has_rows) in enumerate(summaries):
+        if index == start:
+            # leading rows of first partition with rows belong to its first record
+            has_start, values = True, []
+        if last is not None:
+            extras[last].extend(values)
+        if has_start:
+            last = index
+            extras[last] = []
+    return extras
+
+
+@MethodsManager.register("core/multivalued-cell-join")
+def core_multivalued_cell_join(cmd, df, sc=None, **kwargs):
+    """
+    join multi-valued cells of records into their first rows, records spanning partition boundaries
+    are joined using summaries of partitions (one additional pass, no shuffle)
+    """
+    pos = df.columns.index(cmd["columnName"])
+    key_pos = df.columns.index(cmd["keyColumnName"])
+    separator = cmd["separator"]
+
+    summaries = df.rdd.mapPartitions(lambda rows: leading_values(rows, pos, key_pos)).collect()
+    extras = share(get_record_extras(summaries), sc)
+    # leading partitions may be empty (e.g. after row removal)
+    start = record_start(summaries)
+
+    result = df.rdd.mapPartitionsWithIndex(log_closure(cmd, lambda index, rows: join_partition(
+        rows, pos, key_pos, separator, index == start, extras().get(index, ()))))
+    return df.sql_ctx.createDataFrame(result, df.columns)
+
+
+@MethodsManager.register("core/recon")
+def core_recon(cmd, df, sc=None, **kwargs):
+    """
+    reconcile distinct values of column selected by facets, partitions of queries are sent by executors in
+    batched requests; results are registered for next steps, data frame isn't changed
+    """
+    facet_filter = get_facet_filter(cmd, df, sc)
+    query_key = recon.query_function(cmd, df.columns[:])
+    config, cache_path = cmd["config"], recon.CACHE_PATH
+    results = (df.rdd.filter(facet_filter).map(query_key).filter(lambda key: key is not None).distinct()
+               .mapPartitions(log_closure(cmd, lambda keys: recon.reconcile_keys(config, keys, cache_path)))
+               .collect())
+    recon.register(cmd["columnName"], recon.ReconTable(cmd, dict(results)))
+    return df
 
 
 @MethodsManager.register("core/fill-down")
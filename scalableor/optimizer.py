@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Rule-based optimizer of OpenRefine program
+
+Programs recorded by analysts are rewritten before the run, the result of the program stays the same:
+    - no-op steps are removed (rename to the same name, move to the same position, ...)
+    - runs of consecutive renames and moves are collapsed (renames which are undone disappear)
+    - dead steps are removed: steps writing only columns which are removed before they are read
+    - row removals are moved ahead of expression steps, which write no column read by the removal
+Rewriting uses planners of commands (columns read/written by every step), so steps with unknown
+columns are never moved or removed. A dropped or moved expression step doesn't fail on removed rows.
+"""
+
+import log
+
+from scalableor.manager import PlannersManager
+from scalableor.plan import build_plan, expression_columns, step_info
+
+RENAME = "core/column-rename"
+MOVE = "core/column-move"
+REMOVAL = "core/column-removal"
+ROW_REMOVAL = "core/row-removal"
+# steps whose only effect is writing their columns
+PURE_OPS = ("core/column-addition", "core/text-transform", "core/mass-edit", "core/column-addition-by-fetching-urls")
+# steps creating new column
+CREATING_OPS = ("core/column-addition", "core/column-addition-by-fetching-urls")
+# steps which row removals are moved ahead of
+PUSHDOWN_OPS = PURE_OPS + (MOVE,)
+MAX_ROUNDS = 100
+
+
+def analyze(or_program):
+    """
+    plan every step of program
+
+    :return: list of step infos (see plan.step_info) with command, columns before step and 'known' flag
+             (columns are known and step has no errors)
+    """
+    steps = []
+    columns = []
+    exact = False
+    for cmd in or_program:
+        errors = []
+        if PlannersManager.has(cmd["op"]):
+            info = PlannersManager.call(cmd, columns, errors)
+        else:
+            info = step_info(columns, row_local=False, exact=False)
+            info["reads"] = None
+        if info["exact"] is not None:
+            exact = info["exact"]
+        info.update({"cmd": cmd, "before": columns, "known": bool(exact) and not errors})
+        columns = info["columns"]
+        steps.append(info)
+    return steps
+
+
+def step_reads(step):
+    """
+    return column names read by step including columns of facet expressions (None: all columns)
+    """
+    if not step["known"] or step["reads"] is None:
+        return None
+    reads = list(step["reads"])
+    for facet in step["cmd"].get("engineConfig", {}).get("facets", []):
+        if facet.get("expression") and facet.get("columnName") in step["before"]:
+            reads += expression_columns(facet["expression"], facet["columnName"], step["before"])
+    return reads
+
+
+def remove_noops(or_program):
+    return [s["cmd"] for s in analyze(or_program) if not (s["known"] and s["noop"])]
+
+
+def collapse_run(run):
+    """
+    rewrite run of consecutive renames and moves to moves (original names) followed by renames
+
+    :param run:     step infos of run
+    :return: list of commands, None if run can't be shortened
+    """
+    start, final = run[0]["before"], run[-1]["columns"]
+    if start == final:
+        return []
+
+    original = dict((c, c) for c in start)
+    moves = []
+    for step in run:
+        cmd = step["cmd"]
+        if cmd["op"] == RENAME:
+            original[cmd["newColumnName"]] = original.pop(cmd["oldColumnName"])
+        else:
+            moves.append(dict(cmd, columnName=original[cmd["columnName"]]))
+    # only the last of consecutive moves of a column matters
+    moves = [m for i, m in enumerate(moves) if i + 1 == len(moves) or moves[i + 1]["columnName"] != m["columnName"]]
+
+    # renames are ordered so that no name is taken when it is applied
+    pending = sorted((old, new) for new, old in original.items() if old != new)
+    columns = list(start)
+    renames = []
+    while pending:
+        ready = [(old, new) for old, new in pending if new not in columns]
+        if not ready:
+            return None
+        old, new = ready[0]
+        pending.remove((old, new))
+        columns = [new if c == old else c for c in columns]
+        renames.append({"op": RENAME, "oldColumnName": old, "newColumnName": new})
+
+    result = moves + renames
+    if len(result) >= len(run):
+        return None
+    # rewritten run must give the same columns
+    columns = list(start)
+    for cmd in result:
+        errors = []
+        columns = PlannersManager.call(cmd, columns, errors)["columns"]
+        if errors:
+            return None
+    return result if columns == final else None
+
+
+def collapse_renames(or_program):
+    steps = analyze(or_program)
+    result = []
+    run = []
+    for step in steps + [None]:
+        if step is not None and step["known"] and step["cmd"]["op"] in (RENAME, MOVE):
+            run.append(step)
+            continue
+        collapsed = collapse_run(run) if len(run) > 1 else None
+        result.extend([s["cmd"] for s in run] if collapsed is None else collapsed)
+        run = []
+        if step is not None:
+            result.append(step["cmd"])
+    return result
+
+
+def is_dead(steps, index):
+    """
+    check that columns written by step are removed before they are read
+
+    :return: tuple of status and indexes of removals of columns created by step
+    """
+    step = steps[index]
+    if not (step["known"] and step["cmd"]["op"] in PURE_OPS and step["writes"] and step["row_local"]):
+        return False, []
+    removals = []
+    for name in step["writes"]:
+        for position, later in enumerate(steps[index + 1:], index + 1):
+            reads = step_reads(later)
+            op = later["cmd"]["op"]
+            if reads is None or name in reads or name in later["writes"] or \
+                    (op == RENAME and later["cmd"]["oldColumnName"] == name):
+                return False, []
+            # positions of created columns matter for moves
+            if op == MOVE and step["cmd"]["op"] in CREATING_OPS:
+                return False, []
+            if op == REMOVAL and later["cmd"]["columnName"] == name:
+                if name not in step["before"]:
+                    removals.append(position)
+                break
+        else:
+            return False, []
+    return True, removals
+
+
+def remove_dead_steps(or_program):
+    steps = analyze(or_program)
+    dropped = set()
+    for index in range(len(steps)):
+        dead, removals = is_dead(steps, index)
+        if dead:
+            dropped.add(index)
+            dropped.update(removals)
+            break
+    return [s["cmd"] for i, s in enumerate(steps) if i not in dropped]
+
+
+def can_push(removal, step):
+    """
+    check that row removal can be executed before step
+    """
+    reads = step_reads(removal)
+    return (step["known"] and step["cmd"]["op"] in PUSHDOWN_OPS and step["row_local"] and reads is not None and
+            not set(reads) & set(step["writes"]) and all(c in step["before"] for c in reads))
+
+
+def push_filters(or_program):
+    steps = analyze(or_program)
+    for index, step in enumerate(steps):
+        cmd = step["cmd"]
+        if not (step["known"] and cmd["op"] == ROW_REMOVAL and step["row_local"] and
+                cmd.get("engineConfig", {}).get("mode", "row-based") == "row-based"):
+            continue
+        target = index
+        while target > 0 and can_push(step, steps[target - 1]):
+            target -= 1
+        if target < index:
+            program = [s["cmd"] for s in steps]
+            program.insert(target, program.pop(index))
+            return program
+    return [s["cmd"] for s in steps]
+
+
+def optimize(or_program):
+    """
+    rewrite OpenRefine program by rules until it doesn't change
+
+    :param or_program:      sequence of OpenRefine commands
+    :return: rewritten program (list of commands)
+    """
+    program = list(or_program)
+    for _ in range(MAX_ROUNDS):
+        rewritten = collapse_renames(remove_dead_steps(push_filters(remove_noops(program))))
+        if rewritten == program:
+            break
+        program = rewritten
+    if len(program) != len(or_program) or any(a is not b for a, b in zip(program, or_program)):
+        log.logger.info("optimizer: plan before rewriting\n%s" % build_plan(or_program).format())
+        log.logger.info("optimizer: plan after rewriting\n%s" % build_plan(program).format())
+    else:
+        log.logger.info("optimizer: program isn't changed")
+    return program
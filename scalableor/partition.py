@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive partitioning of data
+
+The partition count is chosen from input size and cluster cores. Repartitioning keeps
+the row order (rows are range partitioned by their index), so OpenRefine semantics
+of ordered rows and records are preserved.
+"""
+
+import math
+import os
+import threading
+
+import log
+
+from scalableor.manager import PlannersManager
+
+# default size of partition in MB
+TARGET_PARTITION_SIZE = 128
+# estimated expansion of gzip compressed input
+GZIP_RATIO = 5
+# persisted rdds of job running in thread (driver, jobs of service run concurrently)
+STATE = threading.local()
+
+
+def input_size(path):
+    """
+    return estimated uncompressed size of input file or directory in bytes
+    """
+    if os.path.isdir(path):
+        return sum(input_size(os.path.join(path, i)) for i in os.listdir(path) if not i.startswith((".", "_")))
+    if not os.path.exists(path):
+        return 0
+    size = os.path.getsize(path)
+    return size * GZIP_RATIO if path.endswith(".gz") else size
+
+
+def choose_partitions(path, sc, target_size=None):
+    """
+    choose partition count from input size and cluster cores
+
+    :param path:            path to input
+    :param sc:              spark context
+    :param target_size:     target size of partition in MB
+    """
+    target_size = (target_size or TARGET_PARTITION_SIZE) * 1024 * 1024
+    by_size = int(math.ceil(input_size(path) / float(target_size)))
+    return max(sc.defaultParallelism, by_size, 1)
+
+
+def partition_starts(counts):
+    """
+    return index of first row of every partition
+
+    :param counts:      row counts of partitions
+    """
+    starts, total = [], 0
+    for count in counts:
+        starts.append(total)
+        total += count
+    return starts
+
+
+def range_partitioner(total, partitions):
+    """
+    return function of row index to partition, rows are split in ranges of equal size
+
+    :param total:       row count
+    :param partitions:  partition count
+    """
+    chunk = max(1, int(math.ceil(total / float(partitions))))
+    last = partitions - 1
+    return lambda index: min(index // chunk, last)
+
+
+def index_partition(starts):
+    """
+    return function of partition, which keys rows by their index in data
+    """
+    return lambda split, rows: enumerate(rows, starts[split])
+
+
+def persist(rdd):
+    """
+    persist rdd which is read twice (rows are counted before repartitioning), until the job ends or the data
+    is checkpointed
+
+    :param rdd:     source rdd
+    """
+    from pyspark import StorageLevel
+
+    if not hasattr(STATE, "persisted"):
+        STATE.persisted = []
+    STATE.persisted.append(rdd)
+    return rdd.persist(StorageLevel.MEMORY_AND_DISK)
+
+
+def release():
+    """
+    unpersist rdds of job (data is checkpointed or job ends)
+    """
+    for rdd in getattr(STATE, "persisted", []):
+        rdd.unpersist()
+    STATE.persisted = []
+
+
+def repartition_ordered(rdd, partitions):
+    """
+    repartition rdd and keep order of rows, rows are range partitioned by their index
+    (rows are counted in an additional pass)
+
+    :param rdd:                 source rdd
+    :param partitions:          new partition count
+    """
+    counts = rdd.mapPartitions(lambda it: [sum(1 for _ in it)]).collect()
+    return (rdd.mapPartitionsWithIndex(index_partition(partition_starts(counts)))
+            .repartitionAndSortWithinPartitions(partitions, range_partitioner(sum(counts), partitions))
+            .values())
+
+
+def read_input(cmd, sc):
+    """
+    read input lines, repartition them if partition count of read input is too small
+    (e.g. single not splittable gzip file)
+
+    :param cmd:         import command (optional "partitions", "targetPartitionSize")
+    :param sc:          spark context
+    """
+    partitions = cmd.get("partitions") or choose_partitions(cmd["path"], sc, cmd.get("targetPartitionSize"))
+    rdd = sc.textFile(cmd["path"], partitions)
+    current = rdd.getNumPartitions()
+    log.logger.info("partitioning: input '%s' has %d partition(s), target %d" % (cmd["path"], current, partitions))
+    if current >= partitions:
+        return rdd
+
+    # size of compressed input is only an estimate: rows are counted, (not splittable) input is read once
+    log.logger.info("partitioning: repartition input to %d partition(s)" % partitions)
+    return repartition_ordered(persist(rdd), partitions)
+
+
+def plan_step(cmd, df):
+    """
+    return planned info of command (None: command can't be planned)
+
+    :param cmd:         OpenRefine command
+    :param df:          spark data frame before command (None: before import)
+    """
+    if not PlannersManager.has(cmd["op"]):
+        return None
+    return PlannersManager.call(cmd, df.columns if df is not None else [], [])
+
+
+def changes_partitioning(info):
+    """
+    return True if planned step changes row count or partitioning of data
+
+    :param info:        planned info of step (None: unknown step)
+    """
+    return info is None or info["resizes"] or info["shuffles"] > 0
+
+
+def step_partitions(cmd, info, previous, current, parallelism):
+    """
+    return partition count of data before step, None if data isn't repartitioned
+
+    :param cmd:         OpenRefine command (optional "repartition": partition count)
+    :param info:        planned info of command
+    :param previous:    planned info of previous step (None: unknown)
+    :param current:     current partition count
+    :param parallelism: default parallelism of spark context
+    """
+    partitions = cmd.get("repartition")
+    if partitions is None:
+        # partitions are balanced on import, only a changed row count or partitioning can unbalance them
+        if not info["expression"] or not changes_partitioning(previous):
+            return None
+        partitions = parallelism
+    return partitions if current < partitions else None
+
+
+def before_step(cmd, df, sc, previous=None):
+    """
+    repartition data frame before costly python expression step
+
+    :param cmd:         OpenRefine command (optional "repartition": partition count)
+    :param df:          spark data frame
+    :param sc:          spark context
+    :param previous:    planned info of previous step (None: unknown)
+    """
+    info = plan_step(cmd, df)
+    if df is None or info is None:
+        return df
+
+    current = df.rdd.getNumPartitions()
+    partitions = step_partitions(cmd, info, previous, current, sc.defaultParallelism)
+    if partitions is None:
+        return df
+    log.logger.info("partitioning: repartition %d -> %d partition(s) before '%s'" % (current, partitions, cmd["op"]))
+    # previous steps aren't evaluated again by repartitioning after counting
+    return df.sql_ctx.createDataFrame(repartition_ordered(persist(df.rdd), partitions), df.schema)
+
+
+def before_export(cmd, df, sc):
+    """
+    coalesce data frame before export to limit count of written part files
+
+    :param cmd:         export command (optional "coalesce": partition count)
+    :param df:          spark data frame
+    :param sc:          spark context
+    """
+    current = df.rdd.getNumPartitions()
+    partitions = cmd.get("coalesce")
+    if partitions is None:
+        # many small partitions: coalesce to cluster cores
+        if current <= 2 * sc.defaultParallelism:
+            return df
+        partitions = sc.defaultParallelism
+
+    if current <= partitions:
+        return df
+    log.logger.info("partitioning: coalesce %d -> %d partition(s) before export" % (current, partitions))
+    return df.coalesce(partitions)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Size-bounded cache of compiled regular expressions
+
+The cache is kept per process (driver, spark python worker, process of local pool) and shared by
+facets, column split and GREL regex functions. Least recently used patterns are evicted, so jobs with
+many distinct patterns don't recompile frequent ones. Hit/miss counters of spark tasks are collected by
+accumulators of the running job per partition (a partition evaluated again replaces its counters) and
+reported in step metrics.
+"""
+
+import collections
+import re
+import threading
+
+# maximal count of compiled patterns per process
+CACHE_SIZE = 512
+COUNTERS = ("hits", "misses", "evictions")
+# accumulators of spark tasks of job running in thread (driver, jobs of service run concurrently)
+STATE = threading.local()
+
+
+class RegexCache(object):
+    """
+    this class implements LRU cache of compiled patterns with hit/miss counters
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.patterns = collections.OrderedDict()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def compile(self, pattern, flags=0):
+        key = (type(pattern), pattern, flags)
+        compiled = self.patterns.pop(key, None)
+        if compiled is None:
+            self.counters["misses"] += 1
+            compiled = re.compile(pattern, flags)
+            if len(self.patterns) >= self.size:
+                self.patterns.popitem(last=False)
+                self.counters["evictions"] += 1
+        else:
+            self.counters["hits"] += 1
+        self.patterns[key] = compiled
+        return compiled
+
+
+CACHE = RegexCache()
+
+
+def compile(pattern, flags=0):
+    """
+    return compiled pattern from cache of this process
+    """
+    return CACHE.compile(pattern, flags)
+
+
+def stats():
+    """
+    return counters of cache of this process
+    """
+    return dict(CACHE.counters)
+
+
+def diff(after, before):
+    return dict((i, after[i] - before[i]) for i in COUNTERS)
+
+
+def merge(counters):
+    """
+    add counters of other process (e.g. process of local pool) to counters of this process
+    """
+    for i in COUNTERS:
+        CACHE.counters[i] += counters[i]
+
+
+class CountersParam(object):
+    """
+    accumulator param of cache counters per partition: key of partition -> counters
+    """
+
+    def zero(self, value):
+        return {}
+
+    def addInPlace(self, value1, value2):
+        for key, counters in value2.iteritems():
+            # the most complete evaluation of partition is kept
+            if key not in value1 or counters["hits"] + counters["misses"] > \
+                    value1[key]["hits"] + value1[key]["misses"]:
+                value1[key] = counters
+        return value1
+
+
+def reset():
+    """
+    drop accumulators of job (job starts or ends)
+    """
+    STATE.accumulators = []
+
+
+def accumulator(sc):
+    """
+    create accumulator of cache counters of spark tasks of job
+
+    :param sc:  spark context (None: counters are kept in this process)
+    :return: accumulator or None
+    """
+    if sc is None:
+        return None
+    acc = sc.accumulator({}, CountersParam())
+    if not hasattr(STATE, "accumulators"):
+        reset()
+    STATE.accumulators.append(acc)
+    return acc
+
+
+def metrics():
+    """
+    return counters of this process and of finished spark tasks of job
+    """
+    result = stats()
+    for acc in getattr(STATE, "accumulators", []):
+        for counters in acc.value.itervalues():
+            for i in COUNTERS:
+                result[i] += counters[i]
+    return result
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Execution plan of OpenRefine program without spark
+
+Every command is planned by a registered planner, which tracks column names through the
+program, reports columns read/written by the command and estimates its cost.
+"""
+
+import gzip
+import os
+import re
+
+from scalableor.constant import COLUMN_NAME
+from scalableor.manager import PlannersManager
+
+# columns referenced by expression: cells["name"], cells['name'], cells.name
+RE_CELLS_ITEM = re.compile(r"cells\s*\[\s*[\"'](.+?)[\"']\s*\]")
+RE_CELLS_ATTR = re.compile(r"cells\.(\w+)")
+# expression uses the whole row
+RE_WHOLE_ROW = re.compile(r"\brow\b|\bcells\b(?!\s*[\[.])")
+
+
+def step_info(columns, reads=(), writes=(), row_local=True, expression=False, shuffles=0, passes=0,
+              noop=False, exact=None, resizes=False):
+    """
+    describe planned command
+
+    :param columns:     column names after command
+    :param reads:       column names read by command
+    :param writes:      column names written (created/changed) by command
+    :param row_local:   result of row depends only on this row
+    :param expression:  command evaluates python/GREL expression per row
+    :param shuffles:    number of shuffles of command
+    :param passes:      number of additional passes over data (spark actions)
+    :param noop:        command doesn't change data
+    :param exact:       column names after command are known (None: unchanged)
+    :param resizes:     command changes row count of data (e.g. removes or splits rows)
+    """
+    return {
+        "columns": list(columns),
+        "reads": list(reads),
+        "writes": list(writes),
+        "row_local": row_local,
+        "expression": expression,
+        "shuffles": shuffles,
+        "passes": passes,
+        "noop": noop,
+        "exact": exact,
+        "resizes": resizes,
+    }
+
+
+def require_columns(columns, names, errors):
+    """
+    check that columns exist
+
+    :return: True if all columns exist
+    """
+    missing = [n for n in names if n not in columns]
+    for name in missing:
+        errors.append("column '%s' doesn't exist" % name)
+    return not missing
+
+
+def facet_columns(cmd):
+    """
+    return column names used by facets of command
+    """
+    return [f["columnName"] for f in cmd.get("engineConfig", {}).get("facets", []) if "columnName" in f]
+
+
+def expression_columns(exp, base_column, columns):
+    """
+    return column names read by expression
+
+    :param exp:             GREL/python expression
+    :param base_column:     column of 'value' and 'cell' variables
+    :param columns:         all column names
+    """
+    if RE_WHOLE_ROW.search(exp):
+        return list(columns)
+    names = [base_column] + RE_CELLS_ITEM.findall(exp) + RE_CELLS_ATTR.findall(exp)
+    return [n for i, n in enumerate(names) if n not in names[:i]]
+
+
+def join_shuffles(exp):
+    """
+    return estimated shuffles of cross() lookups (joins with other projects)
+    """
+    from scalableor.cross import join_shuffles
+    return join_shuffles(exp)
+
+
+def facet_count_lookups(cmd, base_column, errors):
+    """
+    return columns counted for facetCount() lookups of command (one shuffle and pass per lookup)
+    """
+    from scalableor.facetcount import command_uses_facet_count, rewrite_command
+    if not command_uses_facet_count(cmd):
+        return []
+    try:
+        return [column for facet_exp, column, key_column in rewrite_command(cmd, base_column)[1]]
+    except SyntaxError as e:
+        errors.append(str(e))
+        return []
+
+
+def read_columns(path, separator):
+    """
+    read only first line of input and return column names
+
+    :param path:        path to input file (plain or gzip) or directory with part files
+    :param separator:   column separator
+    """
+    if os.path.isdir(path):
+        parts = sorted(i for i in os.listdir(path) if not i.startswith((".", "_")))
+        path = os.path.join(path, parts[0])
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        line = f.readline().rstrip("\r\n")
+    return [COLUMN_NAME % (i + 1) for i in range(len(line.split(separator)))]
+
+
+class Plan(object):
+    """
+    this class keeps planned steps of OpenRefine program
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.pruned = []
+        self.errors = []
+        self.warnings = []
+
+    @property
+    def stages(self):
+        """
+        fuse narrow steps to stages, every shuffle starts a new stage
+        """
+        stages = [[]]
+        for step in self.steps:
+            stages[-1].append(step)
+            if step["shuffles"]:
+                stages.append([])
+        return [s for s in stages if s]
+
+    @property
+    def shuffles(self):
+        return sum(s["shuffles"] for s in self.steps)
+
+    @property
+    def passes(self):
+        return len(self.stages) + sum(s["passes"] for s in self.steps)
+
+    def format(self):
+        """
+        return execution plan as text
+        """
+        lines = ["Execution plan: %d step(s), %d stage(s), ~%d pass(es) over data, %d shuffle(s)" % (
+            len(self.steps), len(self.stages), self.passes, self.shuffles)]
+        for index, stage in enumerate(self.stages):
+            lines.append("  stage %d (%d fused step(s)):" % (index + 1, len(stage)))
+            for step in stage:
+                flags = [f for f in ["expression", "row_local"] if step[f]]
+                if step["shuffles"]:
+                    flags.append("shuffles=%d" % step["shuffles"])
+                if step["passes"]:
+                    flags.append("passes=%d" % step["passes"])
+                lines.append("    %3d. %-28s reads=[%s] writes=[%s] [%s]" % (
+                    step["index"] + 1, step["op"], ", ".join(step["reads"]), ", ".join(step["writes"]),
+                    ", ".join(flags)))
+        for step in self.pruned:
+            lines.append("  pruned %3d. %s (no-op)" % (step["index"] + 1, step["op"]))
+        if self.steps and self.steps[-1]["exact"] is not False:
+            lines.append("  output columns: [%s]" % ", ".join(self.steps[-1]["columns"]))
+        lines += ["  warning: %s" % w for w in self.warnings]
+        lines += ["  error: %s" % e for e in self.errors]
+        return "\n".join(lines)
+
+
+def build_plan(or_program):
+    """
+    plan OpenRefine program, track column names through every command
+
+    :param or_program:      sequence of OpenRefine commands
+    :return: plan object
+    """
+    plan = Plan()
+    columns = []
+    exact = False
+    for index, cmd in enumerate(or_program):
+        name = cmd["op"]
+        errors = []
+        if PlannersManager.has(name):
+            info = PlannersManager.call(cmd, columns, errors)
+        else:
+            plan.warnings.append("step %d: planner of '%s' doesn't exist, columns are unknown after it" % (
+                index + 1, name))
+            info = step_info(columns, row_local=False, exact=False, resizes=True)
+
+        # without known columns a missing column is only suspicious
+        for error in errors:
+            (plan.errors if exact else plan.warnings).append("step %d '%s': %s" % (index + 1, name, error))
+
+        if info["exact"] is not None:
+            exact = info["exact"]
+        info.update({"index": index, "op": name, "cmd": cmd, "exact": exact})
+        columns = info["columns"]
+        (plan.pruned if info["noop"] else plan.steps).append(info)
+    return plan
+
+
+@PlannersManager.register("scalableor/import")
+def sc_or_import(cmd, columns, errors):
+    if not os.path.exists(cmd["path"]):
+        errors.append("input '%s' doesn't exist" % cmd["path"])
+        return step_info([], exact=False)
+    return step_info(read_columns(cmd["path"], cmd["separator"]), exact=True,
+                     passes=1 if cmd.get("guessCellType") is True else 0)
+
+
+@PlannersManager.register("scalableor/export")
+def sc_or_export(cmd, columns, errors):
+    return step_info(columns, reads=columns)
+
+
+@PlannersManager.register("scalableor/sample")
+def sc_or_sample(cmd, columns, errors):
+    # rows of every partition are sampled independently
+    return step_info(columns, resizes=True)
+
+
+@PlannersManager.register("core/column-rename")
+def core_column_rename(cmd, columns, errors):
+    old, new = cmd["oldColumnName"], cmd["newColumnName"]
+    if old == new:
+        return step_info(columns, noop=True)
+    if not require_columns(columns, [old], errors):
+        return step_info(columns)
+    if new in columns:
+        errors.append("column '%s' already exists" % new)
+    return step_info([new if c == old else c for c in columns], reads=[old], writes=[new])
+
+
+@PlannersManager.register("core/column-removal")
+def core_column_removal(cmd, columns, errors):
+    name = cmd["columnName"]
+    if not require_columns(columns, [name], errors):
+        return step_info(columns)
+    return step_info([c for c in columns if c != name])
+
+
+@PlannersManager.register("core/column-move")
+def core_column_move(cmd, columns, errors):
+    name = cmd["columnName"]
+    if not require_columns(columns, [name], errors):
+        return step_info(columns)
+    if not 0 <= cmd["index"] < len(columns):
+        errors.append("index %d is out of range" % cmd["index"])
+        return step_info(columns)
+    moved = columns[:]
+    moved.insert(cmd["index"], moved.pop(moved.index(name)))
+    return step_info(moved, noop=moved == columns)
+
+
+@PlannersManager.register("core/row-removal")
+def core_row_removal(cmd, columns, errors):
+    counted = facet_count_lookups(cmd, None, errors)
+    reads = facet_columns(cmd) + counted
+    require_columns(columns, reads, errors)
+    return step_info(columns, reads=reads, row_local=not counted, shuffles=len(counted), passes=len(counted),
+                     resizes=True)
+
+
+@PlannersManager.register("core/column-split")
+def core_column_split(cmd, columns, errors):
+    name = cmd["columnName"]
+    if not require_columns(columns, [name], errors):
+        return step_info(columns)
+
+    if "fieldLengths" in cmd:
+        count = len(cmd["fieldLengths"])
+    elif cmd.get("maxColumns", 0) == 1:
+        return step_info(columns, noop=True)
+    elif cmd.get("maxColumns", 0) > 1:
+        count = cmd["maxColumns"]
+    else:
+        # column count is guessed from first rows of data
+        kept = columns if not cmd.get("removeOriginalColumn") else [c for c in columns if c != name]
+        return step_info(kept, reads=[name], row_local=False, exact=False)
+
+    pos = columns.index(name)
+    new_columns = ["%s %d" % (name, i + 1) for i in range(count)]
+    result = columns[:pos + 1] + new_columns + columns[pos + 1:]
+    if cmd.get("removeOriginalColumn") is True:
+        result.remove(name)
+    return step_info(result, reads=[name], writes=new_columns)
+
+
+@PlannersManager.register("core/column-addition")
+def core_column_addition(cmd, columns, errors):
+    base, new = cmd["baseColumnName"], cmd["newColumnName"]
+    counted = facet_count_lookups(cmd, base, errors)
+    reads = expression_columns(cmd["expression"], base, columns) + facet_columns(cmd) + counted
+    if not require_columns(columns, reads, errors):
+        return step_info(columns)
+    if new in columns:
+        errors.append("column '%s' already exists" % new)
+    pos = columns.index(base)
+    return step_info(columns[:pos + 1] + [new] + columns[pos + 1:], reads=reads, writes=[new], expression=True,
+                     row_local=not counted, shuffles=join_shuffles(cmd["expression"]) + len(counted),
+                     passes=len(counted))
+
+
+@PlannersManager.register("core/column-addition-by-fetching-urls")
+def core_column_addition_by_fetching_urls(cmd, columns, errors):
+    base, new = cmd["baseColumnName"], cmd["newColumnName"]
+    reads = expression_columns(cmd["urlExpression"], base, columns) + facet_columns(cmd)
+    if not require_columns(columns, reads, errors):
+        return step_info(columns)
+    if new in columns:
+        errors.append("column '%s' already exists" % new)
+    pos = columns.index(base)
+    # distinct URLs are fetched per partition
+    return step_info(columns[:pos + 1] + [new] + columns[pos + 1:], reads=reads, writes=[new], expression=True)
+
+
+@PlannersManager.register("core/text-transform")
+def core_text_transform(cmd, columns, errors):
+    name = cmd["columnName"]
+    counted = facet_count_lookups(cmd, name, errors)
+    reads = expression_columns(cmd["expression"], name, columns) + facet_columns(cmd) + counted
+    if not require_columns(columns, reads, errors):
+        return step_info(columns)
+    return step_info(columns, reads=reads, writes=[name], expression=True, row_local=not counted,
+                     shuffles=join_shuffles(cmd["expression"]) + len(counted), passes=len(counted))
+
+
+@PlannersManager.register("core/mass-edit")
+def core_mass_edit(cmd, columns, errors):
+    name = cmd["columnName"]
+    require_columns(columns, [name], errors)
+    return step_info(columns, reads=[name], writes=[name])
+
+
+@PlannersManager.register("scalableor/profile")
+def sc_or_profile(cmd, columns, errors):
+    # partition profiles are merged without shuffle
+    return step_info(columns, reads=columns, row_local=False, passes=1)
+
+
+@PlannersManager.register("core/recon")
+def core_recon(cmd, columns, errors):
+    reads = [cmd["columnName"]] + [d["column"] for d in cmd.get("config", {}).get("columnDetails", [])] + \
+        facet_columns(cmd)
+    require_columns(columns, reads, errors)
+    # distinct queries are shuffled and results are collected to driver, data isn't changed
+    return step_info(columns, reads=reads, row_local=False, shuffles=1, passes=1)
+
+
+@PlannersManager.register("core/multivalued-cell-split")
+def core_multivalued_cell_split(cmd, columns, errors):
+    name = cmd["columnName"]
+    require_columns(columns, [name], errors)
+    # rows are split in order of partitions (flatMap)
+    return step_info(columns, reads=[name], writes=[name], resizes=True)
+
+
+@PlannersManager.register("core/multivalued-cell-join")
+def core_multivalued_cell_join(cmd, columns, errors):
+    names = [cmd["columnName"], cmd["keyColumnName"]]
+    require_columns(columns, names, errors)
+    # records spanning partitions are found in an additional pass
+    return step_info(columns, reads=names, writes=names[:1], row_local=False, passes=1, resizes=True)
+
+
+@PlannersManager.register("core/fill-down")
+def core_fill_down(cmd, columns, errors):
+    name = cmd["columnName"]
+    require_columns(columns, [name], errors)
+    return step_info(columns, reads=[name], writes=[name], row_local=False)
+
+
+@PlannersManager.register("scalableor/cluster")
+def sc_or_cluster(cmd, columns, errors):
+    name = cmd["columnName"]
+    require_columns(columns, [name], errors)
+    # values are counted and grouped by key
+    return step_info(columns, reads=[name], row_local=False, shuffles=2, passes=1)
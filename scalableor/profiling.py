@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Column profiling with mergeable sketches (scalableor/profile)
+
+Every partition is profiled in one pass and the profiles are merged:
+    - distinct count:   HyperLogLog (relative standard error 1.04 / sqrt(2 ** precision))
+    - top values:       Misra-Gries summary of exact counts of batches (counts are lower bounds, the
+                        maximal undercount is reported as topValuesError)
+    - null/blank count, total length and histogram of value lengths (buckets of powers of two) are exact
+The report is written as JSON to the output of the command. A report next to a registered project
+(<project path>.profile.json) gives cross() the size of its data, which decides broadcast over join.
+"""
+
+import hashlib
+import io
+import json
+import math
+import os
+import struct
+
+from scalableor.celltype import java_string
+from scalableor.vectorized import iter_batches
+
+# registers of HyperLogLog: 2 ** PRECISION
+PRECISION = 12
+# counters of heavy hitters summary
+HITTERS_SIZE = 100
+# reported top values
+TOP_VALUES = 10
+
+
+class HyperLogLog(object):
+    """
+    this class estimates count of distinct values
+    """
+
+    def __init__(self, precision=PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, text):
+        """
+        :param text:    value as unicode string
+        """
+        code = struct.unpack(">Q", hashlib.md5(text.encode("utf-8")).digest()[:8])[0]
+        index = code >> (64 - self.precision)
+        bits = 64 - self.precision
+        rank = bits - (code & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(r1, r2) for r1, r2 in zip(self.registers, other.registers))
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = sum(1 for r in self.registers if not r)
+        # linear counting of small cardinalities
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def error(self):
+        return 1.04 / math.sqrt(len(self.registers))
+
+
+class HeavyHitters(object):
+    """
+    this class keeps approximate counts of most frequent values (Misra-Gries summary)
+    """
+
+    def __init__(self, size=HITTERS_SIZE):
+        self.size = size
+        self.counts = {}
+        # maximal undercount of every value
+        self.error = 0
+
+    def update(self, counts, error=0):
+        """
+        add exact counts of values (of a batch or another summary)
+        """
+        for value, count in counts.iteritems():
+            self.counts[value] = self.counts.get(value, 0) + count
+        self.error += error
+        if len(self.counts) > self.size:
+            cut = sorted(self.counts.itervalues(), reverse=True)[self.size]
+            self.counts = dict((v, c - cut) for v, c in self.counts.iteritems() if c > cut)
+            self.error += cut
+
+    def merge(self, other):
+        self.update(other.counts, other.error)
+        return self
+
+    def top(self, count):
+        return sorted(self.counts.iteritems(), key=lambda e: (-e[1], e[0]))[:count]
+
+
+class ColumnProfile(object):
+    """
+    this class profiles values of column
+    """
+
+    def __init__(self, precision=PRECISION, size=HITTERS_SIZE):
+        self.count = 0
+        self.nulls = 0
+        self.blanks = 0
+        self.total_length = 0
+        self.min_length = None
+        self.max_length = None
+        # count of values by bit length of length (0, 1, 2-3, 4-7, ...)
+        self.lengths = []
+        self.distinct = HyperLogLog(precision)
+        self.hitters = HeavyHitters(size)
+
+    def add_values(self, values):
+        """
+        profile batch of values
+        """
+        counts = {}
+        for value in values:
+            self.count += 1
+            if value is None:
+                self.nulls += 1
+                continue
+            text = value if isinstance(value, unicode) else java_string(value)
+            if not text:
+                self.blanks += 1
+            length = len(text)
+            self.total_length += length
+            self.min_length = length if self.min_length is None else min(self.min_length, length)
+            self.max_length = length if self.max_length is None else max(self.max_length, length)
+            bucket = length.bit_length()
+            if bucket >= len(self.lengths):
+                self.lengths.extend([0] * (bucket + 1 - len(self.lengths)))
+            self.lengths[bucket] += 1
+            if text not in counts:
+                self.distinct.add(text)
+                counts[text] = 0
+            counts[text] += 1
+        self.hitters.update(counts)
+
+    def merge(self, other):
+        self.count += other.count
+        self.nulls += other.nulls
+        self.blanks += other.blanks
+        self.total_length += other.total_length
+        lengths = [i for i in (self.min_length, other.min_length) if i is not None]
+        self.min_length = min(lengths) if lengths else None
+        lengths = [i for i in (self.max_length, other.max_length) if i is not None]
+        self.max_length = max(lengths) if lengths else None
+        if len(other.lengths) > len(self.lengths):
+            self.lengths.extend([0] * (len(other.lengths) - len(self.lengths)))
+        for bucket, count in enumerate(other.lengths):
+            self.lengths[bucket] += count
+        self.distinct.merge(other.distinct)
+        self.hitters.merge(other.hitters)
+        return self
+
+    def report(self, name, top_values=TOP_VALUES):
+        histogram = [{"from": (1 << bucket) >> 1, "to": (1 << bucket) - 1, "c": count}
+                     for bucket, count in enumerate(self.lengths) if count]
+        return {
+            "name": name,
+            "count": self.count,
+            "nulls": self.nulls,
+            "blanks": self.blanks,
+            "distinct": self.distinct.estimate(),
+            "distinctError": round(self.distinct.error(), 4),
+            "topValues": [{"v": v, "c": c} for v, c in self.hitters.top(top_values)],
+            "topValuesError": self.hitters.error,
+            "lengths": {"min": self.min_length, "max": self.max_length, "total": self.total_length,
+                        "histogram": histogram},
+        }
+
+
+def profile_rows(rows, width, precision=PRECISION, size=HITTERS_SIZE):
+    """
+    profile rows of partition in one pass
+
+    :param rows:    iterable of rows
+    :param width:   count of columns
+    :return: list of column profiles
+    """
+    profiles = [ColumnProfile(precision, size) for _ in range(width)]
+    for batch in iter_batches(iter(rows)):
+        for index, profile in enumerate(profiles):
+            profile.add_values([row[index] for row in batch])
+    return profiles
+
+
+def merge(profiles1, profiles2):
+    """
+    merge column profiles of two parts of data
+    """
+    return [p1.merge(p2) for p1, p2 in zip(profiles1, profiles2)]
+
+
+def get_profile_params(cmd):
+    """
+    return parameters of sketches of command
+    """
+    return int(cmd.get("precision", PRECISION)), max(int(cmd.get("topValues", TOP_VALUES)) * 10, HITTERS_SIZE)
+
+
+def write_profile(cmd, names, profiles):
+    """
+    write profile report to output file of command
+
+    :param cmd:         profile command
+    :param names:       column names
+    :param profiles:    column profiles
+    :return: report
+    """
+    columns = [p.report(n, int(cmd.get("topValues", TOP_VALUES))) for n, p in zip(names, profiles)]
+    rows = columns[0]["count"] if columns else 0
+    result = {"rows": rows, "bytes": sum(c["lengths"]["total"] for c in columns) + rows * len(columns),
+              "columns": columns}
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    with io.open(cmd["output"], "w", encoding="utf-8") as f:
+        f.write(text.decode("utf-8") if isinstance(text, str) else text)
+    return result
+
+
+def profiled_size(path):
+    """
+    return size of data in bytes from profile report next to data (<path>.profile.json)
+
+    :return: size or None if data isn't profiled
+    """
+    report = path + ".profile.json"
+    if not os.path.isfile(report):
+        return None
+    with open(report) as f:
+        return json.load(f)["bytes"]
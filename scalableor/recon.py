@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Reconciliation of column against reconciliation service (core/recon)
+https://reconciliation-api.github.io/specs/latest/
+
+Queries (cell value and values of columnDetails) are de-duplicated first (distinct() of spark), so every
+query is sent once. Every partition of queries is reconciled in batched multi-query requests over a pool of
+persistent HTTP connections of the executor. Results are kept in a persistent local cache (sqlite), so
+reruns don't send queries which are already reconciled.
+
+The data isn't changed: results are registered per column for the next steps of the program, which get
+'recon' and 'cell.recon' of reconciled cells in expressions. A cell whose value was changed by a later step
+has no recon.
+"""
+
+import hashlib
+import httplib
+import json
+import os
+import Queue
+import socket
+import threading
+import urllib
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+import log
+
+from scalableor.context import GRELList, has_field, key_of, to_grel_object
+from scalableor.diskcache import DiskCache
+
+# path of persistent cache of results
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "scalableor", "recon.db")
+# queries per request
+BATCH_SIZE = 10
+# HTTP connections per executor
+CONNECTIONS = 4
+TIMEOUT = 60
+RETRIES = 3
+# reconciled columns of program which is refined in this thread: column name -> ReconTable
+STATE = threading.local()
+
+
+class ServiceClient(object):
+    """
+    this class sends batched queries to reconciliation service over pool of persistent connections
+    """
+
+    def __init__(self, service, connections=CONNECTIONS, batch_size=BATCH_SIZE, timeout=TIMEOUT):
+        url = urlparse.urlsplit(service)
+        self.connection_class = httplib.HTTPSConnection if url.scheme == "https" else httplib.HTTPConnection
+        self.host = url.netloc
+        self.path = (url.path or "/") + ("?" + url.query if url.query else "")
+        self.connections = connections
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.pool = Queue.Queue()
+        for _ in range(connections):
+            self.pool.put(None)
+        self.requests = 0
+
+    def post(self, queries):
+        """
+        send multi-query request
+
+        :param queries:     dict query id -> query
+        :return: dict query id -> response of query
+        """
+        body = urllib.urlencode({"queries": json.dumps(queries)})
+        headers = {"Content-Type": "application/x-www-form-urlencoded", "Accept": "application/json"}
+        connection = self.pool.get()
+        try:
+            for attempt in range(RETRIES):
+                if connection is None:
+                    connection = self.connection_class(self.host, timeout=self.timeout)
+                try:
+                    connection.request("POST", self.path, body, headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                    self.requests += 1
+                    if response.status != 200:
+                        raise IOError("reconciliation service returned HTTP %d" % response.status)
+                    return json.loads(data)
+                except (httplib.HTTPException, socket.error):
+                    # connection closed by service
+                    connection.close()
+                    connection = None
+                    if attempt == RETRIES - 1:
+                        raise
+        finally:
+            self.pool.put(connection)
+
+    def reconcile(self, queries):
+        """
+        reconcile queries in batches sent in parallel
+
+        :param queries:     list of queries
+        :return: list of lists of candidates
+        """
+        batches = [queries[i:i + self.batch_size] for i in range(0, len(queries), self.batch_size)]
+        workers = ThreadPool(self.connections)
+        try:
+            responses = workers.map(lambda batch: self.post(dict(("q%d" % i, q) for i, q in enumerate(batch))),
+                                    batches)
+        finally:
+            workers.close()
+        return [responses[b].get("q%d" % i, {}).get("result", [])
+                for b, batch in enumerate(batches) for i in range(len(batch))]
+
+    def close(self):
+        while not self.pool.empty():
+            connection = self.pool.get()
+            if connection is not None:
+                connection.close()
+
+
+def detail_columns(cmd):
+    return [d["column"] for d in cmd["config"].get("columnDetails", [])]
+
+
+def query_function(cmd, names):
+    """
+    generate row callback returning key of query of row: tuple of cell value and values of columnDetails,
+    None for blank cell
+    """
+    positions = [names.index(cmd["columnName"])] + [names.index(c) for c in detail_columns(cmd)]
+
+    def get_query_key(row):
+        if row[positions[0]] is None or row[positions[0]] == "":
+            return None
+        return tuple(key_of(row[p]) for p in positions)
+
+    return get_query_key
+
+
+def build_query(config, query_key):
+    """
+    build query of reconciliation API from key of query
+    """
+    query = {"query": query_key[0]}
+    if config.get("type") and config["type"].get("id"):
+        query["type"] = config["type"]["id"]
+        query["type_strict"] = "should"
+    if config.get("limit"):
+        query["limit"] = config["limit"]
+    properties = [{"pid": d["propertyID"], "v": v} for d, v in zip(config.get("columnDetails", []), query_key[1:])
+                  if v]
+    if properties:
+        query["properties"] = properties
+    return query
+
+
+def cache_key(config, query):
+    return hashlib.sha1(json.dumps([config["service"], query], sort_keys=True)).hexdigest()
+
+
+def judge(config, candidates):
+    """
+    create result of query: candidates and judgment (matched if autoMatch and best candidate is a match)
+    """
+    candidates = sorted(candidates, key=lambda c: -float(c.get("score", 0)))
+    matched = bool(config.get("autoMatch", True) and candidates and candidates[0].get("match") is True)
+    return {
+        "judgment": "matched" if matched else "none",
+        "match": candidates[0] if matched else None,
+        "candidates": candidates,
+        "service": config["service"],
+        "identifierSpace": config.get("identifierSpace"),
+        "schemaSpace": config.get("schemaSpace"),
+    }
+
+
+def reconcile_keys(config, query_keys, cache_path=None, connections=CONNECTIONS):
+    """
+    reconcile distinct queries: cached results are reused, other queries are sent in batches
+
+    :param config:          recon config of command
+    :param query_keys:      iterable of distinct keys of queries
+    :param cache_path:      path of persistent cache
+    :param connections:     count of HTTP connections
+    :return: list of (key of query, result)
+    """
+    queries = dict((k, build_query(config, k)) for k in query_keys)
+    if not queries:
+        return []
+    keys = dict((k, cache_key(config, q)) for k, q in queries.iteritems())
+    cache = DiskCache(cache_path or CACHE_PATH, "recon")
+    try:
+        cached = cache.get_many(set(keys.values()))
+        missing = [k for k in queries if keys[k] not in cached]
+        requests = 0
+        if missing:
+            client = ServiceClient(config["service"], connections, int(config.get("batchSize", BATCH_SIZE)))
+            try:
+                candidates = client.reconcile([queries[k] for k in missing])
+            finally:
+                client.close()
+            requests = client.requests
+            found = dict((keys[k], c) for k, c in zip(missing, candidates))
+            cache.put_many(found)
+            cached.update(found)
+        log.logger.info("recon: %d queries, %d sent in %d requests" % (len(queries), len(missing), requests))
+    finally:
+        cache.close()
+    return [(k, judge(config, cached[keys[k]])) for k in queries]
+
+
+class GRELReconCandidate(object):
+    """
+    this class implements candidate of recon of GREL executor (id, name, score, type)
+    """
+    hasField = has_field
+
+    def __init__(self, data):
+        self.id = to_grel_object(data.get("id"))
+        self.name = to_grel_object(data.get("name"))
+        self.score = to_grel_object(float(data.get("score", 0)))
+        self.type = GRELList([to_grel_object(t.get("id") if isinstance(t, dict) else t)
+                              for t in data.get("type", [])])
+
+
+class GRELRecon(object):
+    """
+    this class implements variable recon of OR context for GREL executor
+    https://github.com/OpenRefine/OpenRefine/wiki/Variables#recon
+    """
+    grelname = "recon"
+    hasField = has_field
+
+    def __init__(self, result):
+        self.judgment = to_grel_object(result["judgment"])
+        self.matched = to_grel_object(result["judgment"] == "matched")
+        self.match = GRELReconCandidate(result["match"]) if result["match"] else None
+        self.candidates = GRELList([GRELReconCandidate(c) for c in result["candidates"]])
+        self.best = self.candidates[0] if self.candidates else None
+        self.service = to_grel_object(result["service"])
+        self.identifierSpace = to_grel_object(result["identifierSpace"])
+        self.schemaSpace = to_grel_object(result["schemaSpace"])
+
+
+class ReconTable(object):
+    """
+    this class keeps results of reconciled column and finds recon of cells of rows
+    """
+
+    def __init__(self, cmd, results):
+        self.columns = [cmd["columnName"]] + detail_columns(cmd)
+        self.results = results
+        self.positions = {}
+        # recons are created once per key of query
+        self.recons = {}
+
+    def lookup(self, row, names):
+        """
+        :return: recon of cell of row (GRELRecon) or None
+        """
+        names = tuple(names)
+        if names not in self.positions:
+            self.positions[names] = [names.index(c) if c in names else None for c in self.columns]
+        positions = self.positions[names]
+        if positions[0] is None:
+            return None
+        key = tuple(key_of(row[p]) if p is not None else None for p in positions)
+        if key not in self.recons:
+            result = self.results.get(key)
+            self.recons[key] = GRELRecon(result) if result else None
+        return self.recons[key]
+
+    def rename(self, old, new):
+        """
+        :return: copy of table with renamed column (tables shared by earlier steps aren't changed)
+        """
+        columns = [new if c == old else c for c in self.columns]
+        table = ReconTable({"columnName": columns[0], "config": {}}, self.results)
+        table.columns = columns
+        return table
+
+
+def reset():
+    """
+    forget reconciled columns (program starts)
+    """
+    STATE.tables = {}
+
+
+def get_tables():
+    """
+    return reconciled columns of program: column name -> ReconTable
+    """
+    return dict(getattr(STATE, "tables", {}))
+
+
+def register(column, table):
+    if not hasattr(STATE, "tables"):
+        reset()
+    STATE.tables[column] = table
+
+
+def rename_column(old, new):
+    tables = getattr(STATE, "tables", {})
+    STATE.tables = dict((new if column == old else column, table.rename(old, new) if old in table.columns else table)
+                        for column, table in tables.iteritems())
+
+
+def remove_column(name):
+    getattr(STATE, "tables", {}).pop(name, None)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Sample mode for fast iteration on OpenRefine programs (--sample FRACTION|N)
+
+A seeded sample of rows is taken right after import (every partition/chunk is sampled uniformly with
+its own seed, so reruns give the same sample) and the whole program runs on it. Every step is
+materialized, so a failing step stops the run at once and its time and row count are measured.
+Times and row counts are scaled up by the sample fraction to estimate the run over the full input
+(fixed costs of steps are scaled too, so times are upper estimates).
+"""
+
+import gzip
+import os
+import random
+
+from scalableor.constant import ENGINE_LOCAL
+from scalableor.partition import input_size
+
+SEED = 42
+# lines read to estimate row count of input
+HEAD_LINES = 1000
+
+
+def parse_sample(text):
+    """
+    parse value of --sample
+
+    :return: tuple of kind ("fraction" or "rows") and value
+    """
+    try:
+        if "." in text or "e" in text.lower():
+            fraction = float(text)
+            if 0 < fraction <= 1:
+                return "fraction", fraction
+        elif int(text) > 0:
+            return "rows", int(text)
+    except ValueError:
+        pass
+    raise ValueError("sample '%s' must be a fraction in (0, 1] or a positive row count" % text)
+
+
+def estimate_rows(path):
+    """
+    estimate row count of input from its size and length of first lines
+
+    :param path:        path to input file (plain or gzip) or directory with part files
+    """
+    first = path
+    if os.path.isdir(path):
+        parts = sorted(i for i in os.listdir(path) if not i.startswith((".", "_")))
+        if not parts:
+            return 0
+        first = os.path.join(path, parts[0])
+    opener = gzip.open if first.endswith(".gz") else open
+    lines = size = 0
+    with opener(first, "rb") as f:
+        for line in f:
+            lines += 1
+            size += len(line)
+            if lines >= HEAD_LINES:
+                break
+    if not lines:
+        return 0
+    return max(lines, int(round(input_size(path) * lines / float(size))))
+
+
+def sample_fraction(text, path):
+    """
+    return fraction of rows of sample given as --sample FRACTION|N
+    """
+    kind, value = parse_sample(text)
+    if kind == "fraction":
+        return value
+    return min(1.0, value / float(max(estimate_rows(path), 1)))
+
+
+def sample_rows(rows, fraction, seed, index):
+    """
+    select rows of partition/chunk by seeded Bernoulli sampling
+    """
+    generator = random.Random(seed * 1000003 + index)
+    return [e for e in rows if generator.random() < fraction]
+
+
+def materialize(df, engine, previous=None):
+    """
+    compute result of step and count its rows
+
+    :param df:          result of step (spark data frame or local table)
+    :param engine:      name of execution engine
+    :param previous:    materialized result of previous step (spark: cached data is released)
+    :return: tuple of materialized result and row count
+    """
+    if df is None:
+        return None, None
+    if engine == ENGINE_LOCAL:
+        from scalableor.local import LocalTable
+        chunks = list(df.chunks)
+        return LocalTable(df.columns, chunks), sum(len(c) for c in chunks)
+    df = df.cache()
+    rows = df.count()
+    if previous is not None and previous is not df:
+        previous.unpersist()
+    return df, rows
+
+
+def format_report(metrics, fraction):
+    """
+    return report of sample run with estimates of full run
+
+    :param metrics:     step metrics of sample run (op, seconds, rows)
+    :param fraction:    fraction of rows of sample
+    """
+    lines = ["Sample run: %g of input rows, estimates of full run are scaled by %.1f" % (fraction, 1 / fraction),
+             "  %4s %-36s %10s %10s %14s %12s" % ("step", "op", "seconds", "rows", "est. rows", "est. seconds")]
+    for index, step in enumerate(metrics):
+        rows = step.get("rows")
+        lines.append("  %4d %-36s %10.3f %10s %14s %12.1f" % (
+            index + 1, step["op"], step["seconds"], "-" if rows is None else rows,
+            "-" if rows is None else int(round(rows / fraction)), step["seconds"] / fraction))
+    total = sum(s["seconds"] for s in metrics)
+    lines.append("  total: %.3f s on sample, estimated %.1f s on full input" % (total, total / fraction))
+    return "\n".join(lines) + "\n"
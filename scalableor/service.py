@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running Scalable.OR service
+
+The service keeps one spark context (and the shipped python code) alive and
+accepts OpenRefine programs over a local HTTP API:
+
+    POST /jobs          submit job: {"input": ..., "output": ..., "program": [...] | "or_program": path, "pool": ...}
+    GET  /jobs          list status of all jobs
+    GET  /jobs/<id>     status and metrics of one job
+    GET  /status        service status
+"""
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import threading
+import time
+import traceback
+
+from multiprocessing.pool import ThreadPool
+
+import log
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+
+class Job(object):
+    """
+    this class keeps status and metrics of a submitted OpenRefine program
+    """
+
+    def __init__(self, job_id, request):
+        self.id = job_id
+        self.request = request
+        self.pool = request.get("pool") or "job-%d" % job_id
+        self.status = QUEUED
+        self.error = None
+        self.metrics = []
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "pool": self.pool,
+            "input": self.request.get("input"),
+            "output": self.request.get("output"),
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "seconds": (self.finished or time.time()) - self.started if self.started else None,
+            "steps": self.metrics,
+        }
+
+
+class Service(object):
+    """
+    this class executes submitted jobs concurrently in own spark scheduler pools
+    """
+
+    def __init__(self, scalable_or, max_jobs=4):
+        self.scalable_or = scalable_or
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.workers = ThreadPool(max_jobs)
+
+    def submit(self, request):
+        """
+        register job and schedule its execution
+
+        :param request:     job description
+        :return: job object
+        """
+        for key in ["input", "output"]:
+            if not request.get(key):
+                raise ValueError("required parameter '%s' is undefined" % key)
+        if request.get("program") is None and request.get("or_program") is None:
+            raise ValueError("required parameter 'program' or 'or_program' is undefined")
+
+        with self.lock:
+            job = Job(next(self.ids), request)
+            self.jobs[job.id] = job
+        self.workers.apply_async(self.execute, (job,))
+        return job
+
+    def execute(self, job):
+        """
+        run OpenRefine program of job in its scheduler pool
+
+        :param job:         job object
+        """
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            program = job.request.get("program")
+            if program is None:
+                program = json.load(open(job.request["or_program"], "r"))
+
+            job.metrics = self.scalable_or.run_job(job.request["input"], job.request["output"], program, job.pool)
+            job.status = FINISHED
+        except Exception as e:
+            log.logger.error("Job %d failed: %s" % (job.id, traceback.format_exc()))
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+
+    def wait(self):
+        """
+        wait until all submitted jobs are executed
+        """
+        self.workers.close()
+        self.workers.join()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda j: j.id)
+
+    def status(self):
+        jobs = self.list()
+        counts = dict((s, 0) for s in [QUEUED, RUNNING, FINISHED, FAILED])
+        for job in jobs:
+            counts[job.status] += 1
+        # jobs of local engine run without spark context
+        sc = self.scalable_or.sc
+        return {"jobs": counts, "application_id": sc.applicationId if sc is not None else None}
+
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    JSON HTTP interface of service
+    """
+    service = None
+
+    def send_json(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = [p for p in self.path.split("?")[0].split("/") if p]
+        if parts == ["status"]:
+            return self.send_json(200, self.service.status())
+        if parts == ["jobs"]:
+            return self.send_json(200, [j.to_dict() for j in self.service.list()])
+        if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            job = self.service.get(int(parts[1]))
+            if job is not None:
+                return self.send_json(200, job.to_dict())
+        self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path.split("?")[0].rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": "not found"})
+        try:
+            length = int(self.headers.getheader("Content-Length") or 0)
+            job = self.service.submit(json.loads(self.rfile.read(length)))
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+        self.send_json(202, job.to_dict())
+
+    def log_message(self, fmt, *args):
+        log.logger.debug("%s - %s" % (self.address_string(), fmt % args))
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def bind_handler(service):
+    """
+    create request handler class of service (handlers of BaseHTTPServer are classic classes)
+    """
+
+    class BoundServiceHandler(ServiceHandler):
+        pass
+
+    BoundServiceHandler.service = service
+    return BoundServiceHandler
+
+
+def serve(scalable_or, host, port, max_jobs):
+    """
+    start service and block until it is interrupted
+
+    :param scalable_or:     initialized ScalableOR object (with spark context)
+    :param host:            listen host
+    :param port:            listen port
+    :param max_jobs:        number of concurrently running jobs
+    """
+    server = ThreadedHTTPServer((host, port), bind_handler(Service(scalable_or, max_jobs)))
+    log.logger.info("service is listening on http://%s:%d" % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.logger.info("service is stopped")
+    finally:
+        server.server_close()
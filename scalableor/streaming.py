@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous refinement of files landing in a directory (Spark Structured Streaming, spark >= 2.4)
+
+New files of input directory are read as stream of lines. Every micro-batch is split in columns
+like `scalableor/import`, refined by the row-local commands of OpenRefine program and exported to
+a part file of output directory named by batch id (a replayed batch overwrites its own part file).
+Processed files are tracked in the checkpoint location, so a restarted stream continues.
+"""
+
+import json
+import os
+import time
+
+import incremental
+import log
+
+from method import split_lines
+
+# interval of progress polling in seconds
+POLL_INTERVAL = 1
+
+
+def prepare_program(scalable_or, input_dir, output_dir, or_program):
+    """
+    check that OpenRefine program is row-local and add options of expression steps and export command
+
+    :return: sequence of OpenRefine commands without import command
+    """
+    row_local, reason = incremental.is_row_local(or_program)
+    if not row_local:
+        raise ValueError("stream requires row-local OR program: %s" % reason)
+    or_program = scalable_or.add_io_commands(input_dir, os.path.join(output_dir, "part-%05d.csv"), or_program)
+    return [cmd for cmd in or_program if cmd["op"] != "scalableor/import"]
+
+
+def progress_metrics(progress):
+    """
+    return latency and throughput of micro-batch from streaming query progress
+    """
+    return {
+        "batch": progress["batchId"],
+        "rows": progress["numInputRows"],
+        "seconds": progress.get("durationMs", {}).get("triggerExecution", 0) / 1000.0,
+        "input_rows_per_second": progress.get("inputRowsPerSecond", 0.0),
+        "processed_rows_per_second": progress.get("processedRowsPerSecond", 0.0),
+    }
+
+
+def run(scalable_or, args):
+    """
+    refine files of input directory continuously
+
+    :param scalable_or:     initialized ScalableOR object (with spark context)
+    :param args:            parsed command line arguments
+    :return: list of micro-batch metrics
+    """
+    try:
+        from pyspark.sql import SparkSession
+    except ImportError:
+        raise NotImplementedError("stream mode requires spark >= 2.4")
+
+    if None in [args.input, args.or_program, args.output_dir]:
+        raise ValueError("--stream requires --input (directory), --or-program and --output-dir.")
+
+    input_dir = os.path.abspath(args.input)
+    output_dir = os.path.abspath(args.output_dir)
+    checkpoint = args.stream_checkpoint or os.path.join(output_dir, "_checkpoint")
+    or_program = prepare_program(scalable_or, input_dir, output_dir, json.load(open(args.or_program, "r")))
+    export = or_program[-1]
+
+    session = SparkSession(scalable_or.sc)
+    reader = session.readStream
+    if args.max_files_per_trigger:
+        reader = reader.option("maxFilesPerTrigger", args.max_files_per_trigger)
+    lines = reader.text(input_dir)
+
+    def refine_batch(df, batch_id):
+        if df.rdd.isEmpty():
+            return
+        df = split_lines(df.rdd.map(lambda row: row[0]), ",", df.sql_ctx)
+        batch_program = or_program[:-1] + [dict(export, path=export["path"] % batch_id)]
+        scalable_or.refine(batch_program, df=df)
+
+    writer = lines.writeStream.foreachBatch(refine_batch).option("checkpointLocation", checkpoint)
+    if args.stream_once:
+        writer = writer.trigger(once=True)
+    else:
+        writer = writer.trigger(processingTime="%d seconds" % args.trigger_interval)
+
+    query = writer.start()
+    log.logger.info("stream: refine files of '%s' to '%s' (checkpoint '%s')" % (input_dir, output_dir, checkpoint))
+
+    started = time.time()
+    metrics = []
+    try:
+        while query.isActive:
+            query.awaitTermination(POLL_INTERVAL)
+            report_progress(query, metrics)
+            if args.stream_timeout is not None and time.time() - started > args.stream_timeout:
+                query.stop()
+    except KeyboardInterrupt:
+        query.stop()
+    report_progress(query, metrics)
+
+    if query.exception():
+        raise RuntimeError("stream is failed: %s" % query.exception())
+
+    if args.report:
+        with open(args.report, "w") as output:
+            json.dump({"batches": metrics, "seconds": time.time() - started}, output, indent=2)
+    return metrics
+
+
+def report_progress(query, metrics):
+    """
+    log latency and throughput of new completed micro-batches
+    """
+    reported = set(m["batch"] for m in metrics)
+    for progress in query.recentProgress:
+        if progress["batchId"] in reported or not progress["numInputRows"]:
+            continue
+        reported.add(progress["batchId"])
+        metrics.append(progress_metrics(progress))
+        log.logger.info("stream: batch %(batch)d: %(rows)d rows in %(seconds).2fs "
+                        "(%(processed_rows_per_second).0f rows/s)" % metrics[-1])
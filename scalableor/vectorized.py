@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Batched execution of expression steps
+
+Expressions are compiled once per batch and evaluated in a loop over the rows of batch:
+    - "batch": rows of partition are processed in batches (mapPartitions)
+    - "arrow": columns are moved as Arrow record batches (pandas UDF, requires spark >= 2.3, pandas, pyarrow)
+    - "row":   expression is evaluated for every row separately
+"""
+
+from itertools import islice
+
+from scalableor import failure, memo, pattern, recon
+from scalableor.broadcast import log_closure, share
+from scalableor.celltype import java_string
+from scalableor.context import eval_expression_batch
+from scalableor.facet import get_facet_filter
+from scalableor.plan import expression_columns, facet_columns
+
+BATCH_SIZE = 1024
+# spark task evaluated by this python worker and count of its rows passed in Arrow batches
+ARROW_TASK = [None, 0]
+
+
+def iter_batches(rows, size=BATCH_SIZE):
+    """
+    split iterator of rows into lists of given size
+    """
+    rows = iter(rows)
+    batch = list(islice(rows, size))
+    while batch:
+        yield batch
+        batch = list(islice(rows, size))
+
+
+def evaluate_rows(rows, position, exp, names, facet_filter, otherwise, context=None, on_error=None, failures=None,
+                  recons=None):
+    """
+    evaluate expression for rows selected by facets
+
+    :param rows:            list of rows
+    :param position:        position of base column
+    :param exp:             expression
+    :param names:           column names
+    :param facet_filter:    facet filter
+    :param otherwise:       callback returning value of not selected row
+    :param context:         additional variables of expression
+    :param on_error:        onError mode of failed rows (None: error is raised)
+    :param failures:        collector of failed rows (failure.Failures)
+    :param recons:          reconciled columns (see recon.get_tables)
+    :return: list of values
+    """
+    selected = [facet_filter(e) for e in rows]
+    results = iter(eval_expression_batch([e for e, s in zip(rows, selected) if s], position, exp,
+                                         context=context, names=names, on_error=on_error, failures=failures,
+                                         recons=recons))
+    return [next(results) if s else otherwise(e) for e, s in zip(rows, selected)]
+
+
+def evaluate_partitions(cmd, df, position, build, otherwise, sc=None, context=None, tracker=None):
+    """
+    evaluate expression of command in batches
+
+    :param cmd:         OpenRefine command
+    :param df:          spark data frame
+    :param position:    position of base column
+    :param build:       callback (row, value) returning new row
+    :param otherwise:   callback returning value of row not selected by facets
+    :param sc:          spark context (large expressions are broadcast)
+    :param context:     callback returning additional variables of expression (called once per partition)
+    :param tracker:     collector of failures of original command, if command is rewritten
+    :return: rdd of new rows
+    """
+    names = df.columns[:]
+    shared_exp = share(cmd["expression"], sc)
+    facet_filter = get_facet_filter(cmd, df, sc)
+    counters = pattern.accumulator(sc)
+    on_error = cmd.get("onError")
+    tracker = tracker or failure.tracker(cmd, sc)
+    shared_recons = share(recon.get_tables(), sc)
+
+    def evaluate_partition(split, rows):
+        exp = shared_exp()
+        variables = context() if context else None
+        recons = shared_recons()
+        before = pattern.stats()
+        failures = failure.Failures()
+        # pipelined steps of partition share results of pure builtins
+        with memo.scope():
+            for batch in iter_batches(rows):
+                values = evaluate_rows(batch, position, exp, names, facet_filter, otherwise, variables, on_error,
+                                       failures, recons)
+                for row, value in zip(batch, values):
+                    yield build(row, value)
+        if counters is not None:
+            counters.add({split: pattern.diff(pattern.stats(), before)})
+        failure.track(tracker, split, failures)
+
+    return df.rdd.mapPartitionsWithIndex(log_closure(cmd, evaluate_partition))
+
+
+def arrow_batch_key(size):
+    """
+    return key of Arrow batch of current spark task: partition and offset of batch in partition
+    (python worker evaluates one task at a time)
+
+    :param size:    row count of batch
+    """
+    from pyspark import TaskContext
+
+    task = TaskContext.get()
+    if ARROW_TASK[0] != task.taskAttemptId():
+        ARROW_TASK[:] = [task.taskAttemptId(), 0]
+    key = (task.partitionId(), ARROW_TASK[1])
+    ARROW_TASK[1] += size
+    return key
+
+
+def to_arrow_string(value):
+    """
+    convert result of expression to string written by CSV export of row execution (e.g. 1e10: "1.0E10")
+    """
+    return None if value is None else java_string(value)
+
+
+def arrow_positions(cmd, names, position, recons):
+    """
+    return positions of columns passed to Arrow worker: columns read by expression and facets, columns of
+    reconciled columns (all columns, if expression uses whole row)
+
+    :param cmd:         OpenRefine command
+    :param names:       column names
+    :param position:    position of base column
+    :param recons:      reconciled columns (see recon.get_tables)
+    """
+    reads = expression_columns(cmd["expression"], names[position], names) + facet_columns(cmd)
+    for facet in cmd.get("engineConfig", {}).get("facets", []):
+        if facet.get("expression") and facet.get("columnName") in names:
+            reads += expression_columns(facet["expression"], facet["columnName"], names)
+    for table in recons.values():
+        reads += table.columns
+    return [index for index, name in enumerate(names) if name in reads]
+
+
+def from_arrow(value, type_name):
+    """
+    convert value of pandas series to cell: nulls of numeric columns are NaN, integers of nullable
+    columns are floats
+    """
+    if type_name in ("long", "integer", "short", "byte"):
+        return None if value is None or value != value else int(value)
+    if type_name in ("double", "float"):
+        return None if value is None or value != value else value
+    return value
+
+
+def arrow_column(cmd, df, position, otherwise, sc=None):
+    """
+    create string column evaluating expression of command over Arrow record batches
+    (values of typed columns are formatted like CSV export, the column becomes a string column)
+
+    :param cmd:         OpenRefine command
+    :param df:          spark data frame
+    :param position:    position of base column
+    :param otherwise:   callback returning value of row not selected by facets
+    :param sc:          spark context (large expressions are broadcast)
+    :return: spark column
+    """
+    try:
+        import pandas
+        from pyspark.sql.functions import col, pandas_udf
+        from pyspark.sql.types import StringType
+    except ImportError:
+        raise NotImplementedError("arrow execution requires spark >= 2.3, pandas and pyarrow")
+
+    names = df.columns[:]
+    shared_exp = share(cmd["expression"], sc)
+    facet_filter = get_facet_filter(cmd, df, sc)
+    on_error = cmd.get("onError")
+    tracker = failure.tracker(cmd, sc)
+    recons = recon.get_tables()
+    shared_recons = share(recons, sc)
+    # only read columns are moved to python worker, other cells of rows are None
+    positions = arrow_positions(cmd, names, position, recons)
+    types = [df.schema.fields[i].dataType.typeName() for i in positions]
+
+    def evaluate(*series):
+        rows = []
+        for values in zip(*[[from_arrow(v, t) for v in s.tolist()] for s, t in zip(series, types)]):
+            row = [None] * len(names)
+            for index, value in zip(positions, values):
+                row[index] = value
+            rows.append(tuple(row))
+        failures = failure.Failures()
+        values = evaluate_rows(rows, position, shared_exp(), names, facet_filter, otherwise, on_error=on_error,
+                               failures=failures, recons=shared_recons())
+        if tracker is not None:
+            failure.track(tracker, arrow_batch_key(len(rows)), failures)
+        return pandas.Series([to_arrow_string(v) for v in values])
+
+    return pandas_udf(log_closure(cmd, evaluate), StringType())(*[col("`%s`" % names[i]) for i in positions])
@@ -1,6 +1,44 @@
 # -*- coding: utf-8 -*-
 
+from scalableor.cluster import MODE_MASS_EDIT, MODE_REPORT
+from scalableor.cross import PROJECTS, parse_cross, uses_cross
+from scalableor.facetcount import command_uses_facet_count, rewrite_command
+from scalableor.failure import ON_ERROR_MODES
+from scalableor.keyer import KEYERS
 from scalableor.manager import VerifiersManager
+from scalableor.profiling import PRECISION
+
+
+def verify_cross(exp, errors):
+    """
+    check that projects of cross() are registered
+    """
+    if exp and uses_cross(exp):
+        for project, column, key_column in parse_cross(exp, None)[1]:
+            if project not in PROJECTS:
+                errors.append("project '%s' of cross() isn't registered (--project %s=PATH)" % (project, project))
+
+
+def verify_facet_count(cmd, errors):
+    """
+    check that facetCount() calls of expression and list facets can be precomputed
+    """
+    if not command_uses_facet_count(cmd):
+        return
+    try:
+        rewrite_command(cmd)
+    except SyntaxError as e:
+        errors.append(str(e))
+    if uses_cross(cmd.get("expression") or ""):
+        errors.append("cross() and facetCount() in one command aren't supported")
+
+
+def verify_on_error(cmd, errors):
+    """
+    check onError mode of expression command
+    """
+    if cmd.get("onError") is not None and cmd["onError"] not in ON_ERROR_MODES:
+        errors.append("onError '%s' isn't supported (%s)" % (cmd["onError"], ", ".join(ON_ERROR_MODES)))
 
 
 @VerifiersManager.register("scalableor/import")
@@ -17,6 +55,12 @@ def core_column_split(cmd, errors):
         errors.append("Required parameter is undefined. List of required parameters: %s" % required_params)
 
 
+@VerifiersManager.register("scalableor/sample")
+def sc_or_sample(cmd, errors):
+    if not 0 < float(cmd.get("fraction", 0)) <= 1:
+        errors.append("fraction of sample must be in (0, 1]")
+
+
 @VerifiersManager.register("core/column-rename")
 def core_column_split(cmd, errors):
     required_params = ["oldColumnName", "newColumnName"]
@@ -55,6 +99,22 @@ def core_column_split(cmd, errors):
     required_params = ["baseColumnName", "expression", "newColumnName"]
     if None in [cmd.get(i) for i in required_params]:
         errors.append("Required parameter is undefined. List of required parameters: %s" % required_params)
+    verify_cross(cmd.get("expression"), errors)
+    verify_facet_count(cmd, errors)
+    verify_on_error(cmd, errors)
+
+
+@VerifiersManager.register("core/column-addition-by-fetching-urls")
+def core_column_addition_by_fetching_urls(cmd, errors):
+    required_params = ["baseColumnName", "urlExpression", "newColumnName"]
+    if None in [cmd.get(i) for i in required_params]:
+        errors.append("Required parameter is undefined. List of required parameters: %s" % required_params)
+    if int(cmd.get("delay") or 0) < 0:
+        errors.append("delay of URL fetching must not be negative")
+    url_exp = cmd.get("urlExpression") or ""
+    if uses_cross(url_exp) or command_uses_facet_count(dict(cmd, expression=url_exp)):
+        errors.append("cross() and facetCount() in URL expression aren't supported")
+    verify_on_error(cmd, errors)
 
 
 @VerifiersManager.register("core/text-transform")
@@ -62,6 +122,9 @@ def core_column_split(cmd, errors):
     required_params = ["columnName", "expression"]
     if None in [cmd.get(i) for i in required_params]:
         errors.append("Required parameter is undefined. List of required parameters: %s" % required_params)
+    verify_cross(cmd.get("expression"), errors)
+    verify_facet_count(cmd, errors)
+    verify_on_error(cmd, errors)
 
 
 @VerifiersManager.register("core/mass-edit")
@@ -75,3 +138,54 @@ def core_column_split(cmd, errors):
 def core_column_split(cmd, errors):
     if not cmd.get("engineConfig", {}).get("facets", []):
         errors.append("Required parameter is undefined. List of required parameters: engineConfig.facets")
+    verify_facet_count(cmd, errors)
+
+
+@VerifiersManager.register("core/multivalued-cell-split")
+def core_multivalued_cell_split(cmd, errors):
+    required_params = ["columnName", "keyColumnName"]
+    if None in [cmd.get(i) for i in required_params]:
+        errors.append("Required parameter is undefined. List of required parameters: %s" % required_params)
+    if cmd.get("mode") == "lengths" or "fieldLengths" in cmd:
+        if not isinstance(cmd.get("fieldLengths"), list) or not all(isinstance(i, int) for i in cmd["fieldLengths"]):
+            errors.append("fieldLengths must be a list of integers")
+    elif cmd.get("mode", "separator") not in ("separator", "plain", "regex"):
+        errors.append("mode '%s' isn't supported (separator, lengths)" % cmd["mode"])
+    elif not cmd.get("separator"):
+        errors.append("Required parameter is undefined. List of required parameters: ['separator']")
+
+
+@VerifiersManager.register("core/multivalued-cell-join")
+def core_multivalued_cell_join(cmd, errors):
+    required_params = ["columnName", "keyColumnName", "separator"]
+    if None in [cmd.get(i) for i in required_params]:
+        errors.append("Required parameter is undefined. List of required parameters: %s" % required_params)
+
+
+@VerifiersManager.register("scalableor/cluster")
+def sc_or_cluster(cmd, errors):
+    required_params = ["columnName", "output"]
+    if None in [cmd.get(i) for i in required_params]:
+        errors.append("Required parameter is undefined. List of required parameters: %s" % required_params)
+    if cmd.get("keyer", "fingerprint") not in KEYERS:
+        errors.append("keyer '%s' isn't supported (%s)" % (cmd["keyer"], ", ".join(sorted(KEYERS))))
+    if cmd.get("mode", MODE_REPORT) not in (MODE_REPORT, MODE_MASS_EDIT):
+        errors.append("mode '%s' isn't supported (%s, %s)" % (cmd["mode"], MODE_REPORT, MODE_MASS_EDIT))
+
+
+@VerifiersManager.register("scalableor/profile")
+def sc_or_profile(cmd, errors):
+    if cmd.get("output") is None:
+        errors.append("Required parameter is undefined. List of required parameters: ['output']")
+    if not 4 <= int(cmd.get("precision", PRECISION)) <= 16:
+        errors.append("precision of distinct count must be between 4 and 16")
+
+
+@VerifiersManager.register("core/recon")
+def core_recon(cmd, errors):
+    if None in [cmd.get("columnName"), cmd.get("config", {}).get("service")]:
+        errors.append("Required parameter is undefined. List of required parameters: ['columnName', 'config.service']")
+    if cmd.get("config", {}).get("mode", "standard-service") != "standard-service":
+        errors.append("recon mode '%s' isn't supported (standard-service)" % cmd["config"]["mode"])
+    if int(cmd.get("config", {}).get("batchSize", 1)) < 1:
+        errors.append("batchSize of recon must be positive")
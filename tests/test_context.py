@@ -6,8 +6,10 @@ import unittest
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from scalableor.context import eval_expression, GRELCell, \
-    GRELCells, GRELRow
+from scalableor import context, memo
+from scalableor.context import eval_expression, eval_expression_batch, GRELCell, \
+    GRELCells, GRELRow, LRUCache
+from scalableor.failure import Failures
 
 
 class TestPythonContext(unittest.TestCase):
@@ -295,8 +297,208 @@ class TestGRELIf(unittest.TestCase):
         self.assertEqual(0,
                          eval_expression([True], 0, "if(not(value), 1, 0)"))
 
+    def test_lazy(self):
+        # only the chosen branch is evaluated
+        exp = 'if(value == "", "blank", value.toNumber())'
+        self.assertEqual(["blank", 12], eval_expression_batch([("",), ("12",)], 0, exp))
+        self.assertEqual("b", eval_expression(["a"], 0, 'if(value == "x", 1, if(value == "a", "b", "c"))'))
+        self.assertEqual(["b"], eval_expression(["a,b"], 0, 'value.split(",").filter(v, if(v == "b", 1, 0))'))
+
 
 class TestGRELSubstring(unittest.TestCase):
     def test_base(self):
         self.assertEqual("Heid",
                          eval_expression(["Heidelberg"], 0, "value[0,4]"))
+
+
+class TestGRELNumber(unittest.TestCase):
+    def test_typed(self):
+        self.assertEqual(6, eval_expression([5], 0, "value.toNumber() + 1"))
+        self.assertEqual("1.0E10", eval_expression([1e10], 0, "value.toString()"))
+        self.assertEqual("number", eval_expression([1.5], 0, "type(value)"))
+        self.assertEqual(True, eval_expression([5], 0, "isNumeric(value)"))
+        self.assertEqual(3, eval_expression([3], 0, "toNumber(value)"))
+
+    def test_string(self):
+        self.assertEqual(13, eval_expression(["12"], 0, "value.toNumber() + 1"))
+        self.assertEqual(2.0, eval_expression(["1.5"], 0, "toNumber(value) + 0.5"))
+        self.assertEqual("true", eval_expression([True], 0, "toString(value)"))
+
+
+class TestGRELMatch(unittest.TestCase):
+    def test_base(self):
+        self.assertEqual(["12", "34"], eval_expression(["12-34"], 0, 'value.match("(\\d+)-(\\d+)")'))
+        self.assertEqual(None, eval_expression(["12-34x"], 0, 'value.match("(\\d+)-(\\d+)")'))
+        self.assertEqual([], eval_expression(["abc"], 0, 'match(value, "a.c")'))
+
+
+class TestGRELKeyer(unittest.TestCase):
+    def test_fingerprint(self):
+        self.assertEqual("cruise jr tom", eval_expression([" Tom  Cruise, Jr. "], 0, "value.fingerprint()"))
+        self.assertEqual("cruise tom", eval_expression(["Cruise, Tom"], 0, "fingerprint(value)"))
+        self.assertEqual("godel kurt", eval_expression(["Kurt G\xc3\xb6del"], 0, "value.fingerprint()"))
+
+    def test_ngram_fingerprint(self):
+        self.assertEqual("aiprs", eval_expression(["Paris"], 0, "value.ngramFingerprint(1)"))
+        self.assertEqual("arispari", eval_expression(["Paris"], 0, "ngramFingerprint(value)"))
+
+    def test_phonetic(self):
+        self.assertEqual("R163", eval_expression(["Robert"], 0, "value.phonetic()"))
+        self.assertEqual("R163", eval_expression(["Rupert"], 0, "phonetic(value, 'soundex')"))
+        self.assertEqual("T522", eval_expression(["Tymczak"], 0, "phonetic(value)"))
+        self.assertEqual("65752682", eval_expression(["M\xc3\xbcller-L\xc3\xbcdenscheidt"], 0,
+                                                     "value.phonetic('cologne')"))
+
+    def test_hash(self):
+        self.assertEqual("098f6bcd4621d373cade4e832627b4f6", eval_expression(["test"], 0, "value.md5()"))
+        self.assertEqual("a94a8fe5ccb19ba61c4c0873d391e987982fbbd3", eval_expression(["test"], 0, "sha1(value)"))
+
+
+class TestGRELControls(unittest.TestCase):
+    def test_for_each(self):
+        self.assertEqual("a,b,c", eval_expression([" a , b,c "], 0, 'value.split(",").forEach(v, v.trim()).join(",")'))
+        self.assertEqual(["A", "B"], eval_expression(["a,b"], 0, 'forEach(value.split(","), v, v.toUppercase())'))
+        self.assertEqual(["0:a", "1:b"], eval_expression(["a,b"], 0,
+                                                         'forEachIndex(value.split(","), i, v, str(i) + ":" + v)'))
+
+    def test_filter(self):
+        self.assertEqual("bb|ccc", eval_expression(["a,bb,ccc"], 0, 'value.split(",").filter(v, v.length() > 1).join("|")'))
+        self.assertEqual(["bb", "b"], eval_expression(["a,bb,b"], 0, 'filter(value.split(","), v, v.startsWith("b"))'))
+
+    def test_for_range(self):
+        self.assertEqual([0, 6, 12], eval_expression(["a"], 0, "forRange(0, 9, 3, i, i * 2)"))
+        self.assertEqual([0, 0.5], eval_expression(["a"], 0, "forRange(0, 1, 0.5, i, i)"))
+
+    def test_grel_numbers(self):
+        # loop variables are GREL numbers
+        self.assertEqual(["0:a", "1:b"], eval_expression(["a,b"], 0,
+                                                         'forEachIndex(value.split(","), i, v, i.toString() + ":" + v)'))
+        self.assertEqual([1, 2], eval_expression(["a,b"], 0, 'forEachIndex(value.split(","), i, v, i.toNumber() + 1)'))
+        self.assertEqual("0|3|6", eval_expression(["a"], 0, 'forRange(0, 9, 3, i, i.toString()).join("|")'))
+        self.assertEqual(["0.0", "0.5"], eval_expression(["a"], 0, "forRange(0, 1, 0.5, i, i.toString())"))
+
+    def test_with(self):
+        self.assertEqual("xy", eval_expression(["x,y"], 0, 'with(value.split(","), a, a[0] + a[1])'))
+        self.assertEqual("abab", eval_expression(["ab"], 0, "value.with(v, v + v)"))
+
+    def test_for_non_blank(self):
+        self.assertEqual("X", eval_expression(["x"], 0, 'forNonBlank(value, v, v.toUppercase(), "blank")'))
+        self.assertEqual("blank", eval_expression([""], 0, 'forNonBlank(value, v, v.toUppercase(), "blank")'))
+
+    def test_nested(self):
+        exp = 'forEach(value.split(";"), p, p.split(",").forEach(x, x.trim()).join("+")).join("|")'
+        self.assertEqual("a+b|c+d", eval_expression(["a, b; c ,d"], 0, exp))
+        # variable doesn't overwrite value
+        self.assertEqual("a,b a , b",
+                         eval_expression([" a , b"], 0, 'value.split(",").forEach(value, value.trim()).join(",") + value'))
+
+    def test_batch(self):
+        exp = 'value.split(",").forEach(v, v.trim()).join(",")'
+        self.assertEqual(["a,b", "c"], eval_expression_batch([(" a, b",), ("c ",)], 0, exp))
+
+    def test_invalid_variable(self):
+        self.assertRaises(SyntaxError, eval_expression, ["a"], 0, 'forEach(value.split(","), "v", v)')
+
+
+class TestBatch(unittest.TestCase):
+    def test_equal_to_row(self):
+        rows = [("Heidelberg", "1"), ("Mannheim", "2"), ("", "3")]
+        names = ["city", "id"]
+        for exp in ["value.toUppercase()", "grel:length(value) == 0", "cells['id'].value + value",
+                    "jython:return value[::-1]", "if(value.startsWith('H'), 1, 0)"]:
+            self.assertEqual([eval_expression(row, 0, exp, names=names) for row in rows],
+                             eval_expression_batch(rows, 0, exp, names=names))
+
+    def test_context(self):
+        self.assertEqual([1, 1], eval_expression_batch([["a"], ["b"]], 0, "jython:return gl_var", {"gl_var": 1}))
+
+    def test_empty(self):
+        self.assertEqual([], eval_expression_batch([], 0, "value"))
+
+
+class TestExpressionCache(unittest.TestCase):
+    def test_lru(self):
+        cache = LRUCache(2)
+        created = []
+        create = lambda key: created.append(key) or key.upper()
+        self.assertEqual("A", cache.get("a", create))
+        cache.get("b", create)
+        self.assertEqual("A", cache.get("a", create))
+        cache.get("c", create)
+        cache.get("b", create)
+        self.assertEqual(["a", "b", "c", "b"], created)
+        self.assertEqual(2, len(cache))
+
+    def test_bounded(self):
+        for i in range(context.EXPRESSION_CACHE_SIZE + 10):
+            self.assertEqual("a%d" % i, eval_expression(["a"], 0, "value + '%d'" % i))
+        for cache in [context.PREPARED_GREL, context.EXPRESSION_FUNCTIONS, context.COMPILED_EXPRESSIONS]:
+            self.assertEqual(context.EXPRESSION_CACHE_SIZE, len(cache))
+
+
+class TestOnError(unittest.TestCase):
+    def test_modes(self):
+        rows = [("1",), ("n/a",)]
+        exp = "value.toNumber() * 2"
+        self.assertEqual([2, "n/a"], eval_expression_batch(rows, 0, exp, on_error="keep-original"))
+        self.assertEqual([2, ""], eval_expression_batch(rows, 0, exp, on_error="set-to-blank"))
+        self.assertTrue(eval_expression_batch(rows, 0, exp, on_error="store-error")[1].startswith("ValueError"))
+        self.assertRaises(ValueError, eval_expression_batch, rows, 0, exp)
+
+    def test_failures(self):
+        failures = Failures(1)
+        eval_expression_batch([("a",), ("1",), ("b",)], 0, "value.toNumber()", on_error="set-to-blank",
+                              failures=failures)
+        self.assertEqual(2, failures.count)
+        self.assertEqual([u"a"], failures.samples[0]["row"])
+        self.assertEqual(1, len(failures.samples))
+
+
+class TestMemo(unittest.TestCase):
+    def test_steps(self):
+        rows = [('{"a": 1, "b": "x|y"}',), ('{"a": 2, "b": "z"}',), ('{"a": 1, "b": "x|y"}',)]
+        before = memo.stats()
+        # scope of partition of pipelined steps
+        with memo.scope():
+            self.assertEqual([1, 2, 1], eval_expression_batch(rows, 0, "value.parseJson()['a']"))
+            self.assertEqual([u"x|y", u"z", u"x|y"], eval_expression_batch(rows, 0, "parseJson(value)['b']"))
+        after = memo.stats()
+        # 2 distinct values are parsed once for both steps
+        self.assertEqual(2, after["misses"] - before["misses"])
+        self.assertEqual(4, after["hits"] - before["hits"])
+
+    def test_types(self):
+        self.assertEqual(["a", "b"], eval_expression(["a|b"], 0, "value.split('|')"))
+        self.assertEqual(["1", "2"], eval_expression(["1|2"], 0, "split(value, '|')"))
+        self.assertEqual(1, eval_expression(["1"], 0, "parseJson(value)"))
+        self.assertEqual(1.5, eval_expression(["1.5"], 0, "parseJson(value)"))
+
+    def test_scope(self):
+        before = memo.stats()
+        eval_expression_batch([("a|b",)], 0, "value.split('|')")
+        eval_expression_batch([("a|b",)], 0, "value.split('|')")
+        eval_expression(["a|b"], 0, "value.split('|')")
+        after = memo.stats()
+        # results aren't kept between batches, rows outside of scope aren't memoized
+        self.assertEqual((2, 0), (after["misses"] - before["misses"], after["hits"] - before["hits"]))
+
+    def test_mutation(self):
+        exp = 'jython:l = value.split("|")\nl.append("x")\nreturn ",".join(l)'
+        self.assertEqual(["a,b,x"] * 3, eval_expression_batch([("a|b",)] * 3, 0, exp))
+        with memo.scope():
+            for i in range(2):
+                result = context.parse_json('{"b": [1]}')
+                self.assertEqual({"b": [1]}, result)
+                result["b"].append(2)
+        self.assertEqual([None, ["1"]], [memo.copy_list(None), memo.copy_list(context.GRELList(["1"]))])
+
+    def test_generations(self):
+        results = memo.Memo(size=2)
+        calls = []
+        square = lambda x: calls.append(x) or x * x
+        for value in [1, 2, 3, 1, 4, 5, 1]:
+            results.call(square, (value,))
+        # 1 is kept in the current or previous generation while it is used
+        self.assertEqual([1, 2, 3, 4, 5], calls)
+        self.assertEqual(25, results.call(lambda x: None, (5,)))
+        self.assertEqual([[1]], [results.call(lambda x: x, ([1],))])
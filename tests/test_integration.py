@@ -1,21 +1,39 @@
 # -*- coding: utf-8 -*-
+import BaseHTTPServer
 import csv
+import httplib
+import json
 import os
+import SocketServer
+import StringIO
 import sys
+import threading
+import time
 import unittest
+import urlparse
 
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 import scalableor
 
+try:
+    import pyspark
+except ImportError:
+    pyspark = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
 CASES_DIR = os.path.join(CURRENT_DIR, "integration")
 
 
 # generate tests
-def do_test_expected(self, case, order_is_relevant=True):
+def do_test_expected(self, case, order_is_relevant=True, engine="spark", options=()):
     file_in = os.path.join(CASES_DIR, case, "input.csv")
     file_or = os.path.join(CASES_DIR, case, "or.json")
     file_result = os.path.join(CASES_DIR, case, "output.csv")
@@ -26,8 +44,9 @@ def do_test_expected(self, case, order_is_relevant=True):
         "-i", file_in,
         "-p", file_or,
         "-o", file_out.name + ".csv",
-        "-l"
-    ])
+        "-l",
+        "--engine", engine
+    ] + list(options))
     file_out = open(file_out.name + ".csv", "r")
 
     expected_lines = list(csv.reader(open(file_result, "r")))
@@ -108,3 +127,1178 @@ class TestORRowRemoval(unittest.TestCase):
 class TestORBigTest(unittest.TestCase):
     def test_base(self):
         return do_test_expected(self, "or-demo-wiki")
+
+
+class TestLocalEngine(unittest.TestCase):
+    def test_cases(self):
+        for case in sorted(os.listdir(CASES_DIR)):
+            do_test_expected(self, case, engine="local")
+
+    def test_single_process(self):
+        do_test_expected(self, "core-text-transform-facet", engine="local", options=["--local-processes", "1"])
+        self.assertEqual(1, scalableor.local.PROCESSES)
+        self.assertEqual(None, scalableor.local.POOL)
+
+    def test_pool_closed(self):
+        do_test_expected(self, "core-text-transform-facet", engine="local", options=["--local-processes", "2"])
+        # pool of expression steps is terminated after job
+        self.assertEqual((None, 0), (scalableor.local.POOL, scalableor.local.POOL_USERS))
+
+    def test_csv_quoting(self):
+        format_csv_row = scalableor.local.format_csv_row
+        self.assertEqual(u'a,"b,c",""""', format_csv_row([u"a", u"b,c", u'"']))
+        self.assertEqual(u'"",,"#1"', format_csv_row([u"", u"", u"#1"]))
+        self.assertEqual(u'"-1",true,null,1.5,1.0E10', format_csv_row([u"-1", True, None, 1.5, 1e10]))
+
+
+def local_scalable_or(*options):
+    """
+    create ScalableOR object refining jobs with local engine
+    """
+    return scalableor.run(argv=["-p", os.path.join(CASES_DIR, "core-column-move", "or.json"), "--verify-only",
+                                "--engine", "local"] + list(options))
+
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        case_dir = os.path.join(CASES_DIR, "core-text-transform")
+        self.work_dir = mkdtemp()
+        self.file_in = os.path.join(case_dir, "input.csv")
+        self.program = json.load(open(os.path.join(case_dir, "or.json")))
+        self.expected = list(csv.reader(open(os.path.join(case_dir, "output.csv"))))
+        self.service = scalableor.service.Service(local_scalable_or(), max_jobs=2)
+        self.server = start_server(scalableor.service.bind_handler(self.service))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.wait()
+
+    def request(self, method, path, body=None):
+        connection = httplib.HTTPConnection("127.0.0.1", self.server.server_port, timeout=10)
+        connection.request(method, path, json.dumps(body) if body is not None else None)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def wait_job(self, job_id):
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            status, job = self.request("GET", "/jobs/%d" % job_id)
+            if job["status"] in (scalableor.service.FINISHED, scalableor.service.FAILED):
+                return job
+            time.sleep(0.05)
+        self.fail("job %d isn't finished" % job_id)
+
+    def test_submit(self):
+        file_out = os.path.join(self.work_dir, "output.csv")
+        status, job = self.request("POST", "/jobs", {"input": self.file_in, "output": file_out,
+                                                     "program": self.program})
+        self.assertEqual(202, status)
+        self.assertEqual("job-%d" % job["id"], job["pool"])
+
+        job = self.wait_job(job["id"])
+        self.assertEqual((scalableor.service.FINISHED, None), (job["status"], job["error"]))
+        self.assertEqual(["scalableor/import", "core/text-transform", "scalableor/export"],
+                         [step["op"] for step in job["steps"]])
+        self.assertEqual(self.expected, list(csv.reader(open(file_out))))
+
+        self.assertEqual([job["id"]], [j["id"] for j in self.request("GET", "/jobs")[1]])
+        status, service_status = self.request("GET", "/status")
+        self.assertEqual((200, 1, None), (status, service_status["jobs"]["finished"],
+                                          service_status["application_id"]))
+
+    def test_errors(self):
+        status, error = self.request("POST", "/jobs", {"input": self.file_in, "program": self.program})
+        self.assertEqual((400, "required parameter 'output' is undefined"), (status, error["error"]))
+        self.assertEqual(404, self.request("GET", "/jobs/99")[0])
+        self.assertEqual(404, self.request("POST", "/programs", {})[0])
+
+        # failed job is reported, service keeps running
+        status, job = self.request("POST", "/jobs", {"input": os.path.join(self.work_dir, "missing.csv"),
+                                                     "output": os.path.join(self.work_dir, "output.csv"),
+                                                     "program": self.program})
+        self.assertEqual(202, status)
+        job = self.wait_job(job["id"])
+        self.assertEqual(scalableor.service.FAILED, job["status"])
+        self.assertIn("missing.csv", job["error"])
+        self.assertEqual(1, self.request("GET", "/status")[1]["jobs"]["failed"])
+
+    def test_concurrent(self):
+        outputs = [os.path.join(self.work_dir, "output%d.csv" % i) for i in range(4)]
+        jobs = [self.service.submit({"input": self.file_in, "output": output, "program": self.program})
+                for output in outputs]
+        self.service.wait()
+        self.assertEqual([scalableor.service.FINISHED] * 4, [job.status for job in jobs])
+        self.assertEqual(4, len(set(job.pool for job in jobs)))
+        for output in outputs:
+            self.assertEqual(self.expected, list(csv.reader(open(output))))
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.case_dir = os.path.join(CASES_DIR, "core-text-transform")
+        self.work_dir = mkdtemp()
+        self.expected = list(csv.reader(open(os.path.join(self.case_dir, "output.csv"))))
+
+    def test_manifest(self):
+        file_json, file_csv = [os.path.join(self.work_dir, i) for i in ["batch.json", "batch.csv"]]
+        json.dump([{"input": "a.csv", "or_program": "or.json", "output": "out/a.csv"},
+                   {"input": "/data/b.csv", "program": [], "output": "b.csv"}], open(file_json, "w"))
+        open(file_csv, "w").write("# input,or_program,output\na.csv, or.json ,out/a.csv\n\n")
+
+        self.assertEqual([{"input": os.path.join(self.work_dir, "a.csv"),
+                           "or_program": os.path.join(self.work_dir, "or.json"),
+                           "output": os.path.join(self.work_dir, "out/a.csv")},
+                          {"input": "/data/b.csv", "program": [], "output": os.path.join(self.work_dir, "b.csv")}],
+                         scalableor.batch.load_manifest(file_json))
+        self.assertEqual(scalableor.batch.load_manifest(file_json)[:1], scalableor.batch.load_manifest(file_csv))
+
+    def test_glob(self):
+        for name in ["b.csv", "a.csv", "c.txt"]:
+            open(os.path.join(self.work_dir, name), "w").write("x\n")
+        file_or = os.path.join(self.case_dir, "or.json")
+        requests = scalableor.batch.glob_manifest(os.path.join(self.work_dir, "*.csv"), file_or, "/out")
+        self.assertEqual([(os.path.join(self.work_dir, "a.csv"), "/out/a.csv"),
+                          (os.path.join(self.work_dir, "b.csv"), "/out/b.csv")],
+                         [(r["input"], r["output"]) for r in requests])
+        self.assertEqual(json.load(open(file_or)), requests[0]["program"])
+        self.assertRaises(ValueError, scalableor.batch.glob_manifest, "*.csv", file_or, None)
+
+    def test_glob_outputs(self):
+        file_or = os.path.join(self.case_dir, "or.json")
+        for name in ["x", "y"]:
+            os.mkdir(os.path.join(self.work_dir, name))
+            open(os.path.join(self.work_dir, name, "a.csv"), "w").write("x\n")
+        # inputs of the same name in different directories
+        requests = scalableor.batch.glob_manifest(os.path.join(self.work_dir, "*", "a.csv"), file_or, "/out")
+        self.assertEqual(["/out/x/a.csv", "/out/y/a.csv"], [r["output"] for r in requests])
+        self.assertEqual(os.path.join(self.work_dir, "x"), scalableor.batch.glob_root(os.path.join(self.work_dir,
+                                                                                                  "x", "*.csv")))
+        # output directory is input directory or inside of input
+        for output_dir in [os.path.join(self.work_dir, "x"), os.path.join(self.work_dir, "x", "a.csv", "out")]:
+            self.assertRaises(ValueError, scalableor.batch.glob_manifest, os.path.join(self.work_dir, "x", "*.csv"),
+                              file_or, output_dir)
+        self.assertRaises(ValueError, scalableor.batch.check_outputs,
+                          [{"input": "a.csv", "output": "out.csv"}, {"input": "b.csv", "output": "out.csv"}])
+
+    def test_failed_job(self):
+        manifest, report = [os.path.join(self.work_dir, i) for i in ["batch.csv", "report.json"]]
+        file_in, file_or = [os.path.join(self.case_dir, i) for i in ["input.csv", "or.json"]]
+        with open(manifest, "w") as f:
+            for name in ["first", "missing", "second"]:
+                f.write("%s,%s,%s.csv\n" % (file_in if name != "missing" else "missing.csv", file_or, name))
+
+        scalable_or = local_scalable_or()
+        args = scalable_or.get_args(["--batch", manifest, "--report", report, "--max-jobs", "2"])
+        self.assertFalse(scalableor.batch.run(scalable_or, args))
+
+        result = json.load(open(report))
+        self.assertEqual((3, 2, 1), (result["total"], result["finished"], result["failed"]))
+        self.assertEqual(["finished", "failed", "finished"], [j["status"] for j in result["jobs"]])
+        self.assertIn("missing.csv", result["jobs"][1]["error"])
+        # other jobs aren't affected by failed job
+        for name in ["first", "second"]:
+            self.assertEqual(self.expected, list(csv.reader(open(os.path.join(self.work_dir, name + ".csv")))))
+
+
+class TestIncremental(unittest.TestCase):
+    def run_incremental(self, file_in, file_out, case):
+        scalableor.run(argv=["-i", file_in, "-p", os.path.join(CASES_DIR, case, "or.json"), "-o", file_out,
+                             "--engine", "local", "--incremental"])
+        return open(file_out, "r").read()
+
+    def test_append(self):
+        case = "core-text-transform-facet"
+        lines = open(os.path.join(CASES_DIR, case, "input.csv"), "r").read().splitlines(True)
+        work_dir = mkdtemp()
+        file_in = os.path.join(work_dir, "input.csv")
+        file_out = os.path.join(work_dir, "output.csv")
+
+        open(file_in, "w").writelines(lines[:2])
+        first = self.run_incremental(file_in, file_out, case)
+        open(file_in, "a").writelines(lines[2:])
+        result = self.run_incremental(file_in, file_out, case)
+        self.assertTrue(result.startswith(first))
+        self.assertEqual(result, self.run_incremental(file_in, file_out, case))
+
+        os.remove(file_out + ".state.json")
+        self.assertEqual(result, self.run_incremental(file_in, file_out, case))
+
+    def test_append_during_run(self):
+        case = "core-text-transform-facet"
+        lines = open(os.path.join(CASES_DIR, case, "input.csv"), "r").read().splitlines(True)
+        work_dir = mkdtemp()
+        expected = []
+        for count in [2, 3, len(lines)]:
+            file_part = os.path.join(work_dir, "part-%d.csv" % count)
+            open(file_part, "w").writelines(lines[:count])
+            expected.append(self.run_incremental(file_part, file_part + ".out", case))
+        file_in = os.path.join(work_dir, "input.csv")
+        file_out = os.path.join(work_dir, "output.csv")
+        open(file_in, "w").writelines(lines[:2])
+
+        scan_input = scalableor.incremental.scan_input
+
+        def scan_and_append(path):
+            files = scan_input(path)
+            # rows are appended between scan and copy, last line is half-written
+            open(path, "a").write(lines[2] + lines[3][:3])
+            return files
+
+        scalableor.incremental.scan_input = scan_and_append
+        try:
+            self.assertEqual(expected[0], self.run_incremental(file_in, file_out, case))
+        finally:
+            scalableor.incremental.scan_input = scan_input
+        self.assertEqual(expected[1], self.run_incremental(file_in, file_out, case))
+        open(file_in, "a").writelines([lines[3][3:]] + lines[4:])
+        self.assertEqual(expected[2], self.run_incremental(file_in, file_out, case))
+
+    def test_order_dependent(self):
+        file_in = os.path.join(CASES_DIR, "core-text-transform", "input.csv")
+        or_program = [{"op": "scalableor/import", "separator": ",", "path": file_in},
+                      {"op": "core/fill-down", "columnName": "Column 1"}]
+        self.assertEqual(False, scalableor.incremental.is_row_local(or_program)[0])
+        self.assertEqual(True, scalableor.incremental.is_row_local(or_program[:1])[0])
+
+
+class TestStream(unittest.TestCase):
+    @unittest.skipIf(pyspark is None, "pyspark isn't installed")
+    def test_directory(self):
+        case = "core-text-transform"
+        input_dir, output_dir = mkdtemp(), mkdtemp()
+        open(os.path.join(input_dir, "input.csv"), "w").write(open(os.path.join(CASES_DIR, case, "input.csv")).read())
+
+        scalableor.run(argv=["-i", input_dir, "-p", os.path.join(CASES_DIR, case, "or.json"),
+                             "--output-dir", output_dir, "--stream", "--stream-once", "-l"])
+
+        actual_lines = []
+        for fname in sorted(os.listdir(output_dir)):
+            if fname.startswith("part-"):
+                actual_lines += list(csv.reader(open(os.path.join(output_dir, fname), "r")))
+        expected_lines = list(csv.reader(open(os.path.join(CASES_DIR, case, "output.csv"), "r")))
+        self.assertEqual(sorted(expected_lines), sorted(actual_lines))
+
+    def test_order_dependent(self):
+        self.assertRaises(ValueError, scalableor.streaming.prepare_program, None, "", "",
+                          [{"op": "core/fill-down", "columnName": "Column 1"}])
+
+
+class TestCheckpoint(unittest.TestCase):
+    def get_checkpoints(self, every=None):
+        or_program = json.load(open(os.path.join(CASES_DIR, "or-demo-wiki", "or.json")))
+        or_program.insert(0, {"op": "scalableor/import", "separator": ",",
+                              "path": os.path.join(CASES_DIR, "or-demo-wiki", "input.csv")})
+        return scalableor.checkpoint.Checkpoints(mkdtemp(), or_program, every, resume=True)
+
+    def test_due(self):
+        checkpoints = self.get_checkpoints(every=3)
+        self.assertEqual([2, 5], [i for i in range(7) if checkpoints.is_due(i, {"op": "core/column-rename"})])
+        self.assertTrue(self.get_checkpoints().is_due(0, {"op": "core/column-rename", "checkpoint": True}))
+        self.assertFalse(self.get_checkpoints().is_due(0, {"op": "core/column-rename"}))
+
+    def test_key(self):
+        self.assertEqual(os.path.basename(self.get_checkpoints().directory),
+                         os.path.basename(self.get_checkpoints(every=3).directory))
+
+    def test_nothing_to_resume(self):
+        self.assertEqual((0, None), self.get_checkpoints().load(None))
+
+    def test_resume_before_recon(self):
+        or_program = [{"op": "scalableor/import", "separator": ",", "path": "input.csv"},
+                      {"op": "core/recon", "columnName": "Column 1", "config": {}},
+                      {"op": "core/column-rename", "oldColumnName": "Column 1", "newColumnName": "name"}]
+        checkpoints = scalableor.checkpoint.Checkpoints(mkdtemp(), or_program, resume=True)
+        files = scalableor.checkpoint.get_files(None)
+        os.makedirs(checkpoints.directory)
+        for index in [1, 2]:
+            files.write(checkpoints.manifest_path(index), json.dumps({"step": index, "path": "", "columns": []}))
+        # reconciled columns of step 2 aren't checkpointed
+        self.assertEqual((0, None), checkpoints.load(None))
+
+    def test_local_files(self):
+        files, directory = scalableor.checkpoint.get_files(None), mkdtemp()
+        path = os.path.join(directory, "step-00001.json")
+        files.write(path, json.dumps({"step": 1}))
+        self.assertEqual((True, ["step-00001.json"]), (files.exists(path), files.list(directory)))
+        self.assertEqual({"step": 1}, json.loads(files.read(path)))
+        files.delete(directory)
+        self.assertFalse(files.exists(directory))
+
+    @unittest.skipIf(pyspark is None, "pyspark isn't installed")
+    def test_resume(self):
+        case = "or-demo-wiki"
+        checkpoint_dir = mkdtemp()
+        file_out = os.path.join(mkdtemp(), "output.csv")
+        argv = ["-i", os.path.join(CASES_DIR, case, "input.csv"), "-p", os.path.join(CASES_DIR, case, "or.json"),
+                "-o", file_out, "-l", "--engine", "spark", "--checkpoint-dir", checkpoint_dir]
+
+        scalableor.run(argv=argv + ["--checkpoint-every", "2"])
+        # checkpoints are removed after successful run
+        self.assertEqual([], [i for i in os.listdir(checkpoint_dir) if os.listdir(os.path.join(checkpoint_dir, i))])
+        scalableor.run(argv=argv + ["--resume"])
+        self.assertEqual(list(csv.reader(open(os.path.join(CASES_DIR, case, "output.csv"), "r"))),
+                         list(csv.reader(open(file_out, "r"))))
+
+
+class TestSharedPayload(unittest.TestCase):
+    def test_edit_map(self):
+        cmd = {"edits": [{"from": ["a", "b"], "to": "x"}, {"from": ["b", "c"], "to": "y"}]}
+        self.assertEqual({"a": "x", "b": "x", "c": "y"}, scalableor.method.get_edit_map(cmd))
+        func = scalableor.method.get_mass_edit_function(cmd, 1)
+        self.assertEqual((1, "y", 2), func((1, "c", 2)))
+        self.assertEqual((1, "d", 2), func((1, "d", 2)))
+
+    def test_share_without_spark(self):
+        value = ["v"] * scalableor.broadcast.BROADCAST_THRESHOLD
+        self.assertIs(value, scalableor.broadcast.share(value)())
+
+    def test_log_closure(self):
+        class Broadcast(object):
+            def __init__(self, value):
+                self.value = value
+
+        class SparkContext(object):
+            broadcast = Broadcast
+
+        broadcast = scalableor.broadcast
+        logger, scalableor.log.logger = scalableor.log.logger, Log4jLogger()
+        try:
+            messages = scalableor.log.logger.messages
+            cmd = {"op": "core/mass-edit"}
+            small, large = "x", ["v"] * broadcast.BROADCAST_THRESHOLD
+            self.assertEqual([small, large], [broadcast.share(v, SparkContext())() for v in [small, large]])
+            func = lambda e: e
+            # closure is logged once per step at info level
+            self.assertIs(func, broadcast.log_closure(cmd, func))
+            broadcast.log_closure(cmd, func)
+        finally:
+            scalableor.log.logger = logger
+        closures = [m for level, m in messages if level == "info" and m.startswith("closure")]
+        self.assertEqual(["closure of 'core/mass-edit': %d bytes of payloads in closure, %d bytes broadcast" % (
+            broadcast.payload_size(small), broadcast.payload_size(large))], closures)
+
+
+class TestPartition(unittest.TestCase):
+    def repartition(self, partitions, count):
+        # repartition_ordered without spark: rows keyed by index are range partitioned and sorted
+        counts = [len(p) for p in partitions]
+        index = scalableor.partition.index_partition(scalableor.partition.partition_starts(counts))
+        partition_of = scalableor.partition.range_partitioner(sum(counts), count)
+        result = [[] for _ in range(count)]
+        for split, rows in enumerate(partitions):
+            for i, row in index(split, iter(rows)):
+                result[partition_of(i)].append((i, row))
+        return [[row for i, row in sorted(p)] for p in result]
+
+    def test_repartition_ordered(self):
+        partitions = [[], ["a", "b", "c", "d", "e"], ["f"], [], ["g", "h", "i"]]
+        result = self.repartition(partitions, 3)
+        self.assertEqual([["a", "b", "c"], ["d", "e", "f"], ["g", "h", "i"]], result)
+        self.assertEqual([[], []], self.repartition([[], []], 2))
+
+    def test_repartition_balanced(self):
+        # single partition of (gzip) input is split into partitions of equal size
+        result = self.repartition([[str(i) for i in range(1000)]], 8)
+        self.assertEqual([125] * 8, [len(p) for p in result])
+        self.assertEqual([str(i) for i in range(1000)], sum(result, []))
+
+    def test_before_step(self):
+        addition = {"op": "core/column-addition", "baseColumnName": "a", "newColumnName": "b", "expression": "value"}
+        info = scalableor.plan.core_column_addition(addition, ["a"], [])
+        mass_edit = scalableor.plan.core_mass_edit({"columnName": "a"}, ["a"], [])
+        removal = scalableor.plan.core_row_removal({"op": "core/row-removal"}, ["a"], [])
+        step_partitions = scalableor.partition.step_partitions
+
+        # expression step after unknown or resizing step
+        self.assertEqual(8, step_partitions(addition, info, None, 2, 8))
+        self.assertEqual(8, step_partitions(addition, info, removal, 2, 8))
+        self.assertEqual(None, step_partitions(addition, info, removal, 8, 8))
+        # partitioning isn't changed by previous step
+        self.assertEqual(None, step_partitions(addition, info, mass_edit, 2, 8))
+        self.assertEqual(None, step_partitions(addition, info, info, 2, 8))
+        # not an expression step
+        self.assertEqual(None, step_partitions({"columnName": "a"}, mass_edit, None, 2, 8))
+        # explicit partition count
+        self.assertEqual(4, step_partitions(dict(addition, repartition=4), info, mass_edit, 2, 8))
+
+    def test_release(self):
+        class RDD(object):
+            persisted = True
+
+            def unpersist(self):
+                self.persisted = False
+
+        rdd = RDD()
+        scalableor.partition.STATE.persisted = [rdd]
+        # rdd counted and repartitioned before step is unpersisted at the end of job
+        local_scalable_or().refine([], engine="local")
+        self.assertEqual((False, []), (rdd.persisted, scalableor.partition.STATE.persisted))
+
+
+class TestArrowExecution(unittest.TestCase):
+    VALUES = [("number", "10000000000.0"), ("small", "0.00001"), ("integer", "42"), ("boolean", "True"),
+              ("none", "None"), ("date", "__import__('datetime').date(2020, 1, 2)"), ("text", "u'\\xe4'")]
+
+    def test_format(self):
+        format_csv_row = scalableor.local.format_csv_row
+        to_arrow_string = scalableor.vectorized.to_arrow_string
+        for name, value in self.VALUES:
+            value = eval(value)
+            self.assertEqual(format_csv_row([value]), format_csv_row([to_arrow_string(value)]))
+        self.assertEqual(None, to_arrow_string(None))
+
+    def test_columns(self):
+        arrow_positions = scalableor.vectorized.arrow_positions
+        names = ["a", "b", "c", "d"]
+        cmd = {"expression": 'grel:value + cells["c"].value',
+               "engineConfig": {"facets": [{"type": "list", "columnName": "d", "expression": "value"}]}}
+        self.assertEqual([0, 2, 3], arrow_positions(cmd, names, 0, {}))
+        self.assertEqual([1], arrow_positions({"expression": "grel:value"}, names, 1, {}))
+        self.assertEqual([0, 1, 2, 3], arrow_positions({"expression": "jython:return row"}, names, 1, {}))
+        table = scalableor.recon.ReconTable({"columnName": "d", "config": {}}, {})
+        self.assertEqual([1, 3], arrow_positions({"expression": "grel:value"}, names, 1, {"d": table}))
+
+    def test_nullable_numbers(self):
+        from_arrow = scalableor.vectorized.from_arrow
+        # long column with nulls is a float series with NaN
+        self.assertEqual([2, None, None], [from_arrow(v, "long") for v in [2.0, float("nan"), None]])
+        self.assertEqual(int, type(from_arrow(2.0, "long")))
+        self.assertEqual([1.5, None], [from_arrow(v, "double") for v in [1.5, float("nan")]])
+        self.assertEqual(["x", None], [from_arrow(v, "string") for v in ["x", None]])
+
+    @unittest.skipIf(pyspark is None or pyarrow is None, "pyspark or pyarrow isn't installed")
+    def test_arrow_like_row(self):
+        file_in = os.path.join(CASES_DIR, "core-text-transform", "input.csv")
+        program = NamedTemporaryFile(suffix=".json")
+        # every column has values of one type
+        json.dump([{"op": "core/column-addition", "baseColumnName": "Column 1", "newColumnName": name,
+                    "expression": "jython:return %s" % value, "engineConfig": {"facets": []}}
+                   for name, value in self.VALUES], program)
+        program.flush()
+
+        outputs = []
+        for execution in ["row", "arrow"]:
+            file_out = NamedTemporaryFile(suffix=".csv")
+            scalableor.run(argv=["-i", file_in, "-p", program.name, "-o", file_out.name, "-l",
+                                 "--execution", execution])
+            outputs.append(list(csv.reader(open(file_out.name, "r"))))
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class TestCellType(unittest.TestCase):
+    def test_guess(self):
+        rows = [(u"1", u"1.5", u"true", u"2017-01-02", u"007", u""),
+                (u"-2", u"", u"false", u"2017-02-01", u"8", u""),
+                (u"3", u"1.0E10", u"", u"", u"9", u"")]
+        self.assertEqual(["long", "double", "boolean", "date", "string", "string"],
+                         scalableor.celltype.guess_types(rows))
+        self.assertEqual(["string", "string"], scalableor.celltype.guess_types([(u"1", u"1.50"), (u"1.5", u"2")]))
+
+    def test_local_import(self):
+        work_dir = mkdtemp()
+        file_in, file_or, file_out = [os.path.join(work_dir, i) for i in ["input.csv", "or.json", "output.csv"]]
+        open(file_in, "w").write("1,1.5,true,2017-01-02,007\n2,,false,2017-02-30,8\n")
+        json.dump([{"op": "core/column-addition", "baseColumnName": "Column 1", "newColumnName": "next",
+                    "expression": "grel:value + 1"}], open(file_or, "w"))
+        scalableor.run(argv=["-i", file_in, "-p", file_or, "-o", file_out, "--engine", "local",
+                             "--guess-cell-type"])
+        self.assertEqual(["1,2,1.5,true,2017-01-02,007", "2,3,,false,2017-02-30,8"],
+                         open(file_out).read().splitlines())
+
+    def run_typed(self, program, lines):
+        work_dir = mkdtemp()
+        file_in, file_or, file_out = [os.path.join(work_dir, i) for i in ["input.csv", "or.json", "output.csv"]]
+        open(file_in, "w").write("".join(line + "\n" for line in lines))
+        json.dump(program, open(file_or, "w"))
+        scalableor.run(argv=["-i", file_in, "-p", file_or, "-o", file_out, "--engine", "local",
+                             "--guess-cell-type"])
+        return open(file_out).read().splitlines()
+
+    def test_string_steps(self):
+        text_facet = {"type": "text", "columnName": "Column 1", "query": "2", "mode": "text", "caseSensitive": False}
+        list_facet = {"type": "list", "columnName": "Column 2", "selection": [{"v": {"v": 1.5, "l": "1.5"}}]}
+        removal = [{"op": "core/row-removal", "engineConfig": {"facets": [facet]}} for facet in [text_facet, list_facet]]
+        self.assertEqual(["1,2.5", "3,"], self.run_typed(removal, ["1,2.5", "12,1.5", "3,"]))
+
+        split = [{"op": "core/column-split", "columnName": "Column 2", "separator": ".", "removeOriginalColumn": True},
+                 {"op": "core/column-split", "columnName": "Column 1", "fieldLengths": [1, 1]}]
+        self.assertEqual(["1,1,,2,5", "12,1,2,1,5"], self.run_typed(split, ["1,2.5", "12,1.5"]))
+
+        edit = [{"op": "core/mass-edit", "columnName": "Column 1", "expression": "value",
+                 "edits": [{"from": ["2"], "to": "two"}, {"from": [3], "to": "three"}]}]
+        self.assertEqual(["1", "two", "three"], self.run_typed(edit, ["1", "2", "3"]))
+
+    def test_multivalued_steps(self):
+        program = [{"op": "core/multivalued-cell-split", "columnName": "Column 2", "keyColumnName": "Column 1",
+                    "mode": "separator", "separator": "."},
+                   {"op": "core/multivalued-cell-join", "columnName": "Column 2", "keyColumnName": "Column 1",
+                    "separator": "-"}]
+        lines = ["1,2.5", "2,1.5", "3,"]
+        self.assertEqual(["1,2", '"",5', "2,1", '"",5', "3,"], self.run_typed(program[:1], lines))
+        self.assertEqual(["1,2-5", "2,1-5", "3,"], self.run_typed(program, lines))
+        # values of typed cells are joined as text
+        self.assertEqual(["1,2.5-1.5", "2,3.0"], self.run_typed(program[1:], ["1,2.5", ",1.5", "2,3.0"]))
+
+
+class Log4jLogger(object):
+    """
+    logger of log4j (spark) has only these methods
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def isDebugEnabled(self):
+        return False
+
+    def debug(self, message):
+        self.messages.append(("debug", message))
+
+    def info(self, message):
+        self.messages.append(("info", message))
+
+    def warn(self, message):
+        self.messages.append(("warn", message))
+
+    def error(self, message):
+        self.messages.append(("error", message))
+
+
+class TestOnError(unittest.TestCase):
+    def test_log4j_logger(self):
+        logger, scalableor.log.logger = scalableor.log.logger, Log4jLogger()
+        try:
+            messages = scalableor.log.logger.messages
+            self.test_local()
+        finally:
+            scalableor.log.logger = logger
+        self.assertEqual(3, len([m for level, m in messages if level == "warn"]))
+
+    def test_local(self):
+        work_dir = mkdtemp()
+        file_in, file_or, file_out = [os.path.join(work_dir, i) for i in ["input.csv", "or.json", "output.csv"]]
+        open(file_in, "w").write("1\nn/a\n3\n")
+        json.dump([{"op": "core/column-addition", "baseColumnName": "Column 1", "newColumnName": "error",
+                    "expression": "grel:value.toNumber() * 2", "onError": "store-error"},
+                   {"op": "core/text-transform", "columnName": "Column 1", "expression": "grel:value.toNumber() * 2",
+                    "onError": "keep-original"}], open(file_or, "w"))
+        scalableor.run(argv=["-i", file_in, "-p", file_or, "-o", file_out, "--engine", "local"])
+        rows = list(csv.reader(open(file_out)))
+        self.assertEqual([["2", "2"], ["n/a"], ["6", "6"]], [rows[0], rows[1][:1], rows[2]])
+        self.assertTrue(rows[1][1].startswith("ValueError"))
+        report = json.load(open(file_out + ".errors.json"))
+        self.assertEqual([(2, "store-error", 1), (3, "keep-original", 1)],
+                         [(i["step"], i["onError"], i["count"]) for i in report])
+        self.assertEqual([u"n/a"], report[0]["samples"][0]["row"])
+
+    def test_partition_evaluated_again(self):
+        full, partial = scalableor.failure.Failures(), scalableor.failure.Failures()
+        for failures, rows in [(full, ["a", "b"]), (partial, ["a"])]:
+            for row in rows:
+                failures.add((row,), ValueError(row))
+        param = scalableor.failure.FailuresParam()
+        value = param.zero(None)
+        # e.g. head() evaluates first rows of partition 0, export evaluates all partitions
+        for term in [{0: partial}, {0: full}, {1: partial}, {0: partial}]:
+            value = param.addInPlace(value, term)
+        self.assertEqual({0: 2, 1: 1}, dict((key, f.count) for key, f in value.items()))
+
+    def test_failed_job(self):
+        work_dir = mkdtemp()
+        file_in = os.path.join(work_dir, "input.csv")
+        open(file_in, "w").write("1\nn/a\n")
+        program = [{"op": "core/text-transform", "columnName": "Column 1", "expression": "grel:value.toNumber()",
+                    "onError": "keep-original"},
+                   {"op": "core/text-transform", "columnName": "Column 1", "expression": "grel:value.toNumber()"}]
+        self.assertRaises(Exception, local_scalable_or().run_job, file_in, os.path.join(work_dir, "output.csv"),
+                          program)
+        # collectors of failed job are removed
+        self.assertEqual([], scalableor.failure.STEPS)
+
+    def test_verify(self):
+        errors = []
+        scalableor.verify.verify_on_error({"onError": "ignore"}, errors)
+        scalableor.verify.verify_on_error({"onError": "set-to-blank"}, errors)
+        self.assertEqual(1, len(errors))
+
+
+class TestRegexCache(unittest.TestCase):
+    def test_lru(self):
+        cache = scalableor.pattern.RegexCache(2)
+        first = cache.compile("a+")
+        cache.compile("b+")
+        self.assertIs(first, cache.compile("a+"))
+        cache.compile("c+")
+        cache.compile("b+")
+        self.assertEqual({"hits": 1, "misses": 4, "evictions": 2}, cache.counters)
+        self.assertEqual(["b+", "c+"], sorted(key[1] for key in cache.patterns))
+
+    def test_step_metrics(self):
+        work_dir = mkdtemp()
+        file_in = os.path.join(work_dir, "input.csv")
+        open(file_in, "w").write("1-2\n3-4\n5-6\n")
+        program = [{"op": "core/text-transform", "columnName": "Column 1",
+                    "expression": 'grel:value.match("(\\d+)-(\\d+)")[1]'}]
+        scalable_or = scalableor.run(argv=["-p", os.path.join(CASES_DIR, "core-column-move", "or.json"),
+                                           "--verify-only", "--engine", "local"])
+        metrics = scalable_or.run_job(file_in, os.path.join(work_dir, "output.csv"), program)
+        step = [m for m in metrics if m["op"] == "core/text-transform"][0]
+        self.assertEqual(3, step["regex_cache"]["hits"] + step["regex_cache"]["misses"])
+        self.assertEqual([["2"], ["4"], ["6"]], list(csv.reader(open(os.path.join(work_dir, "output.csv")))))
+
+    def test_job_accumulators(self):
+        class Accumulator(object):
+            def __init__(self, value, param):
+                self.value = value
+
+        class Context(object):
+            def accumulator(self, value, param):
+                return Accumulator(value, param)
+
+        pattern = scalableor.pattern
+        pattern.reset()
+        before = pattern.metrics()
+
+        def other_job():
+            pattern.accumulator(Context()).value[0] = {"hits": 5, "misses": 0, "evictions": 0}
+        thread = threading.Thread(target=other_job)
+        thread.start()
+        thread.join()
+        # accumulators of concurrent job aren't counted
+        self.assertEqual(before, pattern.metrics())
+
+        pattern.accumulator(Context()).value[0] = {"hits": 0, "misses": 2, "evictions": 0}
+        self.assertEqual(2, pattern.diff(pattern.metrics(), before)["misses"])
+        pattern.reset()
+        self.assertEqual(before, pattern.metrics())
+
+
+class TestCross(unittest.TestCase):
+    def test_parse(self):
+        parse_cross = scalableor.cross.parse_cross
+        self.assertEqual(('cross(cell, "p", "id", 0)[0]', [("p", "id", "base")]),
+                         parse_cross('cell.cross("p", "id")[0]', "base"))
+        self.assertEqual([("p", "id", "key")], parse_cross('cells["key"].cross("p", "id")', "base")[1])
+        self.assertEqual([("p", "id", "base")], parse_cross('cross(value, "p", "id")', "base")[1])
+
+    def test_local_lookup(self):
+        work_dir = mkdtemp()
+        file_in, file_project, file_or = [os.path.join(work_dir, i) for i in ["input.csv", "p.csv", "or.json"]]
+        open(file_in, "w").write("1,a\n2,b\n2,c\n")
+        open(file_project, "w").write("id,name\n2,two\n1,one\n1,uno\n")
+        json.dump([{"op": "core/column-addition", "baseColumnName": "Column 1", "newColumnName": "name",
+                    "expression": 'grel:cell.cross("numbers", "id")[0].cells["name"].value'},
+                   {"op": "core/text-transform", "columnName": "Column 2",
+                    "expression": 'jython:return "|".join(r.cells["name"].value for r in cross(cells["Column 1"], "numbers", "id"))'},
+                   ], open(file_or, "w"))
+
+        scalableor.run(argv=["-i", file_in, "-p", file_or, "-o", os.path.join(work_dir, "output.csv"),
+                             "--engine", "local", "--project", "numbers=" + file_project])
+        self.assertEqual([["1", "one", "one|uno"], ["2", "two", "two"], ["2", "two", "two"]],
+                         list(csv.reader(open(os.path.join(work_dir, "output.csv")))))
+
+    def test_key_columns(self):
+        exp, lookups = scalableor.cross.parse_cross(
+            'cell.cross("p", "id")[0].cells["name"].value + cells["b"].cross("p", "id")[0].cells["name"].value', "a")
+        self.assertEqual([("p", "id", "a"), ("p", "id", "b")], lookups)
+        # matches of both lookups of shuffle join are joined to row
+        batch = [(0, (u"1", u"2"), ([(u"1", u"one")], [(u"2", u"two")]))]
+        specs = [(lookup, ["id", "name"], ["a", "b"].index(lookup[2])) for lookup in lookups]
+        context = {"cross": scalableor.cross.make_cross(scalableor.cross.batch_tables(batch, specs))}
+        self.assertEqual([u"onetwo"], scalableor.context.eval_expression_batch([(u"1", u"2")], 0, exp, context,
+                                                                               ["a", "b"]))
+
+    def test_unregistered(self):
+        errors = []
+        scalableor.verify.verify_cross('cell.cross("unknown", "id")', errors)
+        self.assertEqual(1, len(errors))
+
+
+class TestCluster(unittest.TestCase):
+    def test_local(self):
+        work_dir = mkdtemp()
+        file_in, file_or = [os.path.join(work_dir, i) for i in ["input.csv", "or.json"]]
+        open(file_in, "w").write("Tom Cruise\ncruise tom\nTom Cruise\nJohn\nTom  Cruise.\nJohn\n")
+        json.dump([{"op": "scalableor/cluster", "columnName": "Column 1", "keyer": "fingerprint",
+                    "mode": "mass-edit", "output": os.path.join(work_dir, "edits.json")},
+                   {"op": "scalableor/cluster", "columnName": "Column 1", "keyer": "fingerprint",
+                    "output": os.path.join(work_dir, "report.json")}], open(file_or, "w"))
+
+        scalableor.run(argv=["-i", file_in, "-p", file_or, "-o", os.path.join(work_dir, "output.csv"),
+                             "--engine", "local"])
+        edits = json.load(open(os.path.join(work_dir, "edits.json")))
+        self.assertEqual("core/mass-edit", edits[0]["op"])
+        self.assertEqual([{"from": ["Tom  Cruise.", "cruise tom"], "fromBlank": False, "fromError": False,
+                           "to": "Tom Cruise"}], edits[0]["edits"])
+        report = json.load(open(os.path.join(work_dir, "report.json")))
+        self.assertEqual([("cruise tom", 3, 4)], [(c["key"], c["size"], c["rowCount"]) for c in report["clusters"]])
+        self.assertEqual(6, len(open(os.path.join(work_dir, "output.csv")).readlines()))
+
+    def test_unknown_keyer(self):
+        errors = []
+        scalableor.verify.sc_or_cluster({"columnName": "a", "output": "b", "keyer": "x"}, errors)
+        self.assertEqual(1, len(errors))
+
+
+class TestMultiValued(unittest.TestCase):
+    def test_split(self):
+        split = scalableor.method.get_multivalued_split_function(
+            {"columnName": "b", "keyColumnName": "a", "mode": "separator", "separator": ";"}, 1)
+        self.assertEqual([(u"1", u"x", 2), (u"", u"y", None)], split((u"1", u"x;y", 2)))
+        self.assertEqual([(u"1", u"", 2)], split((u"1", u"", 2)))
+
+    def join_partitions(self, partitions):
+        method = scalableor.method
+        summaries = [method.leading_values(iter(p), 1, 0)[0] for p in partitions]
+        extras, start = method.get_record_extras(summaries), method.record_start(summaries)
+        rows = [r for i, p in enumerate(partitions)
+                for r in method.join_partition(p, 1, 0, ";", i == start, extras.get(i, ()))]
+        return extras, rows
+
+    def test_join_partitions(self):
+        partitions = [[("1", "a"), ("", "b")], [("", "c"), ("", "")], [("", "d")], [("2", "e"), ("", "f")]]
+        extras, rows = self.join_partitions(partitions)
+        self.assertEqual({0: ["c", "d"], 3: []}, extras)
+        self.assertEqual([("1", "a;b;c;d"), ("2", "e;f")], rows)
+
+    def test_empty_first_partition(self):
+        # first record starts with blank key in first partition with rows
+        partitions = [[], [("", "a"), ("", "b")], [], [("", "c"), ("2", "d")]]
+        extras, rows = self.join_partitions(partitions)
+        self.assertEqual({1: ["c"], 3: []}, extras)
+        self.assertEqual([("", "a;b;c"), ("2", "d")], rows)
+        self.assertEqual(({}, []), self.join_partitions([[], []]))
+
+    def test_local(self):
+        work_dir = mkdtemp()
+        file_in, file_or, file_out = [os.path.join(work_dir, i) for i in ["input.csv", "or.json", "output.csv"]]
+        open(file_in, "w").write("1,a;b;c,x\n2,d,y\n3,,z\n")
+        json.dump([{"op": "core/multivalued-cell-split", "columnName": "Column 2", "keyColumnName": "Column 1",
+                    "mode": "separator", "separator": ";", "regex": False},
+                   {"op": "core/text-transform", "columnName": "Column 2", "expression": "grel:value.toUppercase()"},
+                   {"op": "core/multivalued-cell-join", "columnName": "Column 2", "keyColumnName": "Column 1",
+                    "separator": "|"}], open(file_or, "w"))
+        scalableor.run(argv=["-i", file_in, "-p", file_or, "-o", file_out, "--engine", "local"])
+        self.assertEqual([["1", "A|B|C", "x"], ["2", "D", "y"], ["3", "", "z"]], list(csv.reader(open(file_out))))
+
+    def test_verify(self):
+        errors = []
+        scalableor.verify.core_multivalued_cell_split({"columnName": "a", "keyColumnName": "b", "mode": "x"}, errors)
+        scalableor.verify.core_multivalued_cell_join({"columnName": "a", "keyColumnName": "b"}, errors)
+        self.assertEqual(2, len(errors))
+
+
+class TestFacetCount(unittest.TestCase):
+    def test_parse(self):
+        parse_facet_count = scalableor.facetcount.parse_facet_count
+        self.assertEqual(('facetCount(value, "value", "a") > 1', [("value", "a", "base")]),
+                         parse_facet_count('value.facetCount("value", "a") > 1', "base"))
+        self.assertEqual([("value.trim()", "a", "b")],
+                         parse_facet_count("grel:facetCount(cells['b'].value, 'value.trim()', 'a')", "base")[1])
+        self.assertEqual([("value", "a", None)], parse_facet_count('facetCount(value.trim(), "value", "a")', "base")[1])
+
+    def test_choices(self):
+        # choice values without key column are evaluated for join of many counts
+        choices = {}
+        cmd = {"columnName": "b",
+               "expression": 'facetCount(value.trim(), "value", "a") + facetCount(value, "value", "a")',
+               "engineConfig": {"facets": [{"type": "list", "columnName": "c",
+                                            "expression": 'facetCount(value + "x", "value", "a") > 1'}]}}
+        lookups = scalableor.facetcount.rewrite_command(cmd, "b", choices)[1]
+        self.assertEqual([("value", "a", None), ("value", "a", "b")], lookups)
+        self.assertEqual({("value", "a", None): [("value.trim()", "b"), ('value + "x"', "c")]}, choices)
+
+    def test_local(self):
+        work_dir = mkdtemp()
+        file_in, file_or, file_out = [os.path.join(work_dir, i) for i in ["input.csv", "or.json", "output.csv"]]
+        open(file_in, "w").write("a,1\nb,2\na,3\nc,4\nA ,5\n")
+        facet = {"type": "list", "name": "dup", "columnName": "Column 1", "omitBlank": False, "omitError": False,
+                 "expression": 'grel:facetCount(value, "value", "Column 1") > 1', "selectBlank": False,
+                 "selectError": False, "invert": False, "selection": [{"v": {"v": True, "l": "true"}}]}
+        json.dump([{"op": "core/column-addition", "baseColumnName": "Column 1", "newColumnName": "count",
+                    "expression": 'grel:value.facetCount("value.trim().toLowercase()", "Column 1")'},
+                   {"op": "core/row-removal", "engineConfig": {"facets": [facet], "mode": "row-based"}}],
+                  open(file_or, "w"))
+        scalableor.run(argv=["-i", file_in, "-p", file_or, "-o", file_out, "--engine", "local"])
+        self.assertEqual([["b", "1", "2"], ["c", "1", "4"], ["A ", "0", "5"]], list(csv.reader(open(file_out))))
+
+    def test_plan(self):
+        errors = []
+        step = scalableor.plan.PlannersManager.get("core/text-transform")(
+            {"columnName": "a", "expression": 'facetCount(value, "value", "b") > 1'}, ["a", "b"], errors)
+        self.assertEqual(([], ["a", "b"], False, 1), (errors, step["reads"], step["row_local"], step["shuffles"]))
+
+    def test_verify(self):
+        errors = []
+        scalableor.verify.verify_facet_count({"expression": 'cross(value, "p", "id") + facetCount(value, x, "a")'},
+                                             errors)
+        self.assertEqual(2, len(errors))
+
+
+class ReconHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    stand-in of reconciliation service: candidate of every query is its uppercase value
+    """
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def do_POST(self):
+        form = urlparse.parse_qs(self.rfile.read(int(self.headers["Content-Length"])))
+        queries = json.loads(form["queries"][0])
+        ReconHandler.requests.append(len(queries))
+        body = json.dumps(dict((k, {"result": [{"id": q["query"].upper(), "name": q["query"], "score": 100,
+                                               "match": q["query"] != "b", "type": [{"id": "Q5"}]}]})
+                               for k, q in queries.items()))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # keep-alive connections of client pool are served in parallel
+    daemon_threads = True
+
+
+def start_server(handler):
+    server = StandInServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class TestRecon(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server(ReconHandler)
+        ReconHandler.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_local(self):
+        work_dir = mkdtemp()
+        file_in, file_or, file_out = [os.path.join(work_dir, i) for i in ["input.csv", "or.json", "output.csv"]]
+        open(file_in, "w").write("a\nb\na\nc\n\nd\na\ne\n")
+        service = "http://127.0.0.1:%d/reconcile" % self.server.server_port
+        json.dump([{"op": "core/recon", "columnName": "Column 1",
+                    "config": {"mode": "standard-service", "service": service, "batchSize": 2}},
+                   {"op": "core/column-rename", "oldColumnName": "Column 1", "newColumnName": "name"},
+                   {"op": "core/column-addition", "baseColumnName": "name", "newColumnName": "judgment",
+                    "expression": "grel:recon.judgment", "onError": "set-to-blank"},
+                   {"op": "core/column-addition", "baseColumnName": "name", "newColumnName": "id",
+                    "expression": "grel:cell.recon.match.id", "onError": "set-to-blank"}],
+                  open(file_or, "w"))
+        argv = ["-i", file_in, "-p", file_or, "-o", file_out, "--engine", "local",
+                "--recon-cache", os.path.join(work_dir, "recon.db")]
+        scalableor.run(argv=argv)
+        expected = [["a", "A", "matched"], ["b", "", "none"], ["a", "A", "matched"], ["c", "C", "matched"],
+                    ["", "", ""], ["d", "D", "matched"], ["a", "A", "matched"], ["e", "E", "matched"]]
+        self.assertEqual(expected, list(csv.reader(open(file_out))))
+        # 5 distinct values in batches of 2
+        self.assertEqual([1, 2, 2], sorted(ReconHandler.requests))
+
+        # results are cached
+        scalableor.run(argv=argv)
+        self.assertEqual(expected, list(csv.reader(open(file_out))))
+        self.assertEqual(3, len(ReconHandler.requests))
+
+    def test_verify(self):
+        errors = []
+        scalableor.verify.core_recon({"columnName": "a", "config": {}}, errors)
+        scalableor.verify.core_recon({"columnName": "a", "config": {"service": "x", "mode": "extend"}}, errors)
+        self.assertEqual(2, len(errors))
+
+    def test_rename(self):
+        table = scalableor.recon.ReconTable({"columnName": "a", "config": {}}, {})
+        renamed = table.rename("a", "b")
+        self.assertEqual((["a"], ["b"]), (table.columns, renamed.columns))
+        self.assertEqual(["b"], table.rename("x", "y").rename("a", "b").columns)
+
+
+class FetchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    stand-in of web service: body of response is its path, /old is redirected to /new, /missing isn't found
+    """
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def do_GET(self):
+        FetchHandler.requests.append(self.path)
+        body = "got " + self.path
+        self.send_response({"/old": 302, "/missing": 404}.get(self.path, 200))
+        if self.path == "/old":
+            self.send_header("Location", "/new")
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetchUrls(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server(FetchHandler)
+        FetchHandler.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_local(self):
+        work_dir = mkdtemp()
+        file_in, file_or, file_out = [os.path.join(work_dir, i) for i in ["input.csv", "or.json", "output.csv"]]
+        open(file_in, "w").write("a\nb\na\n\nmissing\nold\n")
+        url = "grel:'http://127.0.0.1:%d/' + value" % self.server.server_port
+        json.dump([{"op": "core/column-addition-by-fetching-urls", "baseColumnName": "Column 1",
+                    "newColumnName": "page", "urlExpression": url, "onError": "set-to-blank", "delay": 10,
+                    "cacheResponses": True, "httpHeadersJson": [{"name": "User-Agent", "value": "test"}]}],
+                  open(file_or, "w"))
+        argv = ["-i", file_in, "-p", file_or, "-o", file_out, "--engine", "local",
+                "--fetch-cache", os.path.join(work_dir, "fetch.db")]
+        scalableor.run(argv=argv)
+        expected = [["a", "got /a"], ["b", "got /b"], ["a", "got /a"], ["", "got /"], ["missing", ""],
+                    ["old", "got /new"]]
+        self.assertEqual(expected, list(csv.reader(open(file_out))))
+        self.assertEqual(["/", "/a", "/b", "/missing", "/new", "/old"], sorted(FetchHandler.requests))
+
+        # only failed URL is fetched again
+        scalableor.run(argv=argv)
+        self.assertEqual(expected, list(csv.reader(open(file_out))))
+        self.assertEqual(7, len(FetchHandler.requests))
+
+    def test_rate_limit(self):
+        pool = scalableor.fetch.HostPool("http", "127.0.0.1:%d" % self.server.server_port, delay=50)
+        started = time.time()
+        for _ in range(5):
+            pool.wait_turn()
+        self.assertGreaterEqual(time.time() - started, 0.19)
+
+    def test_verify(self):
+        errors = []
+        scalableor.verify.core_column_addition_by_fetching_urls({"baseColumnName": "a", "newColumnName": "b"}, errors)
+        scalableor.verify.core_column_addition_by_fetching_urls(
+            {"baseColumnName": "a", "newColumnName": "b", "urlExpression": "grel:value", "delay": -1}, errors)
+        self.assertEqual(2, len(errors))
+
+
+class TestProfile(unittest.TestCase):
+    def test_distinct(self):
+        first, second = scalableor.profiling.HyperLogLog(), scalableor.profiling.HyperLogLog()
+        for i in range(20000):
+            (first if i % 2 else second).add(unicode(i % 10000))
+        self.assertLess(abs(first.merge(second).estimate() - 10000), 10000 * 3 * first.error())
+        small = scalableor.profiling.HyperLogLog()
+        for value in [u"a", u"b", u"a"]:
+            small.add(value)
+        self.assertEqual(2, small.estimate())
+
+    def test_heavy_hitters(self):
+        hitters = scalableor.profiling.HeavyHitters(3)
+        hitters.update(dict([(u"a", 50), (u"b", 30)] + [(unicode(i), 1) for i in range(10)]))
+        other = scalableor.profiling.HeavyHitters(3)
+        other.update({u"b": 30, u"c": 5})
+        top = hitters.merge(other).top(2)
+        self.assertEqual([u"b", u"a"], [v for v, c in top])
+        self.assertLessEqual(60 - top[0][1], hitters.error)
+
+    def test_local(self):
+        work_dir = mkdtemp()
+        file_in, file_or, file_profile = [os.path.join(work_dir, i) for i in ["input.csv", "or.json", "p.json"]]
+        open(file_in, "w").write("a,1\nbb,\na,22\nccc,4444\n")
+        json.dump([{"op": "scalableor/profile", "output": file_profile, "topValues": 1}], open(file_or, "w"))
+        scalableor.run(argv=["-i", file_in, "-p", file_or, "-o", os.path.join(work_dir, "output.csv"),
+                             "--engine", "local"])
+        report = json.load(open(file_profile))
+        self.assertEqual(4, report["rows"])
+        first, second = report["columns"]
+        self.assertEqual((u"Column 1", 3, [{u"v": u"a", u"c": 2}]),
+                         (first["name"], first["distinct"], first["topValues"]))
+        self.assertEqual((1, 0, 4), (second["blanks"], second["lengths"]["min"], second["lengths"]["max"]))
+        self.assertEqual([(0, 0, 1), (1, 1, 1), (2, 3, 1), (4, 7, 1)],
+                         [(h["from"], h["to"], h["c"]) for h in second["lengths"]["histogram"]])
+        self.assertEqual(4, len(open(os.path.join(work_dir, "output.csv")).readlines()))
+
+    def test_cross_size(self):
+        work_dir = mkdtemp()
+        file_project = os.path.join(work_dir, "p.csv")
+        open(file_project, "w").write("id,name\n1,one\n")
+        scalableor.cross.register_project("profiled", file_project)
+        self.assertEqual(os.path.getsize(file_project), scalableor.cross.project_size("profiled"))
+        json.dump({"rows": 1, "bytes": 100 * 1024 * 1024, "columns": []}, open(file_project + ".profile.json", "w"))
+        self.assertFalse(scalableor.cross.is_broadcast(["profiled"]))
+
+
+class TestVerifyOnly(unittest.TestCase):
+    def test_cases(self):
+        for case in sorted(os.listdir(CASES_DIR)):
+            scalableor.run(argv=[
+                "-i", os.path.join(CASES_DIR, case, "input.csv"),
+                "-p", os.path.join(CASES_DIR, case, "or.json"),
+                "-o", os.path.join(mkdtemp(), "output.csv"),
+                "--verify-only"
+            ])
+
+    def test_unknown_method(self):
+        file_or = NamedTemporaryFile(suffix=".json")
+        file_or.write('[{"op": "core/unknown"}]')
+        file_or.flush()
+        self.assertRaises(SystemExit, scalableor.run, argv=["-p", file_or.name, "--verify-only"])
+
+
+class TestCodeBundle(unittest.TestCase):
+    def test_reuse(self):
+        bundle_dir = mkdtemp()
+        scalable_or = scalableor.run(argv=["-p", os.path.join(CASES_DIR, "core-column-move", "or.json"),
+                                           "--verify-only", "--bundle-dir", bundle_dir])
+        package_dir = os.path.dirname(scalableor.__file__)
+        zippath = scalable_or.build_bundle(package_dir)
+        self.assertTrue(os.path.exists(zippath))
+        self.assertEqual(zippath, scalable_or.build_bundle(package_dir))
+        self.assertEqual([os.path.basename(zippath)], os.listdir(bundle_dir))
+
+
+class TestPlan(unittest.TestCase):
+    def do_plan(self, or_program):
+        file_or = NamedTemporaryFile(suffix=".json")
+        json.dump(or_program, file_or)
+        file_or.flush()
+        return scalableor.run(argv=["-i", os.path.join(CASES_DIR, "core-column-move", "input.csv"),
+                                    "-p", file_or.name, "--plan"])
+
+    def test_base(self):
+        self.do_plan([{"op": "core/column-rename", "oldColumnName": "Column 3", "newColumnName": "test"},
+                      {"op": "core/column-removal", "columnName": "test"}])
+
+    def test_without_output(self):
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            self.do_plan([{"op": "core/column-rename", "oldColumnName": "Column 3", "newColumnName": "test"}])
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn("core/column-rename", printed)
+        self.assertNotIn("scalableor/export", printed)
+
+    def test_missing_column(self):
+        self.assertRaises(SystemExit, self.do_plan, [
+            {"op": "core/column-rename", "oldColumnName": "Column 3", "newColumnName": "test"},
+            {"op": "core/column-rename", "oldColumnName": "Column 3", "newColumnName": "test2"}])
+
+    def test_columns(self):
+        case_dir = os.path.join(CASES_DIR, "or-demo-wiki")
+        or_program = json.load(open(os.path.join(case_dir, "or.json")))
+        or_program.insert(0, {"op": "scalableor/import", "separator": ",", "path": os.path.join(case_dir, "input.csv")})
+        plan = scalableor.plan.build_plan(or_program)
+        self.assertEqual([], plan.errors)
+        self.assertEqual(["actor", "film", "character", "Is Winner"], plan.steps[-1]["columns"])
+
+
+class TestOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.input = os.path.join(CASES_DIR, "core-column-move", "input.csv")
+
+    def optimize(self, or_program):
+        program = [{"op": "scalableor/import", "separator": ",", "path": self.input}] + or_program
+        return scalableor.optimizer.optimize(program)[1:]
+
+    def test_renames(self):
+        rename = lambda old, new: {"op": "core/column-rename", "oldColumnName": old, "newColumnName": new}
+        move = {"op": "core/column-move", "columnName": "b", "index": 0}
+        self.assertEqual([], self.optimize([rename("Column 1", "a"), rename("a", "Column 1")]))
+        self.assertEqual([rename("Column 1", "c")], self.optimize([rename("Column 1", "a"), rename("a", "c")]))
+        self.assertEqual([dict(move, columnName="Column 2"), rename("Column 2", "b")],
+                         self.optimize([rename("Column 2", "a"), rename("a", "b"), move]))
+        # swap of names can't be expressed by fewer renames
+        swap = [rename("Column 1", "t"), rename("Column 2", "Column 1"), rename("t", "Column 2")]
+        self.assertEqual(swap, self.optimize(swap))
+
+    def test_dead_steps(self):
+        transform = {"op": "core/text-transform", "columnName": "Column 2", "expression": "grel:value.trim()"}
+        addition = {"op": "core/column-addition", "baseColumnName": "Column 1", "newColumnName": "tmp",
+                    "expression": "grel:value + 'x'"}
+        removal = {"op": "core/column-removal", "columnName": "Column 2"}
+        self.assertEqual([removal], self.optimize([transform, removal]))
+        self.assertEqual([], self.optimize([addition, {"op": "core/column-removal", "columnName": "tmp"}]))
+        # column is read before removal
+        used = dict(addition, expression="grel:cells['Column 2'].value")
+        self.assertEqual([transform, used, removal], self.optimize([transform, used, removal]))
+
+    def test_push_filters(self):
+        transform = {"op": "core/text-transform", "columnName": "Column 1", "expression": "grel:value.toUppercase()"}
+        facet = {"type": "text", "name": "f", "columnName": "Column 2", "query": "test1", "mode": "text",
+                 "caseSensitive": False}
+        removal = {"op": "core/row-removal", "engineConfig": {"facets": [facet], "mode": "row-based"}}
+        self.assertEqual([removal, transform], self.optimize([transform, removal]))
+        # removal reads transformed column
+        removal = {"op": "core/row-removal", "engineConfig": {"facets": [dict(facet, columnName="Column 1")],
+                                                              "mode": "row-based"}}
+        self.assertEqual([transform, removal], self.optimize([transform, removal]))
+
+    def test_local(self):
+        work_dir = mkdtemp()
+        file_or = os.path.join(work_dir, "or.json")
+        facet = {"type": "text", "name": "f", "columnName": "Column 2", "query": "test1", "mode": "text",
+                 "caseSensitive": False}
+        json.dump([{"op": "core/text-transform", "columnName": "Column 1", "expression": "grel:value.toUppercase()"},
+                   {"op": "core/column-rename", "oldColumnName": "Column 3", "newColumnName": "x"},
+                   {"op": "core/column-rename", "oldColumnName": "x", "newColumnName": "y"},
+                   {"op": "core/row-removal", "engineConfig": {"facets": [facet], "mode": "row-based"}}],
+                  open(file_or, "w"))
+        outputs = []
+        for options in [[], ["--optimize"]]:
+            file_out = os.path.join(work_dir, "output%d.csv" % len(options))
+            scalableor.run(argv=["-i", self.input, "-p", file_or, "-o", file_out, "--engine", "local"] + options)
+            outputs.append(list(csv.reader(open(file_out))))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(["TEST", "test4", "test5-test2"], outputs[1][0])
+
+
+class TestSample(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        self.file_in = os.path.join(self.work_dir, "input.csv")
+        with open(self.file_in, "w") as f:
+            for i in range(2000):
+                f.write("%04d,x\n" % i)
+
+    def run_sample(self, or_program, *options):
+        file_or, file_out = [os.path.join(self.work_dir, i) for i in ["or.json", "output.csv"]]
+        json.dump(or_program, open(file_or, "w"))
+        scalableor.run(argv=["-i", self.file_in, "-p", file_or, "-o", file_out, "--engine", "local"] + list(options))
+        return list(csv.reader(open(file_out)))
+
+    def test_parse(self):
+        self.assertEqual(("fraction", 0.1), scalableor.sample.parse_sample("0.1"))
+        self.assertEqual(("rows", 100), scalableor.sample.parse_sample("100"))
+        self.assertRaises(ValueError, scalableor.sample.parse_sample, "1.5")
+        self.assertEqual(2000, scalableor.sample.estimate_rows(self.file_in))
+
+    def test_local(self):
+        program = [{"op": "core/text-transform", "columnName": "Column 2", "expression": "grel:value + value"}]
+        first = self.run_sample(program, "--sample", "0.1")
+        self.assertTrue(100 < len(first) < 300)
+        self.assertEqual(["xx"], list(set(r[1] for r in first)))
+        # the same seed gives the same sample
+        self.assertEqual(first, self.run_sample(program, "--sample", "0.1"))
+        self.assertNotEqual(first, self.run_sample(program, "--sample", "0.1", "--sample-seed", "7"))
+        self.assertTrue(20 < len(self.run_sample(program, "--sample", "100")) < 200)
+
+    def test_first_error(self):
+        program = [{"op": "core/text-transform", "columnName": "Column 2", "expression": "grel:value.toNumber()"},
+                   {"op": "core/column-removal", "columnName": "Column 1"}]
+        self.assertRaises(SystemExit, self.run_sample, program, "--sample", "0.1")
+
+    def test_report(self):
+        metrics = [{"op": "scalableor/import", "seconds": 0.1}, {"op": "scalableor/sample", "seconds": 0.2, "rows": 10}]
+        report = scalableor.sample.format_report(metrics, 0.01)
+        self.assertIn("1000", report)
+        self.assertIn("estimated 30.0 s", report)